@@ -0,0 +1,234 @@
+'''
+Ad hoc performance measurements. Run from this folder, e.g.
+`python3 benchmark.py client-startup`. Uses a throwaway save folder so that it
+never touches a real Bioprintly instance's state.
+'''
+import os
+import signal
+from statistics import median, quantiles
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from threading import Timer
+from time import perf_counter, process_time, sleep
+from typing import Callable, Dict, List
+
+SCRIPTS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+def time_subprocess_runs_ms(
+	args: List[str],
+	env: Dict[str, str],
+	runs: int,
+) -> List[float]:
+	durations_ms = []
+	for _ in range(runs):
+		start = perf_counter()
+		subprocess.run(args, cwd = SCRIPTS_FOLDER, env = env, check = True)
+		durations_ms.append((perf_counter() - start) * 1e3)
+	return durations_ms
+
+def print_distribution(label: str, durations_ms: List[float]):
+	print(f'{label.ljust(48)} median {median(durations_ms):7.1f} ms, p90 {quantiles(durations_ms, n = 10)[-1]:7.1f} ms')
+
+def benchmark_client_startup(runs = 20):
+	'''
+	Cold start of request.py as Klipper macros invoke it. `G1` without an E
+	param builds no commands, so nothing is submitted and no Bioprintly
+	instance is needed. Importing state.py is what request.py used to pay
+	before it was split away from Tk and state management.
+	'''
+	with TemporaryDirectory() as home:
+		env = { **os.environ, 'HOME': home }
+		for label, args in [
+			('python3 request.py (as in macros.cfg)', ['python3', 'request.py', 'G1']),
+			('python3 -c "import state" (old import graph)', ['python3', '-c', 'import state']),
+			('python3 -c "pass" (interpreter floor)', ['python3', '-c', 'pass']),
+		]:
+			print_distribution(label, time_subprocess_runs_ms(args, env, runs))
+
+def benchmark_headless_startup(runs = 10):
+	'''
+	Time from launching the service headless until its IPC socket is ready, and
+	its resident memory then. Importing Tk on top is what it used to pay, GUI
+	or not. Pins are never set up with GPIO, so this runs anywhere.
+	'''
+	from request_protocol import get_ipc_socket_path
+	for label, args in [
+		('python3 main.py --headless', ['python3', 'main.py', '--headless']),
+		('same, with tkinter.messagebox imported', [
+			'python3',
+			'-c',
+			'import runpy, sys, tkinter.messagebox; sys.argv = ["main.py", "--headless"]; runpy.run_path("main.py")',
+		]),
+	]:
+		durations_ms = []
+		resident_memory_kb = []
+		for _ in range(runs):
+			with TemporaryDirectory() as home:
+				env = { **os.environ, 'HOME': home }
+				socket_path = get_ipc_socket_path(f'{home}/.bioprintly')
+				start = perf_counter()
+				process = subprocess.Popen(
+					args,
+					cwd = SCRIPTS_FOLDER,
+					env = env,
+					stdout = subprocess.DEVNULL,
+					stderr = subprocess.DEVNULL,
+				)
+				while not os.path.exists(socket_path):
+					sleep(0.001)
+				durations_ms.append((perf_counter() - start) * 1e3)
+				with open(f'/proc/{process.pid}/status', 'r') as status:
+					resident_memory_kb += [
+						int(line.split()[1])
+						for line in status
+						if line.startswith('VmRSS:')
+					]
+				process.send_signal(signal.SIGTERM)
+				process.wait()
+		print_distribution(label, durations_ms)
+		print(f"{''.ljust(48)} resident memory median {median(resident_memory_kb) / 1024:7.1f} MB")
+
+def benchmark_g_code_parsing(megabytes = 200):
+	'''
+	Streams synthetic slicer output (relative extruding moves between absolute
+	travel moves) through the modal parser, reporting and timing every G1 under
+	config/printer.cfg's limits as the compiler does.
+	'''
+	from g_code_parsing import get_numpy, stream_g_code_file
+	from kinematics import read_kinematic_limits
+	with TemporaryDirectory() as folder:
+		path = f'{folder}/synthetic.gcode'
+		block = ''.join(
+			f'G90\nG0 X{i % 200} Y{i % 150} Z0.2 F6000\nG91\nG1 X1.5 Y-0.75 E0.04 F1200 ; extrude\n'
+			for i in range(1000)
+		)
+		with open(path, 'w') as file:
+			file.write('M83\n')
+			for _ in range(megabytes * 2 ** 20 // len(block)):
+				file.write(block)
+		size_mb = os.path.getsize(path) / 2 ** 20
+
+		start = perf_counter()
+		reported_line_count = 0
+		for batch in stream_g_code_file(path, ['G1'], read_kinematic_limits()):
+			reported_line_count += len(batch['line_numbers'])
+		duration_s = perf_counter() - start
+		print(f"Parsed {size_mb:.0f} MB ({reported_line_count} G1 lines reported) in {duration_s:.2f} s, {size_mb / duration_s:.0f} MB/s, NumPy {'used' if get_numpy() != None else 'not installed'}")
+
+def benchmark_service_idle_cpu(seconds = 10.0):
+	'''
+	CPU used by the service, PWM engine and state writer threads while there's
+	nothing to do, paused and then processing an empty queue. Pins are never
+	set up, so this runs without GPIO.
+	'''
+	with TemporaryDirectory() as home:
+		os.environ['HOME'] = home
+		from journal import run_state_writer, start_state_journal
+		from pins import run_pwm_engine
+		from service import run_service
+		from state import build_default_global_state, wake_service_threads
+		state = build_default_global_state()
+		state['current_syringe'] = 1
+		state['actuator_position_mm'] = 0.0
+		state['plunger_positions_mm'] = { '1': 5.0, '2': 5.0, '3': 5.0, '4': 5.0 }
+		start_state_journal(state)
+		for run in [run_state_writer, run_service, run_pwm_engine]:
+			Timer(0, run, [state]).start()
+
+		for label, processing_enabled in [
+			('Processing paused', False),
+			('Processing enabled, queue empty', True),
+		]:
+			state['nonpersistent']['processing_enabled'] = processing_enabled
+			wake_service_threads(state)
+			sleep(0.5)
+			cpu_start = process_time()
+			wall_start = perf_counter()
+			sleep(seconds)
+			cpu_percent = (
+				(process_time() - cpu_start) / (perf_counter() - wall_start) * 100
+			)
+			print(f'{label.ljust(48)} {cpu_percent:5.2f}% of a core')
+
+		state['nonpersistent']['shutting_down'] = True
+		wake_service_threads(state)
+		state['nonpersistent']['state_writer_stopped'].wait()
+
+def benchmark_motion_jitter(seconds = 10.0):
+	'''
+	PWM engine tick-to-tick times under load like the GUI's: a thread deep
+	copying and serializing a full command history, as redraws and the state
+	writer do. Runs the engine in the motion core process first, since that
+	forks, then as a thread of this one. Pins are never set up, so this runs
+	without GPIO.
+	'''
+	with TemporaryDirectory() as home:
+		os.environ['HOME'] = home
+		from copy import deepcopy
+		import json
+		from motion_core import set_motion_duty_cycle, start_motion_core, stop_motion_core
+		from pins import run_pwm_engine
+		from state import build_default_global_state
+		from timing import get_loop_deltas_ms
+		history = [
+			{
+				'ordinal': ordinal,
+				'enqueued_by': 'Klipper',
+				'enqueued_at': 0,
+				'started_at': 0,
+				'finished_at': 0,
+				'specifics': {
+					'verb': 'Actuate',
+					'relative_mm_required': 0.04,
+					'duration_ms_required': 120.0,
+				},
+			}
+			for ordinal in range(1000)
+		]
+
+		for label, in_motion_core in [
+			('PWM engine in motion core process', True),
+			('PWM engine as a thread', False),
+		]:
+			state = build_default_global_state()
+			nonpersistent = state['nonpersistent']
+			nonpersistent['processing_enabled'] = True
+			state['pins']['actuator_extend'] = { 'number': 12, 'io_type': 'Output', 'value': 0 }
+			if in_motion_core:
+				start_motion_core(state)
+			else:
+				Timer(0, run_pwm_engine, [state]).start()
+			set_motion_duty_cycle(state, 'actuator_extend', 0.5)
+
+			load_until = perf_counter() + seconds
+			def load():
+				while perf_counter() < load_until:
+					json.dumps(deepcopy(history))
+			load_thread = Timer(0, load)
+			load_thread.start()
+			load_thread.join()
+
+			deltas_ms = get_loop_deltas_ms(nonpersistent['pwm_tick_deltas'])
+			percentiles = quantiles(deltas_ms, n = 1000)
+			print(f"{label.ljust(48)} p50 {median(deltas_ms):6.2f} ms, p99 {percentiles[989]:6.2f} ms, p99.9 {percentiles[998]:6.2f} ms, max {max(deltas_ms):6.2f} ms ({nonpersistent['pwm_engine_interval_ms']} ms interval)")
+
+			nonpersistent['shutting_down'] = True
+			if in_motion_core:
+				stop_motion_core(state)
+			else:
+				nonpersistent['pwm_wakeup_event'].set()
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {
+	'client-startup': benchmark_client_startup,
+	'g-code-parsing': benchmark_g_code_parsing,
+	'headless-startup': benchmark_headless_startup,
+	'motion-jitter': benchmark_motion_jitter,
+	'service-idle-cpu': benchmark_service_idle_cpu,
+}
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+		print(f'Usage: python3 benchmark.py <{"|".join(BENCHMARKS.keys())}>')
+		exit(1)
+	BENCHMARKS[sys.argv[1]]()
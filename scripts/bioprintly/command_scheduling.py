@@ -0,0 +1,92 @@
+'''
+Lets queued commands run at the same time when they don't share hardware,
+e.g. a heating pad switching on while the actuator is mid-extrusion. Each
+command reads and writes a set of resources. It may start once no earlier
+queued command writes anything it touches, or touches anything it writes.
+Barriers write everything, so they wait on, and hold back, every other
+command. Commands touching disjoint resources commute, so finishing them out
+of order leaves the hardware just as running them in order would.
+'''
+from __future__ import annotations
+from commands import CommandSpecifics, SyringeNumber
+from typing import List, Set, TypedDict, TYPE_CHECKING, get_args
+
+if TYPE_CHECKING:
+	from state import EnqueuedCommand, GlobalState
+
+class CommandResources(TypedDict):
+	reads: Set[str]
+	writes: Set[str]
+
+EVERYTHING = '*'
+
+def get_command_resources(
+	specifics: CommandSpecifics,
+	current_syringe: SyringeNumber | None,
+) -> CommandResources:
+	'''
+	`current_syringe` is None when an earlier queued command may still rotate
+	the barrel, in which case 'Current one' could end up being any of them
+	'''
+	if specifics['verb'] == 'Rotate':
+		# Rotating with the actuator extended would crash it into the barrel
+		return { 'reads': { 'actuator' }, 'writes': { 'barrel' } }
+	if specifics['verb'] == 'Actuate':
+		# Pushes (and records) the current syringe's plunger
+		return { 'reads': { 'barrel' }, 'writes': { 'actuator' } }
+	if specifics['verb'] == 'Barrier':
+		return { 'reads': set(), 'writes': { EVERYTHING } }
+
+	if specifics['verb'] == 'Turn heating pad':
+		target = specifics['target_heating_pad']
+		prefix = 'heating_pad'
+	else:
+		target = specifics['target_uv_light']
+		prefix = 'uv_light'
+	if target != 'Current one':
+		return { 'reads': set(), 'writes': { f'{prefix}_{target}' } }
+	if current_syringe == None:
+		return {
+			'reads': { 'barrel' },
+			'writes': set(f'{prefix}_{syringe}' for syringe in get_args(SyringeNumber)),
+		}
+	return { 'reads': { 'barrel' }, 'writes': { f'{prefix}_{current_syringe}' } }
+
+def find_runnable_commands(state: GlobalState) -> List[EnqueuedCommand]:
+	'''
+	Walks the queue in order, up to the scheduling window, claiming each
+	command's resources whether or not it can run yet. That way, a command
+	never overtakes an earlier one it conflicts with. Commands already started
+	stay runnable, since the commands ahead of them can only finish. Finished
+	commands still waiting to leave the queue are skipped.
+	'''
+	claimed_reads: Set[str] = set()
+	claimed_writes: Set[str] = set()
+	runnable: List[EnqueuedCommand] = []
+	commands_walked = 0
+	for command in state['command_queue']:
+		if 'finished_at' in command:
+			continue
+		if commands_walked == state['nonpersistent']['command_scheduling_window']:
+			break
+		commands_walked += 1
+		resources = get_command_resources(
+			command['specifics'],
+			None if 'barrel' in claimed_writes else state['current_syringe'],
+		)
+		if not (
+			EVERYTHING in claimed_writes
+			or (
+				EVERYTHING in resources['writes']
+				and len(claimed_reads) + len(claimed_writes) > 0
+			)
+			or not resources['writes'].isdisjoint(claimed_reads)
+			or not resources['writes'].isdisjoint(claimed_writes)
+			or not resources['reads'].isdisjoint(claimed_writes)
+		):
+			runnable.append(command)
+		claimed_reads |= resources['reads']
+		claimed_writes |= resources['writes']
+		if EVERYTHING in claimed_writes:
+			break
+	return runnable
@@ -0,0 +1,69 @@
+'''
+Command and request types shared by the service and request.py. Kept free of
+Tk and state management imports so that request.py starts quickly.
+'''
+from typing import List, Literal, NotRequired, TypedDict
+
+SyringeNumber = Literal[1, 2, 3, 4]
+OnOff = Literal['On', 'Off']
+Enqueuer = Literal['Klipper', 'Operator', 'Bioprintly']
+'''Bioprintly enqueues housekeeping of its own, like unwinding the barrel'''
+ActuatorTravel = Literal[
+	'Retract fully',
+	'Retract to clearance',
+	'Go to plunger flange',
+]
+
+class CommandRotate(TypedDict):
+	verb: Literal['Rotate']
+	target_syringe: SyringeNumber
+	relative_degrees_required: NotRequired[float]
+	relative_degrees_traveled: NotRequired[float]
+class CommandActuate(TypedDict):
+	verb: Literal['Actuate']
+	duration_ms_required: float
+	relative_mm_required: float | ActuatorTravel
+	'''Retracting to clearance stops just short of where the barrel may rotate'''
+	relative_mm_traveled: NotRequired[float]
+class CommandTurnHeatingPad(TypedDict):
+	verb: Literal['Turn heating pad']
+	target_heating_pad: SyringeNumber | Literal['Current one']
+	on_or_off: OnOff
+class CommandTurnUvLight(TypedDict):
+	verb: Literal['Turn UV light']
+	target_uv_light: SyringeNumber | Literal['Current one']
+	on_or_off: OnOff
+class CommandBarrier(TypedDict):
+	'''Waits for everything enqueued before it, and holds back everything after'''
+	verb: Literal['Barrier']
+
+CommandSpecifics = (
+	CommandRotate
+	| CommandActuate
+	| CommandTurnHeatingPad
+	| CommandTurnUvLight
+	| CommandBarrier
+)
+
+class ProgramAdvance(TypedDict):
+	program_sha256: str
+	'''Content hash of a G-code file compiled by g_code_compiler.py'''
+	marker: int
+	'''Index of the sync marker Klipper has reached'''
+class Request(TypedDict):
+	timestamp: int
+	'''Unix epoch milliseconds'''
+	commands: List[CommandSpecifics]
+	program_advance: NotRequired[ProgramAdvance]
+	'''Enqueues a compiled program's commands up to a sync marker'''
+	awaits_completion: NotRequired[bool]
+	'''False for G1, which Klipper doesn't wait on'''
+class Response(TypedDict):
+	completed_request_timestamp: int
+class Acknowledgment(TypedDict):
+	'''IPC socket reply to requests that don't await completion'''
+	enqueued_request_timestamp: int
+class Rejection(TypedDict):
+	'''IPC socket reply to requests that couldn't be enqueued'''
+	rejected_request_timestamp: int
+	reason: str
@@ -0,0 +1,106 @@
+from commands import CommandSpecifics, SyringeNumber
+from g_code_parsing import ParsedBatch, get_relative_modal_state, parse_g_code_lines
+from kinematics import read_kinematic_limits
+from typing import List, cast, get_args
+
+def build_commands_for_g_code(
+	g_code: str,
+	params: List[str],
+) -> List[CommandSpecifics]:
+	'''
+	`params` are the words after the G-code, e.g. ['X10', 'F600', 'E2']. With no
+	surrounding lines to go on, moves are taken as relative and as starting and
+	ending at rest.
+	'''
+	if g_code == 'M140':
+		for param in params:
+			if param[0] == 'S':
+				on_or_off = 'Off' if float(param[1:]) == 0.0 else 'On'
+				break
+		else:
+			return []
+		commands = [
+			{
+				'verb': 'Actuate',
+				'duration_ms_required': 0.0,
+				'relative_mm_required': 'Retract fully',
+			},
+			{
+				'verb': 'Turn UV light',
+				'target_uv_light': 'Current one',
+				'on_or_off': on_or_off,
+			},
+		]
+		for i in get_args(SyringeNumber):
+			commands.append({
+				'verb': 'Turn heating pad',
+				'target_heating_pad': i,
+				'on_or_off': on_or_off,
+			})
+		return commands
+	elif g_code[0] == 'T':
+		target_syringe = 1 + int(g_code[1:])
+		if not target_syringe in get_args(SyringeNumber):
+			raise Exception(f'T-code {g_code} out of range in bioprintly/g_code.py')
+		target_syringe = cast(SyringeNumber, target_syringe)
+		return [
+			{
+				'verb': 'Actuate',
+				'duration_ms_required': 0.0,
+				'relative_mm_required': 'Retract to clearance',
+			},
+			{
+				'verb': 'Turn UV light',
+				'target_uv_light': 'Current one',
+				'on_or_off': 'Off',
+			},
+			{
+				'verb': 'Rotate',
+				'target_syringe': target_syringe,
+			},
+			{
+				'verb': 'Turn UV light',
+				'target_uv_light': 'Current one',
+				'on_or_off': 'On'
+			},
+		]
+	elif g_code == 'M83':
+		return [
+			{
+				'verb': 'Actuate',
+				'duration_ms_required': 0.0,
+				'relative_mm_required': 'Go to plunger flange',
+			},
+		]
+	elif g_code == 'M400':
+		return [{ 'verb': 'Barrier' }]
+	elif g_code == 'G1':
+		line = ' '.join([g_code] + params).encode()
+		for batch in parse_g_code_lines(
+			[line],
+			[g_code],
+			get_relative_modal_state(),
+			read_kinematic_limits(),
+		):
+			return build_commands_for_parsed_line(batch, 0)
+		return []
+	else:
+		raise Exception(f'Unknown G-code {g_code} in bioprintly/g_code.py')
+
+def build_commands_for_parsed_line(
+	batch: ParsedBatch,
+	index: int,
+) -> List[CommandSpecifics]:
+	'''Moves use the batch's segment math rather than their raw params'''
+	g_code = batch['g_codes'][index]
+	if g_code != 'G1':
+		return build_commands_for_g_code(g_code, batch['params'][index])
+
+	relative_mm_required = batch['extrusions_mm'][index]
+	if relative_mm_required == 0.0 or batch['feedrates_mm_per_min'][index] == 0.0:
+		return []
+	return [{
+		'verb': 'Actuate',
+		'relative_mm_required': relative_mm_required,
+		'duration_ms_required': batch['durations_ms'][index],
+	}]
@@ -0,0 +1,153 @@
+'''
+Compiles a whole G-code file into a Bioprintly program ahead of time, so that
+at print time Klipper only has to say which sync marker it has reached. Usage:
+`python3 g_code_compiler.py path/to/file.gcode`, then print the
+`file.bioprintly.gcode` it writes alongside.
+'''
+from commands import CommandSpecifics
+from g_code import build_commands_for_parsed_line
+from g_code_parsing import stream_g_code_file
+from kinematics import KinematicLimits, read_kinematic_limits
+from hashlib import sha256
+import json
+import os
+from request_protocol import establish_savefolder_path, write_file_atomically
+import sys
+from time import perf_counter
+from typing import List, TypedDict
+
+FORWARDED_G_CODES = ['M140', 'T0', 'T1', 'T2', 'T3', 'M83', 'M400', 'G1']
+'''G-codes that config/macros.cfg forwards to Bioprintly'''
+RENAMED_G_CODES = { 'M140': 'M140.1', 'M83': 'M83.1', 'M400': 'M400.1', 'G1': 'G1.1' }
+'''Klipper's own implementations, as renamed by config/macros.cfg'''
+
+COMPILER_VERSION = 4
+'''Bumped whenever compiling the same G-code would produce a different program'''
+
+class SyncMarker(TypedDict):
+	line_number: int
+	g_code: str
+	command_count: int
+	'''Program commands that are due once Klipper reaches this line'''
+class CompiledProgram(TypedDict):
+	source_sha256: str
+	kinematic_limits: KinematicLimits | None
+	'''From config/printer.cfg; changing them invalidates the program'''
+	commands: List[CommandSpecifics]
+	sync_markers: List[SyncMarker]
+	'''One per forwarded G-code line, in file order'''
+
+def get_compiled_program_path(savefolder_path: str, source_sha256: str) -> str:
+	return f'{savefolder_path}/compiled_programs/v{COMPILER_VERSION}/{source_sha256}.json'
+
+def compile_g_code_file(savefolder_path: str, path: str) -> CompiledProgram:
+	'''Cached by content hash, so recompiling an unchanged file is instant'''
+	source_sha256 = hash_file(path)
+	kinematic_limits = read_kinematic_limits()
+	program = load_compiled_program(savefolder_path, source_sha256)
+	if program != None and program['kinematic_limits'] == kinematic_limits:
+		return program
+
+	program = {
+		'source_sha256': source_sha256,
+		'kinematic_limits': kinematic_limits,
+		'commands': [],
+		'sync_markers': [],
+	}
+	for batch in stream_g_code_file(path, FORWARDED_G_CODES, kinematic_limits):
+		for index, line_number in enumerate(batch['line_numbers']):
+			program['commands'] += build_commands_for_parsed_line(batch, index)
+			program['sync_markers'].append({
+				'line_number': line_number,
+				'g_code': batch['g_codes'][index],
+				'command_count': len(program['commands']),
+			})
+
+	compiled_program_path = get_compiled_program_path(
+		savefolder_path,
+		source_sha256,
+	)
+	os.makedirs(os.path.dirname(compiled_program_path), exist_ok = True)
+	write_file_atomically(
+		compiled_program_path,
+		json.dumps(program, separators = (',', ':')),
+	)
+	return program
+
+def hash_file(path: str) -> str:
+	file_hash = sha256()
+	with open(path, 'rb') as file:
+		for chunk in iter(lambda: file.read(1 << 20), b''):
+			file_hash.update(chunk)
+	return file_hash.hexdigest()
+
+def write_advancing_g_code(
+	source_path: str,
+	advancing_path: str,
+	program: CompiledProgram,
+):
+	'''
+	Rewrites each forwarded line to advance the program to its sync marker,
+	then run Klipper's own implementation of the G-code (if any). Streams line
+	by line, like the parser, so large files aren't held in memory.
+	'''
+	sync_markers = program['sync_markers']
+	marker_index = 0
+	previous_command_count = 0
+	directory, filename = os.path.split(os.path.abspath(advancing_path))
+	temporary_path = f'{directory}/.{filename}.tmp'
+	with open(source_path, 'r') as source, open(temporary_path, 'w') as advancing:
+		for line_index, line in enumerate(source):
+			if (
+				marker_index == len(sync_markers)
+				or sync_markers[marker_index]['line_number'] != line_index + 1
+			):
+				advancing.write(line)
+				continue
+			sync_marker = sync_markers[marker_index]
+			words = line.split(';')[0].split()
+			# Markers without commands to enqueue skip the round trip
+			if sync_marker['command_count'] > previous_command_count:
+				advancing.write(' '.join([
+					'BIOPRINTLY_ADVANCE',
+					f"PROGRAM={program['source_sha256']}",
+					f'MARKER={marker_index}',
+					# Klipper doesn't wait on G1 when it isn't compiled either
+					f"AWAIT={0 if sync_marker['g_code'] == 'G1' else 1}",
+				]) + '\n')
+			if sync_marker['g_code'] in RENAMED_G_CODES:
+				advancing.write(' '.join(
+					[RENAMED_G_CODES[sync_marker['g_code']]] + words[1:]
+				) + '\n')
+			previous_command_count = sync_marker['command_count']
+			marker_index += 1
+	os.replace(temporary_path, advancing_path)
+
+def load_compiled_program(
+	savefolder_path: str,
+	source_sha256: str,
+) -> CompiledProgram | None:
+	try:
+		return json.load(open(
+			get_compiled_program_path(savefolder_path, source_sha256),
+			'r',
+		))
+	except (OSError, json.JSONDecodeError):
+		return None
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print('Usage: python3 g_code_compiler.py path/to/file.gcode')
+		exit(1)
+	source_path = sys.argv[1]
+	compile_start = perf_counter()
+	program = compile_g_code_file(establish_savefolder_path(), source_path)
+	compile_duration_ms = (perf_counter() - compile_start) * 1e3
+
+	advancing_path = f'{os.path.splitext(source_path)[0]}.bioprintly.gcode'
+	write_advancing_g_code(source_path, advancing_path, program)
+	print(f"""Compiled {source_path} in {compile_duration_ms:.1f} ms
+Program: {program['source_sha256']}
+Commands: {len(program['commands'])}
+Sync markers: {len(program['sync_markers'])}
+Print {advancing_path} to have Klipper advance through the program""")
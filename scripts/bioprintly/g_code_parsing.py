@@ -0,0 +1,292 @@
+'''
+Streams G-code through a modal-aware parser: G90/G91 and M82/M83 positioning
+modes, G92 and G28 position resets, and sticky feedrates are tracked across
+lines the way Klipper tracks them. Files are memory-mapped and parsed in
+batches, so memory stays constant however large the slicer output is, and
+segment math runs on whole batches at once (in NumPy when it's installed).
+'''
+from kinematics import KinematicLimits, plan_move_durations_ms
+import mmap
+import os
+from typing import Any, Iterable, Iterator, List, Set, TypedDict
+
+class ModalState(TypedDict):
+	relative_positioning: bool
+	'''G91'''
+	relative_extrusion: bool
+	'''M83'''
+	position_mm: List[float]
+	'''X, Y, Z'''
+	extruder_position_mm: float
+	feedrate_mm_per_min: float
+	'''Sticky: carries over to later moves that don't set F'''
+class ParsedBatch(TypedDict):
+	'''Reported lines only, as parallel lists'''
+	line_numbers: List[int]
+	g_codes: List[str]
+	params: List[List[str]]
+	'''Empty for moves, whose params are already digested into the lists below'''
+	extrusions_mm: List[float]
+	'''Relative E of each move, whatever the extrusion mode'''
+	x_deltas_mm: List[float]
+	y_deltas_mm: List[float]
+	z_deltas_mm: List[float]
+	feedrates_mm_per_min: List[float]
+	follows_previous_move: List[bool]
+	'''Whether Klipper can carry speed into this move from the previous one'''
+	durations_ms: List[float]
+	'''0 for lines that aren't moves, or moves without a feedrate yet'''
+
+LOWERCASE_BIT = 0x20
+LETTER_X, LETTER_Y, LETTER_Z, LETTER_E, LETTER_F = b'xyzef'
+MOVE_G_CODES = { b'G0', b'G1', b'G2', b'G3' }
+NUMPY_BATCH_THRESHOLD = 256
+'''Below this, converting to and from arrays costs more than it saves'''
+numpy: Any = None
+numpy_probed = False
+
+def get_numpy() -> Any:
+	'''
+	Lazily imported, since it's optional and importing it would dominate
+	request.py's startup. Returns None when it isn't available.
+	'''
+	global numpy, numpy_probed
+	if numpy_probed == False:
+		numpy_probed = True
+		try:
+			numpy = __import__('numpy')
+		except ImportError:
+			numpy = None
+	return numpy
+
+def get_initial_modal_state() -> ModalState:
+	'''Klipper's defaults after startup'''
+	return {
+		'relative_positioning': False,
+		'relative_extrusion': False,
+		'position_mm': [0.0, 0.0, 0.0],
+		'extruder_position_mm': 0.0,
+		'feedrate_mm_per_min': 0.0,
+	}
+
+def get_relative_modal_state() -> ModalState:
+	'''For lines seen in isolation, as config/macros.cfg forwards them'''
+	return {
+		**get_initial_modal_state(),
+		'relative_positioning': True,
+		'relative_extrusion': True,
+	}
+
+def compute_move_durations_ms(
+	batch: ParsedBatch,
+	kinematic_limits: KinematicLimits | None,
+) -> List[float]:
+	'''
+	Accelerating and decelerating as Klipper would, given its limits, or else
+	straight-line travel at the feedrate
+	'''
+	x_deltas_mm = batch['x_deltas_mm']
+	y_deltas_mm = batch['y_deltas_mm']
+	z_deltas_mm = batch['z_deltas_mm']
+	feedrates_mm_per_min = batch['feedrates_mm_per_min']
+	numpy = (
+		get_numpy() if len(feedrates_mm_per_min) >= NUMPY_BATCH_THRESHOLD
+		else None
+	)
+	if kinematic_limits != None:
+		return plan_move_durations_ms(
+			x_deltas_mm,
+			y_deltas_mm,
+			z_deltas_mm,
+			feedrates_mm_per_min,
+			batch['follows_previous_move'],
+			kinematic_limits,
+			numpy,
+		)
+	if numpy != None:
+		feedrates = numpy.array(feedrates_mm_per_min)
+		travels_mm = numpy.sqrt(
+			numpy.square(x_deltas_mm)
+			+ numpy.square(y_deltas_mm)
+			+ numpy.square(z_deltas_mm)
+		)
+		return numpy.divide(
+			travels_mm * 60000.0,
+			feedrates,
+			out = numpy.zeros_like(travels_mm),
+			where = feedrates != 0.0,
+		).tolist()
+
+	return [
+		0.0 if feedrate == 0.0 else (x * x + y * y + z * z) ** 0.5 * 60000.0 / feedrate
+		for x, y, z, feedrate in zip(
+			x_deltas_mm,
+			y_deltas_mm,
+			z_deltas_mm,
+			feedrates_mm_per_min,
+		)
+	]
+
+def stream_g_code_file(
+	path: str,
+	reported_g_codes: Iterable[str],
+	kinematic_limits: KinematicLimits | None = None,
+	batch_line_count = 65536,
+) -> Iterator[ParsedBatch]:
+	with open(path, 'rb') as file:
+		if os.fstat(file.fileno()).st_size == 0:
+			return
+		with mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+			yield from parse_g_code_lines(
+				iterate_mapped_lines(mapped),
+				reported_g_codes,
+				get_initial_modal_state(),
+				kinematic_limits,
+				batch_line_count,
+			)
+
+def iterate_mapped_lines(mapped: mmap.mmap, chunk_bytes = 1 << 22) -> Iterator[bytes]:
+	'''Splits whole chunks at once, which beats a readline call per line'''
+	chunk_start = 0
+	while chunk_start < len(mapped):
+		chunk_end = mapped.find(b'\n', chunk_start + chunk_bytes) + 1
+		if chunk_end == 0:
+			chunk_end = len(mapped)
+		yield from mapped[chunk_start:chunk_end].splitlines()
+		chunk_start = chunk_end
+
+def parse_g_code_lines(
+	lines: Iterable[bytes],
+	reported_g_codes: Iterable[str],
+	modal_state: ModalState,
+	kinematic_limits: KinematicLimits | None = None,
+	batch_line_count = 65536,
+) -> Iterator[ParsedBatch]:
+	'''
+	Yields a batch each time `batch_line_count` reported lines accumulate, and
+	once more at the end. Every line updates `modal_state`, reported or not.
+	Arcs (G2/G3) only move the position to their endpoint; their length isn't
+	computed since config/macros.cfg doesn't forward them. Speed is carried
+	between reported moves on consecutive lines; anything in between, like a
+	dwell, an unreported move or a forwarded G-code that Klipper waits on, is
+	taken as a stop. Each batch is taken to end at rest too.
+
+	This loop is the hot path for large files, so modal state lives in locals
+	while it runs, and param letters are compared as lowercased byte values.
+	'''
+	reported: Set[bytes] = set(g_code.encode() for g_code in reported_g_codes)
+	relative_positioning = modal_state['relative_positioning']
+	relative_extrusion = modal_state['relative_extrusion']
+	x_mm, y_mm, z_mm = modal_state['position_mm']
+	extruder_position_mm = modal_state['extruder_position_mm']
+	feedrate_mm_per_min = modal_state['feedrate_mm_per_min']
+
+	batch = get_empty_batch()
+	previous_line_was_reported_move = False
+
+	for line_index, line in enumerate(lines):
+		words = line.partition(b';')[0].split()
+		if len(words) == 0:
+			continue
+		g_code = words[0].upper()
+
+		x_delta_mm = y_delta_mm = z_delta_mm = extrusion_mm = 0.0
+		if g_code in MOVE_G_CODES:
+			for word in words[1:]:
+				letter = word[0] | LOWERCASE_BIT
+				if letter == LETTER_X:
+					value = float(word[1:])
+					x_delta_mm = value if relative_positioning else value - x_mm
+					x_mm += x_delta_mm
+				elif letter == LETTER_Y:
+					value = float(word[1:])
+					y_delta_mm = value if relative_positioning else value - y_mm
+					y_mm += y_delta_mm
+				elif letter == LETTER_Z:
+					value = float(word[1:])
+					z_delta_mm = value if relative_positioning else value - z_mm
+					z_mm += z_delta_mm
+				elif letter == LETTER_E:
+					value = float(word[1:])
+					# Like Klipper, G91 makes extrusion relative too
+					extrusion_mm = (
+						value if relative_positioning or relative_extrusion
+						else value - extruder_position_mm
+					)
+					extruder_position_mm += extrusion_mm
+				elif letter == LETTER_F:
+					feedrate_mm_per_min = float(word[1:])
+		elif g_code == b'G90':
+			relative_positioning = False
+		elif g_code == b'G91':
+			relative_positioning = True
+		elif g_code == b'M82':
+			relative_extrusion = False
+		elif g_code == b'M83':
+			relative_extrusion = True
+		elif g_code == b'G92' or g_code == b'G28':
+			# Bare G28 homes every axis
+			homes_every_axis = g_code == b'G28' and not any(
+				word[0] | LOWERCASE_BIT in (LETTER_X, LETTER_Y, LETTER_Z)
+				for word in words[1:]
+			)
+			if homes_every_axis:
+				x_mm = y_mm = z_mm = 0.0
+			for word in words[1:]:
+				letter = word[0] | LOWERCASE_BIT
+				value = 0.0 if g_code == b'G28' or len(word) == 1 else float(word[1:])
+				if letter == LETTER_X:
+					x_mm = value
+				elif letter == LETTER_Y:
+					y_mm = value
+				elif letter == LETTER_Z:
+					z_mm = value
+				elif letter == LETTER_E:
+					extruder_position_mm = value
+
+		if g_code not in reported:
+			previous_line_was_reported_move = False
+			continue
+		batch['line_numbers'].append(line_index + 1)
+		batch['g_codes'].append(g_code.decode())
+		batch['params'].append(
+			[] if g_code in MOVE_G_CODES
+			else [word.decode() for word in words[1:]]
+		)
+		batch['extrusions_mm'].append(extrusion_mm)
+		batch['x_deltas_mm'].append(x_delta_mm)
+		batch['y_deltas_mm'].append(y_delta_mm)
+		batch['z_deltas_mm'].append(z_delta_mm)
+		batch['feedrates_mm_per_min'].append(feedrate_mm_per_min)
+		batch['follows_previous_move'].append(previous_line_was_reported_move)
+		previous_line_was_reported_move = g_code in MOVE_G_CODES
+
+		if len(batch['line_numbers']) >= batch_line_count:
+			batch['durations_ms'] = compute_move_durations_ms(batch, kinematic_limits)
+			yield batch
+			batch = get_empty_batch()
+			previous_line_was_reported_move = False
+
+	modal_state['relative_positioning'] = relative_positioning
+	modal_state['relative_extrusion'] = relative_extrusion
+	modal_state['position_mm'] = [x_mm, y_mm, z_mm]
+	modal_state['extruder_position_mm'] = extruder_position_mm
+	modal_state['feedrate_mm_per_min'] = feedrate_mm_per_min
+
+	if len(batch['line_numbers']) > 0:
+		batch['durations_ms'] = compute_move_durations_ms(batch, kinematic_limits)
+		yield batch
+
+def get_empty_batch() -> ParsedBatch:
+	return {
+		'line_numbers': [],
+		'g_codes': [],
+		'params': [],
+		'extrusions_mm': [],
+		'x_deltas_mm': [],
+		'y_deltas_mm': [],
+		'z_deltas_mm': [],
+		'feedrates_mm_per_min': [],
+		'follows_previous_move': [],
+		'durations_ms': [],
+	}
@@ -1,11 +1,53 @@
-from copy import deepcopy
 from math import floor
-from threading import Timer
+from notifications import Notification
+from operator_actions import submit_operator_action
+from queue import Empty
+import signal
+from threading import Timer, current_thread, main_thread
 from tkinter.font import nametofont
 from gui_layout import build_gui_layout
-from state import GlobalState, save_state_to_disk
-from tkinter import Tk, ttk, messagebox
-from util import deep_equals, unix_time_ms, maximize_tk_window
+from state import GlobalState, build_default_global_state
+from state_snapshot import open_state_snapshot, refresh_state_replica
+from tkinter import Tk, Toplevel, ttk, messagebox
+from util import set_value, unix_time_ms
+
+def run_gui_until_closed(state: GlobalState):
+	'''Reopens the GUI whenever it asks to be, e.g. to apply a new UI scale'''
+	while True:
+		run_gui(state)
+		if state['nonpersistent']['reopening_gui'] == True:
+			state['nonpersistent']['reopening_gui'] = False
+			continue
+		break
+
+def run_attached_gui():
+	'''
+	Entry point of a GUI process (--attach-gui). Shows the state the service
+	process publishes, and sends operator actions back to it; see
+	state_snapshot.py and operator_actions.py.
+	'''
+	state = build_default_global_state()
+	nonpersistent = state['nonpersistent']
+	nonpersistent['attached_to_service'] = True
+	# The service process logs them already
+	nonpersistent['notification_sinks'] = [show_notification_in_gui]
+	nonpersistent['state_snapshot'] = open_state_snapshot(
+		nonpersistent['savefolder_path'],
+		False,
+	)
+	refresh_state_replica(state)
+	
+	signal.signal(signal.SIGINT, lambda a, b: (
+		set_value(nonpersistent, 'shutting_down', True),
+		(
+			nonpersistent['gui_root'].quit()
+			if nonpersistent['gui_root'] != None
+			else None,
+		)
+	))
+	
+	if nonpersistent['shutting_down'] == False:
+		run_gui_until_closed(state)
 
 def run_gui(state: GlobalState):
 	gui_root = state['nonpersistent']['gui_root'] = Tk()
@@ -32,6 +74,15 @@ def update_gui_repeatedly(state: GlobalState):
 	if gui_root == None:
 		raise Exception(f'update_gui_repeatedly: gui_root == None')
 	
+	if state['nonpersistent']['attached_to_service'] == True:
+		refresh_state_replica(state)
+		if state['nonpersistent']['shutting_down'] == True:
+			# The service shut down, or died
+			gui_root.destroy()
+			return
+	
+	show_queued_notifications(state)
+	
 	gui_redrawables = state['nonpersistent']['gui_redrawables']
 	gui_dependency_cache = state['nonpersistent']['gui_dependency_cache']
 	modal_redrawables = state['nonpersistent']['modal_redrawables']
@@ -48,13 +99,13 @@ def update_gui_repeatedly(state: GlobalState):
 				
 				if cache_key in dependency_cache:
 					prev_value = dependency_cache[cache_key]
-					if not deep_equals(cur_value, prev_value):
+					if cur_value != prev_value:
 						redrawable['redraw']()
-						dependency_cache[cache_key] = deepcopy(cur_value)
+						dependency_cache[cache_key] = cur_value
 						break
 				else:
 					redrawable['redraw']()
-					dependency_cache[cache_key] = deepcopy(cur_value)
+					dependency_cache[cache_key] = cur_value
 					break
 	
 	if state['nonpersistent']['reopening_gui'] == True:
@@ -71,6 +122,38 @@ def update_gui_repeatedly(state: GlobalState):
 			state,
 		)
 
+def show_notification_in_gui(state: GlobalState, notification: Notification):
+	'''
+	Notification sink. Tk may only be used from the main thread, so this only
+	queues the notification for update_gui_repeatedly once the GUI is up.
+	Before then (e.g. while loading state), it's shown right away.
+	'''
+	if (
+		state['nonpersistent']['gui_root'] == None
+		and current_thread() is main_thread()
+	):
+		show_notification(notification)
+	else:
+		state['nonpersistent']['gui_notifications'].put(notification)
+
+def show_queued_notifications(state: GlobalState):
+	gui_notifications = state['nonpersistent']['gui_notifications']
+	while True:
+		try:
+			show_notification(gui_notifications.get_nowait())
+		except Empty:
+			break
+
+def show_notification(notification: Notification):
+	(
+		messagebox.showerror
+		if notification['severity'] == 'Error'
+		else messagebox.showwarning
+	)(
+		message = notification['message'],
+		detail = notification['detail'],
+	)
+
 def confirm_close_gui(state: GlobalState):
 	if (state['nonpersistent']['gui_root'] == None):
 		raise Exception('confirm_close_gui: gui_root == None')
@@ -80,7 +163,7 @@ def confirm_close_gui(state: GlobalState):
 			message = 'Are you sure you want to close? This will stop command processing.',
 		)
 	):
-		state['nonpersistent']['shutting_down'] = True
+		submit_operator_action(state, { 'verb': 'Shut down' })
 		state['nonpersistent']['gui_root'].destroy()
 
 TK_STANDARD_FONT_NAMES = [
@@ -110,3 +193,12 @@ def scale_fonts_by_ui_scale(state: GlobalState):
 		if font_name == 'TkFixedFont':
 			default_size *= 1.12
 		font.configure(size = round(default_size * state['ui_scale']))
+
+def maximize_tk_window(root: Tk | Toplevel):
+	try:
+		root.state('zoomed')
+		# Workaround for zoom not working after re-opening the root window
+		if root.state() != 'zoomed':
+			Timer(0, lambda: root.state('zoomed')).start()
+	except:
+		pass
@@ -1,8 +1,7 @@
-from threading import Timer
-from time import sleep
-from typing import Dict, List, TypedDict, cast, get_args
-from pins import write_pin, zero_out_pins
-from util import set_value, signum, stringify_primitive, this_action_would_put_it_further_away_from_target_than_it_is_now, unix_time_ms
+from typing import Dict, List, TypedDict, get_args
+from journal import get_state_version
+from operator_actions import submit_operator_action
+from util import stringify_primitive, unix_time_ms
 from state import GlobalState, Redrawable, SyringeNumber, calibration_is_complete
 from tkinter import Toplevel, messagebox, ttk
 
@@ -126,7 +125,9 @@ def build_actuator_status_row(
 			/ nonpersistent['actuator_travel_mm_per_ms']
 			/ 1000
 		)} seconds)""",
-		command = lambda: Timer(0, home_the_actuator, [state]).start(),
+		command = lambda: submit_operator_action(state, {
+			'verb': 'Home the actuator',
+		}),
 	)
 	actuator_home_button.grid(
 		row = starting_row,
@@ -167,7 +168,10 @@ def build_handcrank_rows(
 			state = 'disabled',
 			text = f'Retract actuator {distance} mm',
 			command = lambda distance=distance: (
-				Timer(0, handcrank_the_actuator, [state, -distance]).start(),
+				submit_operator_action(state, {
+					'verb': 'Handcrank the actuator',
+					'relative_mm_required': -distance,
+				}),
 			)
 		)
 		retract_button.grid(
@@ -182,7 +186,10 @@ def build_handcrank_rows(
 			state = 'disabled',
 			text = f'Extend actuator {distance} mm',
 			command = lambda distance=distance: (
-				Timer(0, handcrank_the_actuator, [state, distance]).start(),
+				submit_operator_action(state, {
+					'verb': 'Handcrank the actuator',
+					'relative_mm_required': distance,
+				}),
 			),
 		)
 		extend_button.grid(
@@ -263,16 +270,10 @@ def build_plunger_rows(
 			text = f'Record actuator tip as plunger {syringe_number}\'s position',
 			state = 'disabled',
 			command = lambda syringe_number=syringe_number: (
-				set_value(
-					state['plunger_positions_mm'],
-					str(syringe_number),
-					state['actuator_position_mm'],
-				),
-				set_value(
-					state,
-					'current_syringe',
-					syringe_number,
-				),
+				submit_operator_action(state, {
+					'verb': 'Record plunger position',
+					'syringe_number': syringe_number,
+				}),
 			),
 		)
 		record_button.grid(
@@ -344,11 +345,10 @@ def build_current_syringe_rows(
 			state = 'disabled',
 			text = f'Record {syringe_number} as the current syringe and close',
 			command = lambda syringe_number=syringe_number: (
-				set_value(
-					state,
-					'current_syringe',
-					syringe_number,
-				),
+				submit_operator_action(state, {
+					'verb': 'Record current syringe',
+					'syringe_number': syringe_number,
+				}),
 				close_calibration_gui(state),
 			),
 		)
@@ -362,7 +362,7 @@ def build_current_syringe_rows(
 		redrawables.append({
 			'dependencies': [
 				lambda: state['actuator_position_mm'],
-				lambda: state['plunger_positions_mm'],
+				lambda: get_state_version(state, 'plunger_positions_mm'),
 				lambda: nonpersistent['actuator_has_calibration_lock'],
 				# Workaround for lock change not triggering redraw
 				lambda: round(unix_time_ms() / 1e3) % 2,
@@ -406,86 +406,6 @@ def get_plunger_position_text(
 		)} mm"""
 	).rjust(len(default))
 
-def home_the_actuator(state: GlobalState):
-	'''Only for use in calibration logic; not a substitute for CommandActuate'''
-	nonpersistent = state['nonpersistent']
-	
-	if nonpersistent['actuator_has_calibration_lock'] == True:
-		return
-	nonpersistent['actuator_has_calibration_lock'] = True
-	state['actuator_position_mm'] = None
-	write_pin(state, 'actuator_retract', 1)
-	sleep(
-		nonpersistent['actuator_max_possible_extension_mm']
-		/ nonpersistent['actuator_travel_mm_per_ms']
-		/ 1000
-		* (1 + nonpersistent['safety_margin'])
-	)
-	write_pin(state, 'actuator_retract', 0)
-	state['actuator_position_mm'] = 0
-	nonpersistent['actuator_has_calibration_lock'] = False
-
-def handcrank_the_actuator(state: GlobalState, relative_mm_required: float):
-	'''Only for use in calibration logic; not a substitute for CommandActuate'''
-	nonpersistent = state['nonpersistent']
-	
-	if nonpersistent['actuator_has_calibration_lock'] == True:
-		return
-	nonpersistent['actuator_has_calibration_lock'] = True
-	
-	handcrank_loop_interval_ms = 8
-	handcrank_loop_last_start = unix_time_ms()
-	relative_mm_traveled = 0
-	while True:
-		handcrank_loop_measured_delta = (
-			unix_time_ms() - handcrank_loop_last_start
-		)
-		handcrank_loop_last_start = unix_time_ms()
-		expected_travel_mm = (
-			signum(relative_mm_required)
-			* nonpersistent['actuator_travel_mm_per_ms']
-			* handcrank_loop_measured_delta
-		)
-		
-		if cast(float, state['actuator_position_mm']) < 0:
-			state['actuator_position_mm'] = 0
-		
-		if this_action_would_put_it_further_away_from_target_than_it_is_now(
-			relative_mm_traveled,
-			expected_travel_mm,
-			relative_mm_required,
-		):
-			break
-		
-		if (
-			cast(float, state['actuator_position_mm'])
-			+ expected_travel_mm
-		) > (
-			nonpersistent['actuator_max_possible_extension_mm']
-			* (1 - nonpersistent['safety_margin'])
-		):
-			break
-		
-		if relative_mm_required > 0:
-			write_pin(state, 'actuator_extend', 1)
-		else:
-			write_pin(state, 'actuator_retract', 1)
-		
-		relative_mm_traveled += expected_travel_mm
-		state['actuator_position_mm'] = (
-			cast(float, state['actuator_position_mm'])
-			+ expected_travel_mm
-		)
-		
-		sleep(max(0,
-			handcrank_loop_interval_ms
-			- (unix_time_ms() - handcrank_loop_last_start)
-		) / 1e3)
-	
-	write_pin(state, 'actuator_extend', 0)
-	write_pin(state, 'actuator_retract', 0)
-	nonpersistent['actuator_has_calibration_lock'] = False
-
 def close_calibration_gui(state: GlobalState):
 	modal = state['nonpersistent']['modal']
 	if modal == None:
@@ -503,8 +423,10 @@ def close_calibration_gui(state: GlobalState):
 
 def toggle_processing_with_warning(state: GlobalState):
 	if state['nonpersistent']['processing_enabled'] == True:
-		state['nonpersistent']['processing_enabled'] = False
-		zero_out_pins(state)
+		submit_operator_action(state, {
+			'verb': 'Set processing enabled',
+			'processing_enabled': False,
+		})
 	elif messagebox.askokcancel(
 		message = 'Careful!',
 		detail = f"""Are these calibration values correct? If they're wrong, the bioprint hardware will likely crash and damage itself.
@@ -518,4 +440,7 @@ Actuator tip position: {stringify_primitive(state['actuator_position_mm'])} mm e
 for i in get_args(SyringeNumber)
 ) + '(all measured from actuator tip home)'
 	):
-		state['nonpersistent']['processing_enabled'] = True
+		submit_operator_action(state, {
+			'verb': 'Set processing enabled',
+			'processing_enabled': True,
+		})
@@ -1,11 +1,14 @@
+from bisect import bisect_left
 from threading import Timer
-from pins import InputOutput, PinMappings, PinNumber, setup_pins
+from pins import InputOutput, PinMappings, PinNumber
 from gui_calibration import ACTUATOR_HANDCRANK_OPTIONS_MM, build_calibration_gui, toggle_processing_with_warning
-from state import CommandSpecifics, GlobalState, SyringeNumber, enqueue_command, processing_is_allowed_to_be_started, save_state_to_disk, Redrawable, calibration_is_complete
+from journal import get_state_version
+from operator_actions import submit_operator_action
+from state import CommandSpecifics, EnqueuedCommand, GlobalState, SyringeNumber, processing_is_allowed_to_be_started, Redrawable, calibration_is_complete
 from tkinter import StringVar, messagebox
 import tkinter
 import tkinter as ttk
-from typing import Any, Callable, List, Sequence, Tuple, TypedDict, get_args
+from typing import Any, Callable, Dict, List, Sequence, Tuple, TypedDict, cast, get_args
 from util import friendly_timestamp, hsv_to_hex, intersperse, set_value, stringify_primitive
 
 class ScaledConstants(TypedDict):
@@ -111,11 +114,10 @@ def build_ui_scale_control(
 	option_menu_variable.trace_add(
 		'write',
 		lambda a, b, c, option_menu_variable=option_menu_variable: (
-			set_value(
-				state,
-				'ui_scale',
-				float(option_menu_variable.get().split('%')[0]) / 100,
-			),
+			submit_operator_action(state, {
+				'verb': 'Set UI scale',
+				'ui_scale': float(option_menu_variable.get().split('%')[0]) / 100,
+			}),
 			set_value(
 				state['nonpersistent'],
 				'reopening_gui',
@@ -197,12 +199,14 @@ def build_rotator_controls(
 		switch_to_syringe_button = ttk.Button(
 			switch_to_syringe_row,
 			text = f'#{syringe_number}',
-			command = lambda syringe_number=syringe_number: enqueue_command(
+			command = lambda syringe_number=syringe_number: submit_operator_action(
 				state,
-				'Operator',
 				{
-					'verb': 'Rotate',
-					'target_syringe': syringe_number,
+					'verb': 'Enqueue',
+					'specifics': {
+						'verb': 'Rotate',
+						'target_syringe': syringe_number,
+					},
 				},
 			),
 		)
@@ -276,13 +280,15 @@ def build_actuator_controls(
 		retract_button = ttk.Button(
 			row,
 			text = f'Retract actuator {distance} mm',
-			command = lambda distance=distance: enqueue_command(
+			command = lambda distance=distance: submit_operator_action(
 				state,
-				'Operator',
 				{
-					'verb': 'Actuate',
-					'duration_ms_required': 0.0,
-					'relative_mm_required': -distance,
+					'verb': 'Enqueue',
+					'specifics': {
+						'verb': 'Actuate',
+						'duration_ms_required': 0.0,
+						'relative_mm_required': -distance,
+					},
 				},
 			),
 		)
@@ -303,13 +309,15 @@ def build_actuator_controls(
 		extend_button = ttk.Button(
 			row,
 			text = f'Extend actuator {distance} mm',
-			command = lambda distance=distance: enqueue_command(
+			command = lambda distance=distance: submit_operator_action(
 				state,
-				'Operator',
 				{
-					'verb': 'Actuate',
-					'duration_ms_required': 0.0,
-					'relative_mm_required': distance,
+					'verb': 'Enqueue',
+					'specifics': {
+						'verb': 'Actuate',
+						'duration_ms_required': 0.0,
+						'relative_mm_required': distance,
+					},
 				},
 			),
 		)
@@ -369,12 +377,11 @@ def build_pin_io_controls(
 		pin_number_variable.trace_add(
 			'write',
 			lambda a, b, c, name=name, pin_number_variable=pin_number_variable: (
-				set_value(
-					state['pins'][name],
-					'number',
-					int(pin_number_variable.get()),
-				),
-				setup_pins(state),
+				submit_operator_action(state, {
+					'verb': 'Set pin',
+					'pin_name': name,
+					'number': cast(PinNumber, int(pin_number_variable.get())),
+				}),
 			),
 		)
 		pin_number_dropdown = ttk.OptionMenu(
@@ -390,13 +397,12 @@ def build_pin_io_controls(
 			io_type_variable.set(io_type_initial)
 		io_type_variable.trace_add(
 			'write',
-			lambda a, b, c, io_type_variable=io_type_variable: (
-				set_value(
-					state['pins'][name],
-					'io_type',
-					io_type_variable.get(),
-				),
-				setup_pins(state),
+			lambda a, b, c, name=name, io_type_variable=io_type_variable: (
+				submit_operator_action(state, {
+					'verb': 'Set pin',
+					'pin_name': name,
+					'io_type': cast(InputOutput, io_type_variable.get()),
+				}),
 			),
 		)
 		io_type_dropdown = ttk.OptionMenu(
@@ -507,6 +513,18 @@ def build_processing_controls(
 	).grid(row = 1, column = 0, sticky = 'e')
 	measured_delta = ttk.Label(stats_table, font = 'TkFixedFont')
 	measured_delta.grid(row = 1, column = 1, sticky = 'e')
+	ttk.Label(
+		stats_table,
+		text = 'State write latency (last/max):',
+	).grid(row = 2, column = 0, sticky = 'e')
+	state_write_latency = ttk.Label(stats_table, font = 'TkFixedFont')
+	state_write_latency.grid(row = 2, column = 1, sticky = 'e')
+	ttk.Label(
+		stats_table,
+		text = 'Spooled requests (received/dropped/duplicate):',
+	).grid(row = 3, column = 0, sticky = 'e')
+	request_spool_counts = ttk.Label(stats_table, font = 'TkFixedFont')
+	request_spool_counts.grid(row = 3, column = 1, sticky = 'e')
 	
 	return [
 		{
@@ -577,24 +595,78 @@ def build_processing_controls(
 			],
 			'redraw': lambda: (
 				measured_delta.config(text = f'''{
-					str(
-						state['nonpersistent']['processing_loop_measured_delta']
-					).rjust(8)
+					f"{state['nonpersistent']['processing_loop_measured_delta']:.2f}".rjust(8)
 					if state['nonpersistent']['processing_enabled']
 					else '(Paused)'
 				} ms''')
 			)
 		},
+		{
+			'dependencies': [
+				lambda: state['nonpersistent']['state_write_latency_ms'],
+				lambda: state['nonpersistent']['state_write_max_latency_ms'],
+			],
+			'redraw': lambda: (
+				state_write_latency.config(text = f'''{
+					stringify_primitive(
+						state['nonpersistent']['state_write_latency_ms']
+					)
+				}/{
+					stringify_primitive(
+						state['nonpersistent']['state_write_max_latency_ms']
+					)
+				} ms''')
+			)
+		},
+		{
+			'dependencies': [
+				lambda: state['nonpersistent']['request_spool_received'],
+				lambda: state['nonpersistent']['request_spool_dropped'],
+				lambda: state['nonpersistent']['request_spool_duplicates'],
+			],
+			'redraw': lambda: (
+				request_spool_counts.config(text = '/'.join(map(str, [
+					state['nonpersistent']['request_spool_received'],
+					state['nonpersistent']['request_spool_dropped'],
+					state['nonpersistent']['request_spool_duplicates'],
+				])))
+			)
+		},
 	]
 
+class TextBlock(TypedDict):
+	key: int
+	'''Identifies the block from one redraw to the next, e.g. an ordinal'''
+	revision: Any
+	'''The block is only rendered again once this changes'''
+	render: Callable[[], str]
+	color_tag: str
+
 def build_scrollable_text(
 	parent: tkinter.Widget | ttk.Widget,
-	get_text_content: Callable[[], Sequence[
-		# (text_segment, color_tag_name)
-		Tuple[str, str]
-	]],
+	get_text_blocks: Callable[[], Sequence[TextBlock]],
+	get_text_version: Callable[[], Any],
 	empty_text: str,
 ) -> List[Redrawable]:
+	text, scrollbar = build_scrollable_text_widget(parent)
+	rendered_revisions: Dict[int, Any] = {}
+	
+	return [
+		{
+			'dependencies': [get_text_version],
+			'redraw': lambda: redraw_text_blocks(
+				text,
+				rendered_revisions,
+				get_text_blocks(),
+				empty_text,
+				True,
+			),
+		}
+	]
+
+def build_scrollable_text_widget(
+	parent: tkinter.Widget | ttk.Widget,
+) -> Tuple[tkinter.Text, ttk.Scrollbar]:
 	frame = ttk.Frame(parent)
 	frame.pack(fill = 'both', expand = True)
 	frame.pack_propagate(False)
@@ -631,46 +703,311 @@ def build_scrollable_text(
 	scrollbar.pack(side = tkinter.RIGHT, fill = 'y')
 	text.configure(yscrollcommand = scrollbar.set)
 	
-	return [
-		{
-			'dependencies': [get_text_content],
-			'redraw': lambda: (
-				text_height_before := text.count('1.0', 'end', 'ypixels')[0],
-				scroll_fraction_start := text.yview()[0],
-				text.configure(state = 'normal'),
-				text.delete('1.0', 'end'),
-				text_content := get_text_content(),
-				[
-					[
-						text.insert(
-							'end',
-							text_segment,
-							color_tag,
-						) for (text_segment, color_tag) in text_content
-					] if len(text_content) > 0
-					else text.insert('end', empty_text)
-				],
-				text.configure(state = 'disabled'),
-				text_height_after := text.count('1.0', 'end', 'ypixels')[0],
-				text.yview('moveto', (
-					scroll_fraction_start * text_height_before
-					+ (text_height_after - text_height_before)
-				) / text_height_after if scroll_fraction_start != 0 else 0),
-			),
-		}
-	]
+	return text, scrollbar
+
+def redraw_text_blocks(
+	text: tkinter.Text,
+	rendered_revisions: Dict[int, Any],
+	text_blocks: Sequence[TextBlock],
+	empty_text: str,
+	follow_top: bool,
+):
+	'''
+	Only inserts, deletes, or re-renders the blocks that changed, each spanning
+	a tag of its own. Blocks that stay keep their order relative to each other,
+	so new ones go in right before whichever stays next.
+	'''
+	# Keeps the top visible line in place as blocks come and go around it, but
+	# if following the top, lets new blocks show up when scrolled all the way up
+	text.mark_set('scroll_anchor', '@0,0')
+	text.mark_gravity(
+		'scroll_anchor',
+		'left' if follow_top and text.yview()[0] == 0 else 'right',
+	)
+	text.configure(state = 'normal')
+	
+	block_keys = set(map(lambda block: block['key'], text_blocks))
+	for key in list(rendered_revisions.keys()):
+		if not key in block_keys:
+			delete_text_block(text, key)
+			del rendered_revisions[key]
+	if len(text.tag_ranges('empty')) > 0:
+		text.delete('empty.first', 'empty.last')
+	
+	next_block_index = 'end'
+	for block in reversed(text_blocks):
+		block_tag = f'block-{block["key"]}'
+		if block['key'] in rendered_revisions:
+			if rendered_revisions[block['key']] == block['revision']:
+				next_block_index = text.index(f'{block_tag}.first')
+				continue
+			delete_text_block(text, block['key'])
+		text.insert(
+			next_block_index,
+			block['render'](),
+			(block_tag, block['color_tag']),
+		)
+		rendered_revisions[block['key']] = block['revision']
+		next_block_index = text.index(f'{block_tag}.first')
+	if len(text_blocks) == 0:
+		text.insert('end', empty_text, 'empty')
+	
+	text.configure(state = 'disabled')
+	text.yview('scroll_anchor')
+
+def delete_text_block(text: tkinter.Text, key: int):
+	block_tag = f'block-{key}'
+	text.delete(f'{block_tag}.first', f'{block_tag}.last')
+	text.tag_delete(block_tag)
+
+QUEUE_VIEW_WINDOW_LENGTH = 40
+'''How many queued commands the queue pane formats and renders at once'''
+
+class QueueViewport(TypedDict):
+	start_ordinal: int | None
+	'''Where the rendered window of the queue starts; None follows its head'''
+	scroll_to_ordinal: int | None
+	'''Command to scroll to the top of the view once it's rendered'''
+	revision: int
 
 def build_command_queue(
 	state: GlobalState,
 	parent: tkinter.Widget,
 	scaled_constants: ScaledConstants,
 ) -> List[Redrawable]:
+	'''
+	Virtualized, since a whole program can be enqueued at once: only a window
+	of the queue is ever rendered. It moves along as the view reaches either
+	end of it, and the scrollbar spans the whole queue.
+	'''
 	scrollable_text_pad_left = scaled_constants['scrollable_text_pad_left']
-	return build_scrollable_text(
-		parent,
-		lambda: list(map(
-			lambda command: (f'''
-{scrollable_text_pad_left}[{command['specifics']['verb']}]
+	viewport: QueueViewport = {
+		'start_ordinal': None,
+		'scroll_to_ordinal': None,
+		'revision': 0,
+	}
+	
+	navigation_row = ttk.Frame(parent)
+	navigation_row.pack(fill = 'x')
+	ttk.Button(
+		navigation_row,
+		text = 'Jump to active',
+		command = lambda: move_queue_viewport(
+			viewport,
+			None,
+			get_active_ordinal(state['command_queue']),
+		),
+	).pack(side = 'left')
+	ordinal_variable = StringVar()
+	ordinal_entry = ttk.Entry(
+		navigation_row,
+		textvariable = ordinal_variable,
+		width = 8,
+	)
+	ordinal_entry.pack(side = 'left')
+	jump_to_ordinal = lambda *args: (
+		move_queue_viewport_to_ordinal(
+			state['command_queue'],
+			viewport,
+			int(ordinal_variable.get().strip().lstrip('#')),
+		)
+		if ordinal_variable.get().strip().lstrip('#').isdigit()
+		else messagebox.showwarning(
+			message = f'"{ordinal_variable.get()}" is not a command number',
+		)
+	)
+	ordinal_entry.bind('<Return>', jump_to_ordinal)
+	ttk.Button(
+		navigation_row,
+		text = 'Jump to #',
+		command = jump_to_ordinal,
+	).pack(side = 'left')
+	position_label = ttk.Label(navigation_row)
+	position_label.pack(side = 'right')
+	
+	text, scrollbar = build_scrollable_text_widget(parent)
+	text.configure(yscrollcommand = lambda first, last: on_queue_text_scrolled(
+		state['command_queue'],
+		viewport,
+		scrollbar,
+		float(first),
+		float(last),
+	))
+	scrollbar.configure(command = lambda *args: on_queue_scrollbar_moved(
+		state['command_queue'],
+		viewport,
+		text,
+		*args,
+	))
+	rendered_revisions: Dict[int, Any] = {}
+	
+	return [
+		{
+			'dependencies': [
+				lambda: get_state_version(state, 'command_queue'),
+				lambda: viewport['revision'],
+			],
+			'redraw': lambda: redraw_command_queue(
+				state['command_queue'],
+				viewport,
+				text,
+				rendered_revisions,
+				position_label,
+				scrollable_text_pad_left,
+			),
+		}
+	]
+
+def get_queue_window(
+	command_queue: List[EnqueuedCommand],
+	viewport: QueueViewport,
+) -> Tuple[int, List[EnqueuedCommand]]:
+	'''The index the rendered window starts at, and the commands in it'''
+	start_index = (
+		0
+		if viewport['start_ordinal'] == None
+		# The queue stays sorted by ordinal
+		else bisect_left(
+			command_queue,
+			viewport['start_ordinal'],
+			key = lambda command: command['ordinal'],
+		)
+	)
+	start_index = max(0, min(
+		start_index,
+		len(command_queue) - QUEUE_VIEW_WINDOW_LENGTH,
+	))
+	return (
+		start_index,
+		command_queue[start_index:start_index + QUEUE_VIEW_WINDOW_LENGTH],
+	)
+
+def move_queue_viewport(
+	viewport: QueueViewport,
+	start_ordinal: int | None,
+	scroll_to_ordinal: int | None = None,
+):
+	viewport['start_ordinal'] = start_ordinal
+	viewport['scroll_to_ordinal'] = scroll_to_ordinal
+	viewport['revision'] += 1
+
+def move_queue_viewport_to_index(
+	command_queue: List[EnqueuedCommand],
+	viewport: QueueViewport,
+	index: int,
+):
+	'''Leaves some commands before the one at `index` rendered, to scroll up to'''
+	if len(command_queue) == 0:
+		return
+	index = max(0, min(index, len(command_queue) - 1))
+	start_index = max(0, index - QUEUE_VIEW_WINDOW_LENGTH // 4)
+	move_queue_viewport(
+		viewport,
+		command_queue[start_index]['ordinal'] if start_index > 0 else None,
+		command_queue[index]['ordinal'],
+	)
+
+def move_queue_viewport_to_ordinal(
+	command_queue: List[EnqueuedCommand],
+	viewport: QueueViewport,
+	ordinal: int,
+):
+	'''Finished or fused away ordinals go to the next command still queued'''
+	move_queue_viewport_to_index(command_queue, viewport, bisect_left(
+		command_queue,
+		ordinal,
+		key = lambda command: command['ordinal'],
+	))
+
+def get_active_ordinal(command_queue: List[EnqueuedCommand]) -> int | None:
+	'''First started command, or else the head of the queue'''
+	for command in command_queue[:QUEUE_VIEW_WINDOW_LENGTH]:
+		if 'started_at' in command:
+			return command['ordinal']
+	return command_queue[0]['ordinal'] if len(command_queue) > 0 else None
+
+def on_queue_text_scrolled(
+	command_queue: List[EnqueuedCommand],
+	viewport: QueueViewport,
+	scrollbar: ttk.Scrollbar,
+	first: float,
+	last: float,
+):
+	'''
+	Moves the window half its length along once the view reaches either end of
+	it. Maps the view onto the whole queue for the scrollbar, taking each
+	rendered command to be about as tall as the others.
+	'''
+	start_index, window = get_queue_window(command_queue, viewport)
+	if len(window) == 0:
+		scrollbar.set(0, 1)
+		return
+	if (
+		last >= 1
+		and first > 0
+		and start_index + len(window) < len(command_queue)
+	):
+		new_start_index = start_index + QUEUE_VIEW_WINDOW_LENGTH // 2
+		move_queue_viewport(viewport, command_queue[new_start_index]['ordinal'])
+	elif first <= 0 and last < 1 and start_index > 0:
+		new_start_index = max(0, start_index - QUEUE_VIEW_WINDOW_LENGTH // 2)
+		move_queue_viewport(
+			viewport,
+			command_queue[new_start_index]['ordinal']
+			if new_start_index > 0
+			else None,
+		)
+	scrollbar.set(
+		(start_index + first * len(window)) / len(command_queue),
+		(start_index + last * len(window)) / len(command_queue),
+	)
+
+def on_queue_scrollbar_moved(
+	command_queue: List[EnqueuedCommand],
+	viewport: QueueViewport,
+	text: tkinter.Text,
+	*args,
+):
+	if args[0] != 'moveto':
+		# Scrolling by units or pages moves the window along as it goes
+		text.yview(*args)
+		return
+	start_index, window = get_queue_window(command_queue, viewport)
+	index = min(
+		round(float(args[1]) * len(command_queue)),
+		len(command_queue) - 1,
+	)
+	if start_index <= index < start_index + len(window):
+		text.yview(f'block-{command_queue[index]["ordinal"]}.first')
+	else:
+		move_queue_viewport_to_index(command_queue, viewport, index)
+
+def redraw_command_queue(
+	command_queue: List[EnqueuedCommand],
+	viewport: QueueViewport,
+	text: tkinter.Text,
+	rendered_revisions: Dict[int, Any],
+	position_label: ttk.Label,
+	scrollable_text_pad_left: str,
+):
+	start_index, window = get_queue_window(command_queue, viewport)
+	redraw_text_blocks(
+		text,
+		rendered_revisions,
+		list(map(
+			lambda command: cast(TextBlock, {
+				'key': command['ordinal'],
+				'revision': (
+					command.get('started_at'),
+					command.get('fused_through_ordinal'),
+					# Processing fills in specifics as it goes
+					tuple(command['specifics'].items()),
+				),
+				'render': lambda: f'''
+{scrollable_text_pad_left}[{command['specifics']['verb']}]{f"""
+{scrollable_text_pad_left}Fused from {
+	command['fused_command_count']
+} commands""" if 'fused_command_count' in command else ''}
 {scrollable_text_pad_left}Enqueued by {command['enqueued_by']}
 {scrollable_text_pad_left}Enqueued at {
 	friendly_timestamp(command['enqueued_at'])
@@ -680,12 +1017,25 @@ def build_command_queue(
 }""" if 'started_at' in command else ''}
 {friendly_specifics(command['specifics'], scrollable_text_pad_left + ' ✒ ')}
 \n''',
-				color_tag_from_ordinal(command['ordinal']),
-			),
-			state['command_queue'],
+				'color_tag': color_tag_from_ordinal(command['ordinal']),
+			}),
+			window,
 		)),
 		f'\n{scrollable_text_pad_left}(Empty)',
+		False,
 	)
+	
+	scroll_to_tag = f'block-{viewport["scroll_to_ordinal"]}'
+	if len(text.tag_ranges(scroll_to_tag)) > 0:
+		text.yview(f'{scroll_to_tag}.first')
+	viewport['scroll_to_ordinal'] = None
+	
+	position_label.config(text = (
+		f'#{window[0]["ordinal"]}–#{window[-1]["ordinal"]}, {start_index + 1:,}–{start_index + len(window):,} of {len(command_queue):,}'
+		if len(window) > 0
+		else '0 of 0'
+	))
+
 def build_delete_last_enqueued_command_button(
 	state: GlobalState,
 	parent: tkinter.Widget,
@@ -694,9 +1044,9 @@ def build_delete_last_enqueued_command_button(
 	button = ttk.Button(
 		parent,
 		text = 'Delete last enqueued command (from the bottom)',
-		command = lambda: (
-			set_value(state, 'command_queue', state['command_queue'][:-1]),
-		),
+		command = lambda: submit_operator_action(state, {
+			'verb': 'Delete last enqueued command',
+		}),
 	)
 	button.pack()
 
@@ -724,8 +1074,15 @@ def build_command_history(
 	return build_scrollable_text(
 		parent,
 		lambda: list(map(
-			lambda command: (f'''
-{scrollable_text_pad_left}[{command['specifics']['verb']}]
+			lambda command: cast(TextBlock, {
+				'key': command['ordinal'],
+				# Finished commands don't change
+				'revision': None,
+				'render': lambda: f'''
+{scrollable_text_pad_left}[{command['specifics']['verb']}]{f"""
+{scrollable_text_pad_left}Fused from {
+	command['fused_command_count']
+} commands""" if 'fused_command_count' in command else ''}
 {scrollable_text_pad_left}Enqueued by {command['enqueued_by']}
 {scrollable_text_pad_left}Enqueued at {
 	friendly_timestamp(command['enqueued_at'])
@@ -738,10 +1095,11 @@ def build_command_history(
 } (took {(command['finished_at'] - command['started_at']):,} ms)
 {friendly_specifics(command['specifics'], scrollable_text_pad_left + ' ✒ ')}
 \n''',
-				color_tag_from_ordinal(command['ordinal']),
-			),
+				'color_tag': color_tag_from_ordinal(command['ordinal']),
+			}),
 			reversed(state['command_history']),
 		)),
+		lambda: get_state_version(state, 'command_history'),
 		f'\n{scrollable_text_pad_left}(Empty)',
 	)
 
@@ -754,7 +1112,9 @@ def build_clear_history_button(
 		parent,
 		text = 'Clear command history',
 		command = lambda: [
-			state['command_history'].clear()
+			submit_operator_action(state, {
+				'verb': 'Clear command history',
+			})
 			if messagebox.askokcancel(
 				message = 'Are you sure you want to clear the command history?',
 			)
@@ -0,0 +1,42 @@
+'''
+Optionally runs the GUI in a process of its own (--gui-process), so that Tk
+can crash, hang or be closed without stopping a print. The service process
+keeps the state and publishes it (see state_snapshot.py), and the GUI process
+sends operator actions back over the IPC socket (see operator_actions.py).
+Kept free of Tk imports, since it runs in the service process.
+'''
+from __future__ import annotations
+from pathlib import Path
+import subprocess
+import sys
+from time import sleep
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+	from state import GlobalState
+
+GUI_RELAUNCH_DELAY_MS = 2000
+'''Keeps a GUI that can't start at all (e.g. no display) from spinning'''
+
+def run_gui_supervisor(state: GlobalState):
+	'''
+	Launches the GUI process, and relaunches it whenever it exits while the
+	service carries on. Returns once the service shuts down.
+	'''
+	nonpersistent = state['nonpersistent']
+	while nonpersistent['shutting_down'] == False:
+		gui_process = nonpersistent['gui_process'] = subprocess.Popen([
+			sys.executable,
+			str(Path(__file__).with_name('main.py')),
+			'--attach-gui',
+		])
+		return_code = gui_process.wait()
+		nonpersistent['gui_process'] = None
+		if nonpersistent['shutting_down'] == False:
+			print(f'GUI process exited with code {return_code}; relaunching it')
+			sleep(GUI_RELAUNCH_DELAY_MS / 1e3)
+
+def stop_gui_process(state: GlobalState):
+	gui_process = state['nonpersistent']['gui_process']
+	if gui_process != None and gui_process.poll() == None:
+		gui_process.terminate()
@@ -0,0 +1,106 @@
+import json
+import os
+from operator_actions import OperatorActionAcknowledgment, OperatorActionRejection, OperatorActionRequest, perform_operator_action
+from request_handling import enqueue_request
+import socket
+from state import Acknowledgment, GlobalState, Rejection, Request, Response, commands_up_to_ordinal_are_finished
+from state_snapshot import publish_state_snapshot
+from typing import TextIO, cast
+from threading import Timer
+
+def run_ipc_server(state: GlobalState):
+	'''
+	Accepts requests from request.py over a Unix domain socket, one JSON line
+	per connection. The reply is sent as soon as the request's commands have
+	finished (or been enqueued, if it doesn't await completion), so clients
+	don't pay any polling latency. GUI processes send operator actions the same
+	way.
+	'''
+	nonpersistent = state['nonpersistent']
+	socket_path = nonpersistent['ipc_socket_path']
+	if os.path.exists(socket_path):
+		os.remove(socket_path)
+
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(socket_path)
+	server.listen()
+	# Wake up periodically to notice shutdown
+	server.settimeout(0.5)
+
+	while nonpersistent['shutting_down'] == False:
+		try:
+			connection, _ = server.accept()
+		except socket.timeout:
+			continue
+		Timer(0, handle_ipc_connection, [state, connection]).start()
+
+	server.close()
+	os.remove(socket_path)
+
+def handle_ipc_connection(state: GlobalState, connection: socket.socket):
+	nonpersistent = state['nonpersistent']
+	with connection, connection.makefile('rw') as stream:
+		try:
+			message = json.loads(stream.readline())
+		except json.JSONDecodeError:
+			return
+		if 'operator_action' in message:
+			handle_operator_action(state, message, stream)
+			return
+		request = cast(Request, message)
+		print(f'Received request from Klipper over IPC: {json.dumps(request)}')
+
+		try:
+			caboose_ordinal = enqueue_request(state, request)
+		except Exception as error:
+			print(f'Rejecting request over IPC: {error}')
+			rejection: Rejection = {
+				'rejected_request_timestamp': request['timestamp'],
+				'reason': str(error),
+			}
+			stream.write(json.dumps(rejection) + '\n')
+			return
+
+		if request.get('awaits_completion', True) == False:
+			acknowledgment: Acknowledgment = {
+				'enqueued_request_timestamp': request['timestamp'],
+			}
+			stream.write(json.dumps(acknowledgment) + '\n')
+			return
+
+		command_finished_condition = nonpersistent['command_finished_condition']
+		with command_finished_condition:
+			while not commands_up_to_ordinal_are_finished(state, caboose_ordinal):
+				if nonpersistent['shutting_down'] == True:
+					return
+				# Timeout covers queue edits that don't notify, like deletion
+				command_finished_condition.wait(timeout = 1)
+
+		response: Response = {
+			'completed_request_timestamp': request['timestamp'],
+		}
+		stream.write(json.dumps(response) + '\n')
+
+def handle_operator_action(
+	state: GlobalState,
+	operator_action_request: OperatorActionRequest,
+	stream: TextIO,
+):
+	action = operator_action_request['operator_action']
+	try:
+		perform_operator_action(state, action)
+	except Exception as error:
+		print(f'Rejecting operator action over IPC: {error}')
+		rejection: OperatorActionRejection = {
+			'rejected_operator_action': action,
+			'reason': str(error),
+		}
+		stream.write(json.dumps(rejection) + '\n')
+		return
+	if state['nonpersistent']['state_snapshot'] != None:
+		# So the GUI process sees the action's effects once it's acknowledged
+		publish_state_snapshot(state)
+	acknowledgment: OperatorActionAcknowledgment = {
+		'performed_operator_action': action['verb'],
+	}
+	stream.write(json.dumps(acknowledgment) + '\n')
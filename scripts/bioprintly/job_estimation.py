@@ -0,0 +1,231 @@
+'''
+Estimates a job before it's printed: how long it takes, how much each syringe
+extrudes, and whether a syringe would run out partway (which would otherwise
+pause processing mid-print). Usage:
+`python3 job_estimation.py path/to/file.gcode` (or a compiled program's hash)
+'''
+from bisect import bisect_left
+from commands import CommandSpecifics, SyringeNumber
+from g_code_compiler import CompiledProgram, compile_g_code_file, load_compiled_program
+from journal import read_snapshot_and_journal
+import os
+from rotation_planning import get_barrel_winding_degrees, get_clearance_position_mm, plan_rotation_degrees
+from state import GlobalState, build_default_global_state
+from step_pulses import plan_trapezoidal_step_times
+import sys
+from time import perf_counter
+from typing import Dict, List, TypedDict, cast
+
+class RunOut(TypedDict):
+	syringe: SyringeNumber
+	command_index: int
+	line_number: int | None
+	'''G-code line whose commands would hit the maximum safe distance'''
+	elapsed_s: float
+	'''Into the job'''
+class JobEstimate(TypedDict):
+	duration_s: float
+	rotation_s: float
+	retraction_s: float
+	'''Retracting fully or to clearance, and going to plunger flanges'''
+	extrusion_s: float
+	extrusion_mm_per_syringe: Dict[str, float]
+	available_mm_per_syringe: Dict[str, float]
+	'''Extension left before the maximum safe distance, at the start'''
+	run_out: RunOut | None
+	'''The first one only; estimation carries on past it as if it hadn't'''
+
+def get_available_mm_per_syringe(state: GlobalState) -> Dict[str, float]:
+	nonpersistent = state['nonpersistent']
+	max_safe_extension_mm = (
+		nonpersistent['actuator_max_possible_extension_mm']
+		* (1 - nonpersistent['safety_margin'])
+	)
+	return {
+		syringe: max_safe_extension_mm - plunger_position_mm
+		for syringe, plunger_position_mm in state['plunger_positions_mm'].items()
+	}
+
+def estimate_job(
+	state: GlobalState,
+	program: CompiledProgram,
+) -> JobEstimate:
+	'''
+	Plays the program against a copy of the state's positions, following the
+	same rules as the service. Every command also costs a processing interval.
+	'''
+	nonpersistent = state['nonpersistent']
+	current_syringe = state['current_syringe']
+	winding_degrees = cast(float, get_barrel_winding_degrees(state))
+	actuator_position_mm = cast(float, state['actuator_position_mm'])
+	travel_since_zero_mm = nonpersistent['actuator_travel_since_zero_mm']
+	plunger_positions_mm = dict(state['plunger_positions_mm'])
+	travel_mm_per_ms = nonpersistent['actuator_travel_mm_per_ms']
+	max_safe_extension_mm = (
+		nonpersistent['actuator_max_possible_extension_mm']
+		* (1 - nonpersistent['safety_margin'])
+	)
+	estimate: JobEstimate = {
+		'duration_s': 0.0,
+		'rotation_s': 0.0,
+		'retraction_s': 0.0,
+		'extrusion_s': 0.0,
+		'extrusion_mm_per_syringe': {},
+		'available_mm_per_syringe': get_available_mm_per_syringe(state),
+		'run_out': None,
+	}
+	rotation_durations_s: Dict[int, float] = {}
+	marker_command_counts = [
+		sync_marker['command_count'] for sync_marker in program['sync_markers']
+	]
+
+	for command_index, specifics in enumerate(program['commands']):
+		estimate['duration_s'] += nonpersistent['processing_loop_interval_ms'] / 1e3
+		specifics = cast(CommandSpecifics, specifics)
+		if specifics['verb'] == 'Rotate':
+			relative_degrees = specifics.get('relative_degrees_required')
+			if relative_degrees == None:
+				relative_degrees = plan_rotation_degrees(
+					cast(SyringeNumber, current_syringe),
+					specifics['target_syringe'],
+					winding_degrees,
+					nonpersistent['barrel_winding_limit_degrees'],
+				)
+			winding_degrees += relative_degrees
+			step_count = round(
+				abs(relative_degrees) / nonpersistent['rotator_degrees_per_step']
+			)
+			if not step_count in rotation_durations_s:
+				step_times_s = plan_trapezoidal_step_times(
+					step_count,
+					nonpersistent['rotator_max_steps_per_s'],
+					nonpersistent['rotator_acceleration_steps_per_s2'],
+				)
+				rotation_durations_s[step_count] = (
+					step_times_s[-1] if len(step_times_s) > 0 else 0.0
+				)
+			estimate['rotation_s'] += rotation_durations_s[step_count]
+			estimate['duration_s'] += rotation_durations_s[step_count]
+			current_syringe = specifics['target_syringe']
+		elif specifics['verb'] == 'Actuate':
+			relative_mm = specifics['relative_mm_required']
+			if relative_mm == 'Retract to clearance' and (
+				travel_since_zero_mm >= nonpersistent['actuator_rezero_travel_mm']
+			):
+				relative_mm = 'Retract fully'
+			if relative_mm == 'Retract fully':
+				duration_s = actuator_position_mm / travel_mm_per_ms / 1e3
+				actuator_position_mm = 0.0
+				travel_since_zero_mm = 0.0
+				estimate['retraction_s'] += duration_s
+				estimate['duration_s'] += duration_s
+				continue
+			if relative_mm == 'Retract to clearance':
+				retracted_mm = max(
+					0.0,
+					actuator_position_mm - get_clearance_position_mm(nonpersistent),
+				)
+				duration_s = retracted_mm / travel_mm_per_ms / 1e3
+				actuator_position_mm -= retracted_mm
+				travel_since_zero_mm += retracted_mm
+				estimate['retraction_s'] += duration_s
+				estimate['duration_s'] += duration_s
+				continue
+			if relative_mm == 'Go to plunger flange':
+				relative_mm = (
+					plunger_positions_mm[str(current_syringe)] - actuator_position_mm
+				)
+				duration_s = abs(relative_mm) / travel_mm_per_ms / 1e3
+				estimate['retraction_s'] += duration_s
+			else:
+				duration_s = max(
+					abs(relative_mm) / travel_mm_per_ms,
+					specifics['duration_ms_required'],
+				) / 1e3
+				estimate['extrusion_s'] += duration_s
+				extrusion_mm_per_syringe = estimate['extrusion_mm_per_syringe']
+				extrusion_mm_per_syringe[str(current_syringe)] = (
+					extrusion_mm_per_syringe.get(str(current_syringe), 0.0)
+					+ relative_mm
+				)
+			if (
+				actuator_position_mm + relative_mm > max_safe_extension_mm
+				and estimate['run_out'] == None
+			):
+				marker_index = bisect_left(marker_command_counts, command_index + 1)
+				estimate['run_out'] = {
+					'syringe': cast(SyringeNumber, current_syringe),
+					'command_index': command_index,
+					'line_number': (
+						program['sync_markers'][marker_index]['line_number']
+						if marker_index < len(program['sync_markers'])
+						else None
+					),
+					'elapsed_s': estimate['duration_s'],
+				}
+			estimate['duration_s'] += duration_s
+			travel_since_zero_mm += abs(relative_mm)
+			actuator_position_mm = max(0.0, actuator_position_mm + relative_mm)
+			if relative_mm > 0:
+				plunger_positions_mm[str(current_syringe)] = max(
+					plunger_positions_mm[str(current_syringe)],
+					actuator_position_mm,
+				)
+
+	return estimate
+
+def load_state_for_estimation() -> GlobalState:
+	'''
+	Positions as Bioprintly last persisted them, read without the instance
+	check or journal, so estimating is safe while Bioprintly is running
+	'''
+	state = build_default_global_state()
+	savedata = read_snapshot_and_journal(state['nonpersistent']['savefolder_path'])
+	if savedata != None:
+		for key in [
+			'current_syringe',
+			'actuator_position_mm',
+			'plunger_positions_mm',
+			'barrel_winding_degrees',
+		]:
+			if key in savedata:
+				state[key] = savedata[key]
+	return state
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print('Usage: python3 job_estimation.py <path/to/file.gcode | compiled program hash>')
+		exit(1)
+	estimation_start = perf_counter()
+	state = load_state_for_estimation()
+	savefolder_path = state['nonpersistent']['savefolder_path']
+	if os.path.exists(sys.argv[1]):
+		program = compile_g_code_file(savefolder_path, sys.argv[1])
+	else:
+		loaded_program = load_compiled_program(savefolder_path, sys.argv[1])
+		if loaded_program == None:
+			print(f'No G-code file or compiled program {sys.argv[1]}')
+			exit(1)
+		program = loaded_program
+	if (
+		state['current_syringe'] == None
+		or state['actuator_position_mm'] == None
+		or len(state['plunger_positions_mm']) < 4
+	):
+		print('Calibration is missing one or more values; calibrate Bioprintly first.')
+		exit(1)
+
+	estimate = estimate_job(state, program)
+	lines: List[str] = [
+		f"Estimated in {(perf_counter() - estimation_start) * 1e3:.0f} ms from syringe {state['current_syringe']}, actuator at {state['actuator_position_mm']:.2f} mm",
+		f"Duration: {estimate['duration_s']:.1f} s (rotation {estimate['rotation_s']:.1f} s, retraction {estimate['retraction_s']:.1f} s, extrusion {estimate['extrusion_s']:.1f} s)",
+	]
+	for syringe in sorted(estimate['available_mm_per_syringe']):
+		lines.append(f"Syringe {syringe}: extrudes {estimate['extrusion_mm_per_syringe'].get(syringe, 0.0):.2f} mm of {estimate['available_mm_per_syringe'][syringe]:.2f} mm available")
+	run_out = estimate['run_out']
+	if run_out == None:
+		lines.append('No syringe runs out')
+	else:
+		lines.append(f"Syringe {run_out['syringe']} runs out {run_out['elapsed_s']:.1f} s in, at line {run_out['line_number']} (program command {run_out['command_index']})")
+	print('\n'.join(lines))
+	exit(0 if run_out == None else 2)
@@ -0,0 +1,405 @@
+from __future__ import annotations
+from copy import deepcopy
+import json
+from notifications import notify_operator
+import os
+from pathlib import Path
+from queue import Empty
+from time import perf_counter, sleep
+from typing import Any, Dict, List, Literal, Set, TextIO, TypedDict, TYPE_CHECKING
+from timing import monotonic_ms
+
+if TYPE_CHECKING:
+	from state import EnqueuedCommand, FinishedCommand, GlobalState
+
+class JournalEnqueue(TypedDict):
+	op: Literal['Enqueue']
+	command: EnqueuedCommand
+class JournalFuse(TypedDict):
+	op: Literal['Fuse']
+	command: EnqueuedCommand
+	'''Replaces the queued command with the same ordinal'''
+class JournalDrop(TypedDict):
+	op: Literal['Drop']
+	ordinal: int
+	'''Of a queued command removed without finishing, e.g. a superseded tail'''
+class JournalStart(TypedDict):
+	op: Literal['Start']
+	ordinal: int
+	started_at: int
+class JournalProgress(TypedDict):
+	op: Literal['Progress']
+	ordinal: int
+	progress: Dict[str, Any]
+	'''PROGRESS_KEYS of the started command's specifics'''
+class JournalFinish(TypedDict):
+	op: Literal['Finish']
+	commands: List[FinishedCommand]
+class JournalSet(TypedDict):
+	op: Literal['Set']
+	key: str
+	'''Top-level key of GlobalState'''
+	value: Any
+
+JournalEntry = (
+	JournalEnqueue
+	| JournalFuse
+	| JournalDrop
+	| JournalStart
+	| JournalProgress
+	| JournalFinish
+	| JournalSet
+)
+
+COMMAND_HISTORY_LENGTH = 50
+PROGRESS_KEYS = [
+	'relative_mm_required',
+	'relative_mm_traveled',
+	'relative_degrees_required',
+	'relative_degrees_traveled',
+]
+'''
+What processing fills in as a command runs, so that after a crash it carries
+on from where the journaled positions say it got to, rather than starting over
+'''
+
+def get_journal_path(savefolder_path: str, generation: int) -> str:
+	return f'{savefolder_path}/journal.{generation}.jsonl'
+
+def get_journal_generations(savefolder_path: str) -> List[int]:
+	generations = []
+	for path in Path(savefolder_path).glob('journal.*.jsonl'):
+		try:
+			generations.append(int(path.name.split('.')[1]))
+		except ValueError:
+			continue
+	return sorted(generations)
+
+JOURNALED_KEYS_BY_OP: Dict[str, List[str]] = {
+	'Enqueue': ['command_queue'],
+	'Fuse': ['command_queue'],
+	'Drop': ['command_queue'],
+	'Start': ['command_queue'],
+	'Progress': ['command_queue'],
+	'Finish': ['command_queue', 'command_history'],
+}
+
+def append_to_journal(state: GlobalState, entry: JournalEntry):
+	'''
+	Safe to call from any thread. Only queues an immutable copy of the entry;
+	run_state_writer does the serializing and file I/O.
+	'''
+	state['nonpersistent']['journal_queue'].put(deepcopy(entry))
+	for key in (
+		[entry['key']]
+		if entry['op'] == 'Set'
+		else JOURNALED_KEYS_BY_OP[entry['op']]
+	):
+		bump_state_version(state, key)
+
+def bump_state_version(state: GlobalState, key: str):
+	'''
+	Every journaled change bumps the version of the top-level keys it touches,
+	so that the GUI can tell a collection changed without comparing its contents
+	'''
+	state_versions = state['nonpersistent']['state_versions']
+	state_versions[key] = state_versions.get(key, 0) + 1
+
+def get_state_version(state: GlobalState, key: str) -> int:
+	return state['nonpersistent']['state_versions'].get(key, 0)
+
+def journal_set(state: GlobalState, key: str):
+	'''Records the current value of a top-level key after mutating it'''
+	append_to_journal(state, {
+		'op': 'Set',
+		'key': key,
+		'value': state[key],
+	})
+
+def apply_journal_entry(savedata: Dict[str, Any], entry: JournalEntry):
+	if entry['op'] == 'Enqueue':
+		savedata['command_queue'].append(entry['command'])
+		savedata['next_command_ordinal'] = max(
+			savedata['next_command_ordinal'],
+			entry['command']['ordinal'] + 1,
+		)
+	elif entry['op'] == 'Fuse':
+		savedata['command_queue'] = [
+			entry['command'] if command['ordinal'] == entry['command']['ordinal']
+			else command
+			for command in savedata['command_queue']
+		]
+		savedata['next_command_ordinal'] = max(
+			savedata['next_command_ordinal'],
+			entry['command']['fused_through_ordinal'] + 1,
+		)
+	elif entry['op'] == 'Drop':
+		savedata['command_queue'] = list(filter(
+			lambda command: command['ordinal'] != entry['ordinal'],
+			savedata['command_queue'],
+		))
+	elif entry['op'] == 'Start':
+		for command in savedata['command_queue']:
+			if command['ordinal'] == entry['ordinal']:
+				command['started_at'] = entry['started_at']
+				break
+	elif entry['op'] == 'Progress':
+		for command in savedata['command_queue']:
+			if command['ordinal'] == entry['ordinal']:
+				command['specifics'].update(entry['progress'])
+				break
+	elif entry['op'] == 'Finish':
+		finished_ordinals = set(map(
+			lambda command: command['ordinal'],
+			entry['commands'],
+		))
+		savedata['command_queue'] = list(filter(
+			lambda command: command['ordinal'] not in finished_ordinals,
+			savedata['command_queue'],
+		))
+		savedata['command_history'] = (
+			savedata['command_history'] + entry['commands']
+		)[-COMMAND_HISTORY_LENGTH:]
+	elif entry['op'] == 'Set':
+		savedata[entry['key']] = entry['value']
+	else:
+		raise Exception(f"Unknown journal entry op {entry['op']}")
+
+def read_snapshot_and_journal(savefolder_path: str) -> Dict[str, Any] | None:
+	'''
+	Reads the last snapshot and replays every journal generation written since.
+	A torn final line (from a crash mid-append) is ignored.
+	'''
+	try:
+		savedata = json.load(open(f'{savefolder_path}/state.json', 'r'))
+	except:
+		savedata = None
+
+	generations = get_journal_generations(savefolder_path)
+	if savedata == None and len(generations) == 0:
+		return None
+	if savedata == None:
+		savedata = {}
+	savedata.setdefault('command_queue', [])
+	savedata.setdefault('command_history', [])
+	savedata.setdefault('next_command_ordinal', 0)
+
+	for generation in generations:
+		if generation < savedata.get('journal_generation', 0):
+			continue
+		for line in open(get_journal_path(savefolder_path, generation), 'r'):
+			try:
+				entry = json.loads(line)
+			except json.JSONDecodeError:
+				break
+			apply_journal_entry(savedata, entry)
+
+	if len(generations) > 0:
+		savedata['journal_generation'] = generations[-1]
+	return savedata
+
+def get_persistent_state_copy(state: GlobalState) -> Dict[str, Any]:
+	return {
+		key: deepcopy(value)
+		for key, value in state.items()
+		if key != 'nonpersistent'
+	}
+
+def write_snapshot(
+	savefolder_path: str,
+	snapshot: Dict[str, Any],
+	superseded_generations: List[int],
+):
+	'''Writes via atomic rename, so a crash never leaves a half-written file'''
+	savefile_path = f'{savefolder_path}/state.json'
+	temporary_path = f'{savefile_path}.tmp'
+	with open(temporary_path, 'w') as temporary_file:
+		json.dump(snapshot, temporary_file, indent = '\t')
+		temporary_file.flush()
+		os.fsync(temporary_file.fileno())
+	os.replace(temporary_path, savefile_path)
+
+	for generation in superseded_generations:
+		try:
+			os.remove(get_journal_path(savefolder_path, generation))
+		except FileNotFoundError:
+			pass
+
+def coalesce_journal_entries(
+	shadow: Dict[str, Any],
+	entries: List[JournalEntry],
+) -> List[JournalEntry]:
+	'''
+	Drops Sets that don't change anything or are overwritten later in the same
+	batch, Starts and Progress of commands that finish within it (Finish
+	entries carry both), and all but the last Progress of each command. Merges
+	runs of Finish entries, and keeps only the last of a run of Fuses into the
+	same command. Sets of the queue and history are left alone since their
+	order relative to other ops matters.
+	'''
+	last_set_index_by_key: Dict[str, int] = {}
+	last_progress_index_by_ordinal: Dict[int, int] = {}
+	finished_ordinals: Set[int] = set()
+	for i, entry in enumerate(entries):
+		if entry['op'] == 'Set':
+			last_set_index_by_key[entry['key']] = i
+		elif entry['op'] == 'Progress':
+			last_progress_index_by_ordinal[entry['ordinal']] = i
+		elif entry['op'] == 'Finish':
+			for command in entry['commands']:
+				finished_ordinals.add(command['ordinal'])
+	
+	coalesced: List[JournalEntry] = []
+	for i, entry in enumerate(entries):
+		if entry['op'] == 'Start' and entry['ordinal'] in finished_ordinals:
+			continue
+		if entry['op'] == 'Progress' and (
+			entry['ordinal'] in finished_ordinals
+			or last_progress_index_by_ordinal[entry['ordinal']] != i
+		):
+			continue
+		if entry['op'] == 'Set' and entry['key'] not in [
+			'command_queue',
+			'command_history',
+		]:
+			if last_set_index_by_key[entry['key']] != i:
+				continue
+			if entry['key'] in shadow and shadow[entry['key']] == entry['value']:
+				continue
+		if (
+			entry['op'] == 'Finish'
+			and len(coalesced) > 0
+			and coalesced[-1]['op'] == 'Finish'
+		):
+			coalesced[-1] = {
+				'op': 'Finish',
+				'commands': coalesced[-1]['commands'] + entry['commands'],
+			}
+			continue
+		if (
+			entry['op'] == 'Fuse'
+			and len(coalesced) > 0
+			and coalesced[-1]['op'] == 'Fuse'
+			and coalesced[-1]['command']['ordinal'] == entry['command']['ordinal']
+		):
+			coalesced[-1] = entry
+			continue
+		coalesced.append(entry)
+	
+	return coalesced
+
+def start_state_journal(state: GlobalState):
+	'''
+	Call once the state has been loaded. Writes a snapshot synchronously and
+	sets up the shadow copy that run_state_writer keeps in sync.
+	'''
+	nonpersistent = state['nonpersistent']
+	shadow = nonpersistent['state_writer_shadow'] = get_persistent_state_copy(state)
+	write_shadow_snapshot(state, shadow)
+
+def write_shadow_snapshot(state: GlobalState, shadow: Dict[str, Any]):
+	'''
+	Starts a new journal generation and writes a snapshot that supersedes all
+	older generations.
+	'''
+	nonpersistent = state['nonpersistent']
+	nonpersistent['journal_generation'] += 1
+	shadow['journal_generation'] = nonpersistent['journal_generation']
+	write_snapshot(
+		nonpersistent['savefolder_path'],
+		shadow,
+		list(filter(
+			lambda generation: generation < nonpersistent['journal_generation'],
+			get_journal_generations(nonpersistent['savefolder_path']),
+		)),
+	)
+	nonpersistent['savefile_last_write'] = monotonic_ms()
+
+def run_state_writer(state: GlobalState):
+	'''
+	Owns all state file I/O. Waits for journal entries, gives bursts a moment to
+	pile up, then coalesces them into a single append. Compaction is done from
+	the shadow copy, so other threads never have to copy or serialize state.
+	Exits after draining the queue once stop_state_writer is called.
+	'''
+	nonpersistent = state['nonpersistent']
+	journal_queue = nonpersistent['journal_queue']
+	shadow = nonpersistent['state_writer_shadow']
+	journal_file: TextIO | None = None
+	entries_since_compaction = 0
+	stopping = False
+	
+	try:
+		while not stopping:
+			entries: List[Any] = []
+			try:
+				first_entry = journal_queue.get(
+					timeout = nonpersistent['journal_compaction_interval_ms'] / 1e3,
+				)
+				sleep(nonpersistent['state_writer_coalescing_ms'] / 1e3)
+				entries.append(first_entry)
+				while True:
+					entries.append(journal_queue.get_nowait())
+			except Empty:
+				pass
+			
+			if None in entries:
+				stopping = True
+				entries = list(filter(lambda entry: entry != None, entries))
+			
+			write_start = perf_counter()
+			entries = coalesce_journal_entries(shadow, entries)
+			for entry in entries:
+				apply_journal_entry(shadow, entry)
+			if len(entries) > 0:
+				if journal_file == None:
+					journal_file = open(get_journal_path(
+						nonpersistent['savefolder_path'],
+						nonpersistent['journal_generation'],
+					), 'a')
+				journal_file.write(''.join(map(
+					lambda entry: json.dumps(entry, separators = (',', ':')) + '\n',
+					entries,
+				)))
+				# Survives the app crashing; only compaction pays for an fsync
+				journal_file.flush()
+				entries_since_compaction += len(entries)
+			
+			if entries_since_compaction > 0 and (
+				stopping
+				or entries_since_compaction
+					>= nonpersistent['journal_compaction_entry_threshold']
+				or monotonic_ms() >= (
+					nonpersistent['savefile_last_write']
+					+ nonpersistent['journal_compaction_interval_ms']
+				)
+			):
+				if journal_file != None:
+					journal_file.close()
+					journal_file = None
+				write_shadow_snapshot(state, shadow)
+				entries_since_compaction = 0
+			
+			if len(entries) > 0:
+				write_latency_ms = (perf_counter() - write_start) * 1e3
+				nonpersistent['state_write_latency_ms'] = write_latency_ms
+				nonpersistent['state_write_max_latency_ms'] = max(
+					nonpersistent['state_write_max_latency_ms'],
+					write_latency_ms,
+				)
+	except Exception as error:
+		notify_operator(
+			state,
+			'Error',
+			f'Bioprintly has stopped saving its state: {error}',
+			'Commands carry on, but changes from here on will be lost when Bioprintly exits. Please fix the problem (e.g. free up disk space) and restart Bioprintly.',
+		)
+		raise
+	finally:
+		# Shutting down waits for this, even if the writer failed
+		nonpersistent['state_writer_stopped'].set()
+
+def stop_state_writer(state: GlobalState):
+	'''Blocks until everything journaled so far is on disk, or the writer failed'''
+	state['nonpersistent']['journal_queue'].put(None)
+	state['nonpersistent']['state_writer_stopped'].wait()
@@ -0,0 +1,341 @@
+'''
+Models Klipper's motion planning closely enough to time extrusion against the
+nozzle: per-move trapezoidal velocity profiles under the [printer] limits in
+config/printer.cfg, with junction speeds from square_corner_velocity.
+'''
+import math
+import os
+from typing import Any, Dict, List, TypedDict
+
+class KinematicLimits(TypedDict):
+	max_velocity_mm_per_s: float
+	max_accel_mm_per_s2: float
+	max_z_velocity_mm_per_s: float
+	max_z_accel_mm_per_s2: float
+	square_corner_velocity_mm_per_s: float
+
+PRINTER_CFG_PATH = os.path.normpath(os.path.join(
+	os.path.dirname(os.path.abspath(__file__)),
+	'../../config/printer.cfg',
+))
+'''Same relative location in this repo and in ~/printer_data'''
+DEFAULT_SQUARE_CORNER_VELOCITY_MM_PER_S = 5.0
+'''Klipper's default'''
+
+def read_kinematic_limits(
+	printer_cfg_path = PRINTER_CFG_PATH,
+) -> KinematicLimits | None:
+	'''
+	Reads the [printer] section by hand, since configparser alone would add a
+	good chunk to request.py's startup. Returns None when the file or its
+	limits are missing, in which case moves are timed at their feedrate.
+	'''
+	printer_section: Dict[str, str] = {}
+	section = None
+	try:
+		printer_cfg = open(printer_cfg_path, 'r')
+	except OSError:
+		return None
+	with printer_cfg:
+		for line in printer_cfg:
+			line = line.split('#', 1)[0].split(';', 1)[0].strip()
+			if line.startswith('['):
+				section = line.strip('[]').strip()
+			elif section == 'printer' and (':' in line or '=' in line):
+				key, value = line.replace('=', ':', 1).split(':', 1)
+				printer_section[key.strip()] = value.strip()
+
+	try:
+		max_velocity_mm_per_s = float(printer_section['max_velocity'])
+		max_accel_mm_per_s2 = float(printer_section['max_accel'])
+		return {
+			'max_velocity_mm_per_s': max_velocity_mm_per_s,
+			'max_accel_mm_per_s2': max_accel_mm_per_s2,
+			'max_z_velocity_mm_per_s': float(printer_section.get(
+				'max_z_velocity',
+				max_velocity_mm_per_s,
+			)),
+			'max_z_accel_mm_per_s2': float(printer_section.get(
+				'max_z_accel',
+				max_accel_mm_per_s2,
+			)),
+			'square_corner_velocity_mm_per_s': float(printer_section.get(
+				'square_corner_velocity',
+				DEFAULT_SQUARE_CORNER_VELOCITY_MM_PER_S,
+			)),
+		}
+	except (KeyError, ValueError):
+		return None
+
+def plan_move_durations_ms(
+	x_deltas_mm: List[float],
+	y_deltas_mm: List[float],
+	z_deltas_mm: List[float],
+	feedrates_mm_per_min: List[float],
+	follows_previous_move: List[bool],
+	limits: KinematicLimits,
+	numpy: Any = None,
+) -> List[float]:
+	'''
+	Like Klipper's lookahead, but only across the given moves: each chain of
+	moves that follow one another starts and ends at rest. Moves without
+	travel or without a feedrate take 0 ms, as they did before acceleration was
+	modelled. Per-move limits and durations are computed on whole arrays when
+	`numpy` is given; the lookahead passes are inherently sequential.
+	'''
+	move_count = len(feedrates_mm_per_min)
+	if move_count == 0:
+		return []
+
+	# Klipper's cartesian kinematics scale the Z limits by the share of the
+	# move that's along Z
+	if numpy != None:
+		x = numpy.array(x_deltas_mm)
+		y = numpy.array(y_deltas_mm)
+		z = numpy.array(z_deltas_mm)
+		distances = numpy.sqrt(x * x + y * y + z * z)
+		z_ratios = numpy.divide(
+			distances,
+			numpy.abs(z),
+			out = numpy.full(move_count, numpy.inf),
+			where = z != 0.0,
+		)
+		cruise_velocities = numpy.minimum.reduce([
+			numpy.array(feedrates_mm_per_min) / 60.0,
+			numpy.full(move_count, limits['max_velocity_mm_per_s']),
+			limits['max_z_velocity_mm_per_s'] * z_ratios,
+		])
+		accels = numpy.minimum(
+			limits['max_accel_mm_per_s2'],
+			limits['max_z_accel_mm_per_s2'] * z_ratios,
+		)
+		cruise_v2s_array = cruise_velocities ** 2
+		start_v2s = compute_max_start_v2s_on_arrays(
+			x,
+			y,
+			z,
+			distances,
+			cruise_v2s_array,
+			accels,
+			numpy.array(follows_previous_move, dtype = bool),
+			limits,
+			numpy,
+		)
+		distances_list: List[float] = distances.tolist()
+		cruise_v2s: List[float] = cruise_v2s_array.tolist()
+		accels_list: List[float] = accels.tolist()
+	else:
+		distances_list = [
+			math.sqrt(x * x + y * y + z * z)
+			for x, y, z in zip(x_deltas_mm, y_deltas_mm, z_deltas_mm)
+		]
+		z_ratios_list = [
+			math.inf if z == 0.0 else distance / abs(z)
+			for z, distance in zip(z_deltas_mm, distances_list)
+		]
+		cruise_v2s = [
+			min(
+				feedrate / 60.0,
+				limits['max_velocity_mm_per_s'],
+				limits['max_z_velocity_mm_per_s'] * z_ratio,
+			) ** 2
+			for feedrate, z_ratio in zip(feedrates_mm_per_min, z_ratios_list)
+		]
+		accels_list = [
+			min(
+				limits['max_accel_mm_per_s2'],
+				limits['max_z_accel_mm_per_s2'] * z_ratio,
+			)
+			for z_ratio in z_ratios_list
+		]
+		start_v2s = compute_max_start_v2s(
+			x_deltas_mm,
+			y_deltas_mm,
+			z_deltas_mm,
+			distances_list,
+			cruise_v2s,
+			accels_list,
+			follows_previous_move,
+			limits,
+		)
+	end_v2s = [0.0] * move_count
+
+	# Backward pass: leave room to decelerate into every following move
+	next_start_v2 = 0.0
+	for index in range(move_count - 1, -1, -1):
+		end_v2s[index] = next_start_v2
+		start_v2s[index] = min(
+			start_v2s[index],
+			end_v2s[index] + 2.0 * distances_list[index] * accels_list[index],
+		)
+		next_start_v2 = start_v2s[index]
+	# Forward pass: only exit as fast as each move can accelerate to
+	for index in range(move_count):
+		if index > 0:
+			start_v2s[index] = min(start_v2s[index], end_v2s[index - 1])
+		end_v2s[index] = min(
+			end_v2s[index],
+			start_v2s[index] + 2.0 * distances_list[index] * accels_list[index],
+		)
+
+	return compute_trapezoid_durations_ms(
+		distances_list,
+		start_v2s,
+		cruise_v2s,
+		end_v2s,
+		accels_list,
+		numpy,
+	)
+
+def compute_max_start_v2s(
+	x_deltas_mm: List[float],
+	y_deltas_mm: List[float],
+	z_deltas_mm: List[float],
+	distances: List[float],
+	cruise_v2s: List[float],
+	accels: List[float],
+	follows_previous_move: List[bool],
+	limits: KinematicLimits,
+) -> List[float]:
+	'''
+	Fastest each move may be entered, from Klipper's junction deviation model.
+	Moves that don't follow a moving predecessor are entered at rest.
+	'''
+	junction_deviation_mm = (
+		limits['square_corner_velocity_mm_per_s'] ** 2
+		* (math.sqrt(2.0) - 1.0)
+		/ limits['max_accel_mm_per_s2']
+	)
+	max_start_v2s = [0.0] * len(distances)
+	for index in range(1, len(distances)):
+		previous = index - 1
+		if (
+			follows_previous_move[index] == False
+			or distances[index] == 0.0
+			or distances[previous] == 0.0
+			or cruise_v2s[index] == 0.0
+			or cruise_v2s[previous] == 0.0
+		):
+			continue
+		junction_cos_theta = -(
+			x_deltas_mm[index] * x_deltas_mm[previous]
+			+ y_deltas_mm[index] * y_deltas_mm[previous]
+			+ z_deltas_mm[index] * z_deltas_mm[previous]
+		) / (distances[index] * distances[previous])
+		# Full reversal
+		if junction_cos_theta > 0.999999:
+			continue
+		junction_cos_theta = max(junction_cos_theta, -0.999999)
+		sin_theta_d2 = math.sqrt(0.5 * (1.0 - junction_cos_theta))
+		cos_theta_d2 = math.sqrt(0.5 * (1.0 + junction_cos_theta))
+		junction_radius_ratio = sin_theta_d2 / (1.0 - sin_theta_d2)
+		tan_theta_d2 = sin_theta_d2 / cos_theta_d2
+		max_start_v2s[index] = min(
+			junction_radius_ratio * junction_deviation_mm * accels[index],
+			junction_radius_ratio * junction_deviation_mm * accels[previous],
+			# The approximated corner arc can't reach past either move's midpoint
+			0.5 * distances[index] * tan_theta_d2 * accels[index],
+			0.5 * distances[previous] * tan_theta_d2 * accels[previous],
+			cruise_v2s[index],
+			cruise_v2s[previous],
+		)
+	return max_start_v2s
+
+def compute_max_start_v2s_on_arrays(
+	x: Any,
+	y: Any,
+	z: Any,
+	distances: Any,
+	cruise_v2s: Any,
+	accels: Any,
+	follows_previous_move: Any,
+	limits: KinematicLimits,
+	numpy: Any,
+) -> List[float]:
+	'''compute_max_start_v2s, pairing each move with its predecessor by shifting'''
+	junction_deviation_mm = (
+		limits['square_corner_velocity_mm_per_s'] ** 2
+		* (math.sqrt(2.0) - 1.0)
+		/ limits['max_accel_mm_per_s2']
+	)
+	max_start_v2s = numpy.zeros(len(distances))
+	joins = (
+		follows_previous_move[1:]
+		& (distances[1:] != 0.0)
+		& (distances[:-1] != 0.0)
+		& (cruise_v2s[1:] != 0.0)
+		& (cruise_v2s[:-1] != 0.0)
+	)
+	distance_products = numpy.where(joins, distances[1:] * distances[:-1], 1.0)
+	junction_cos_theta = -(
+		x[1:] * x[:-1] + y[1:] * y[:-1] + z[1:] * z[:-1]
+	) / distance_products
+	# Full reversals
+	joins &= junction_cos_theta <= 0.999999
+	junction_cos_theta = numpy.clip(junction_cos_theta, -0.999999, 0.999999)
+	sin_theta_d2 = numpy.sqrt(0.5 * (1.0 - junction_cos_theta))
+	cos_theta_d2 = numpy.sqrt(0.5 * (1.0 + junction_cos_theta))
+	junction_radius_ratio = sin_theta_d2 / (1.0 - sin_theta_d2)
+	tan_theta_d2 = sin_theta_d2 / cos_theta_d2
+	max_start_v2s[1:] = numpy.where(joins, numpy.minimum.reduce([
+		junction_radius_ratio * junction_deviation_mm * accels[1:],
+		junction_radius_ratio * junction_deviation_mm * accels[:-1],
+		0.5 * distances[1:] * tan_theta_d2 * accels[1:],
+		0.5 * distances[:-1] * tan_theta_d2 * accels[:-1],
+		cruise_v2s[1:],
+		cruise_v2s[:-1],
+	]), 0.0)
+	return max_start_v2s.tolist()
+
+def compute_trapezoid_durations_ms(
+	distances: List[float],
+	start_v2s: List[float],
+	cruise_v2s: List[float],
+	end_v2s: List[float],
+	accels: List[float],
+	numpy: Any = None,
+) -> List[float]:
+	'''Accelerate, cruise, decelerate; or a triangle if cruise isn't reached'''
+	if numpy != None:
+		distance = numpy.array(distances)
+		start_v2 = numpy.array(start_v2s)
+		end_v2 = numpy.array(end_v2s)
+		accel = numpy.array(accels)
+		peak_v2 = numpy.minimum(
+			numpy.array(cruise_v2s),
+			(2.0 * distance * accel + start_v2 + end_v2) / 2.0,
+		)
+		moving = (distance > 0.0) & (peak_v2 > 0.0)
+		peak_v = numpy.sqrt(numpy.where(moving, peak_v2, 1.0))
+		cruise_distance = numpy.maximum(
+			distance - (2.0 * peak_v2 - start_v2 - end_v2) / (2.0 * accel),
+			0.0,
+		)
+		durations_s = (
+			(2.0 * peak_v - numpy.sqrt(start_v2) - numpy.sqrt(end_v2)) / accel
+			+ cruise_distance / peak_v
+		)
+		return numpy.where(moving, durations_s * 1e3, 0.0).tolist()
+
+	durations_ms = []
+	for distance, start_v2, cruise_v2, end_v2, accel in zip(
+		distances,
+		start_v2s,
+		cruise_v2s,
+		end_v2s,
+		accels,
+	):
+		peak_v2 = min(cruise_v2, (2.0 * distance * accel + start_v2 + end_v2) / 2.0)
+		if distance == 0.0 or peak_v2 <= 0.0:
+			durations_ms.append(0.0)
+			continue
+		peak_v = math.sqrt(peak_v2)
+		cruise_distance = max(
+			distance - (2.0 * peak_v2 - start_v2 - end_v2) / (2.0 * accel),
+			0.0,
+		)
+		durations_ms.append(1e3 * (
+			(2.0 * peak_v - math.sqrt(start_v2) - math.sqrt(end_v2)) / accel
+			+ cruise_distance / peak_v
+		))
+	return durations_ms
@@ -1,33 +1,90 @@
-from gui import run_gui
-from pins import setup_pins
+from gui_process import run_gui_supervisor, stop_gui_process
+from ipc import run_ipc_server
+from journal import run_state_writer
+from motion_core import start_motion_core
+from notifications import NotificationSink, log_notification, remember_notification
+from pins import run_pwm_engine, setup_pins
+from request_handling import run_request_spool
 from service import run_service
 import signal
-from state import get_initial_global_state, save_state_to_disk
+import sys
+from state import get_initial_global_state, wake_service_threads
+from state_snapshot import open_state_snapshot, publish_state_snapshot, run_state_snapshot_publisher
 from threading import Timer
+from typing import List
 from util import set_value
 
 def setup_everything():
-	state = get_initial_global_state()
+	'''
+	Runs the GUI as the main thread, unless it's to run in a process of its own
+	(--gui-process) or not at all (--headless). GUI processes can be attached
+	to either of those with --attach-gui. Tk is only imported once a GUI is
+	requested.
+	'''
+	if '--attach-gui' in sys.argv:
+		from gui import run_attached_gui
+		run_attached_gui()
+		return
+	
+	gui_in_process = (
+		'--gui-process' not in sys.argv
+		and '--headless' not in sys.argv
+	)
+	notification_sinks: List[NotificationSink] = [log_notification]
+	if gui_in_process:
+		from gui import show_notification_in_gui
+		notification_sinks.append(show_notification_in_gui)
+	else:
+		notification_sinks.append(remember_notification)
+	
+	state = get_initial_global_state(notification_sinks)
 	setup_pins(state)
+	if '--motion-core' in sys.argv:
+		# Forks, so before any other thread starts
+		start_motion_core(state)
+	
+	if not gui_in_process:
+		state['nonpersistent']['state_snapshot'] = open_state_snapshot(
+			state['nonpersistent']['savefolder_path'],
+			True,
+		)
+		# Ready before the IPC socket is, which GUI processes need too
+		publish_state_snapshot(state)
+		Timer(0, run_state_snapshot_publisher, [state]).start()
 	
+	Timer(0, run_state_writer, [state]).start()
 	# Launch the service (command processing) as a secondary thread
-	Timer(0, run_service, [state]).start()
+	service_thread = Timer(0, run_service, [state])
+	service_thread.start()
+	if state['nonpersistent']['motion_core'] == None:
+		Timer(0, run_pwm_engine, [state]).start()
+	Timer(0, run_ipc_server, [state]).start()
+	Timer(0, run_request_spool, [state]).start()
 	
-	signal.signal(signal.SIGINT, lambda a, b: (
-		set_value(state['nonpersistent'], 'shutting_down', True),
-		(
-			state['nonpersistent']['gui_root'].quit()
-			if state['nonpersistent']['gui_root'] != None
-			else None,
-		)
-	))
+	for signal_number in [signal.SIGINT, signal.SIGTERM]:
+		signal.signal(signal_number, lambda a, b: (
+			set_value(state['nonpersistent'], 'shutting_down', True),
+			wake_service_threads(state),
+			stop_gui_process(state),
+			(
+				state['nonpersistent']['gui_root'].quit()
+				if state['nonpersistent']['gui_root'] != None
+				else None,
+			)
+		))
+	
+	if '--gui-process' in sys.argv:
+		# The GUI can crash or be closed without stopping command processing
+		run_gui_supervisor(state)
+		return
+	if '--headless' in sys.argv:
+		# Until shut down by a signal or an attached GUI; the service stops the
+		# state writer on its way out
+		service_thread.join()
+		return
 	
 	# Run the GUI as the main thread
-	while True:
-		run_gui(state)
-		if state['nonpersistent']['reopening_gui'] == True:
-			state['nonpersistent']['reopening_gui'] = False
-			continue
-		break
+	from gui import run_gui_until_closed
+	run_gui_until_closed(state)
 
 setup_everything()
@@ -0,0 +1,360 @@
+'''
+Optionally moves the software PWM engine and the step pulse generator into a
+process of their own (the motion core), so that Tk redraws and JSON
+serialization in the main process can't hold the GIL over a PWM tick or a
+step. The process is forked before any other thread starts, and is pinned to
+one CPU, with SCHED_FIFO scheduling and its memory locked where that's
+permitted (e.g. when run as root). Isolating that CPU with isolcpus= on the
+kernel command line keeps everything else off it.
+
+The service talks to it through shared memory: a ring of MotionCommands that
+only the service writes, and a MotionSnapshot that only the motion core
+writes. The snapshot is guarded by a sequence lock rather than a semaphore, so
+that a reader preempted mid-read can never make the motion core wait.
+
+Without a motion core, the same functions drive pins.py and step_pulses.py
+within the process.
+'''
+from __future__ import annotations
+from ctypes import CDLL, Structure, c_bool, c_double, c_int32, c_int64, c_uint64, get_errno
+import multiprocessing
+from notifications import log_notification, notify_operator
+from multiprocessing.sharedctypes import RawArray, RawValue
+import os
+from pins import PinMappings, run_pwm_engine, set_pwm_duty_cycle, stop_pwm, take_pwm_on_time_ms, zero_out_pins
+from step_pulses import PulseTrain, plan_trapezoidal_step_times, run_step_pulse_generator
+from threading import Event, Lock, Timer
+from time import sleep
+from timing import monotonic_ms
+from typing import Any, Dict, List, Literal, TypedDict, cast, get_args, TYPE_CHECKING
+
+if TYPE_CHECKING:
+	from state import GlobalState, NonPersistentState
+
+MotionOp = Literal[
+	'Set duty cycle',
+	'Stop PWM',
+	'Start pulse train',
+	'Zero out pins',
+	'Shut down',
+]
+MOTION_OPS: List[MotionOp] = list(get_args(MotionOp))
+PIN_NAMES: List[str] = list(PinMappings.__annotations__.keys())
+MOTION_RING_LENGTH = 64
+MOTION_CORE_TIMEOUT_MS = 500
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+class MotionCommand(Structure):
+	_fields_ = [
+		# Index into MOTION_OPS
+		('op', c_int32),
+		# Index into PIN_NAMES
+		('pin', c_int32),
+		('duty_cycle', c_double),
+		('step_count', c_int64),
+		('max_steps_per_s', c_double),
+		('acceleration_steps_per_s2', c_double),
+	]
+class MotionSnapshot(Structure):
+	_fields_ = [
+		# Odd while the motion core is writing
+		('sequence', c_uint64),
+		('commands_done', c_uint64),
+		# Running totals per pin, indexed like PIN_NAMES
+		('on_time_ms', c_double * len(PIN_NAMES)),
+		# Ring index of the command that started the latest pulse train
+		('pulse_train_command', c_int64),
+		('pulse_train_steps_emitted', c_int64),
+		('pulse_train_finished', c_bool),
+		('pwm_engine_failures', c_uint64),
+	]
+
+class MotionCore(TypedDict):
+	process: Any
+	ring: Any
+	'''RawArray of MOTION_RING_LENGTH MotionCommands'''
+	snapshot: MotionSnapshot
+	processing_enabled: Any
+	'''RawValue mirroring nonpersistent processing_enabled'''
+	wakeup: Any
+	'''Semaphore released once per command written to the ring'''
+	commands_written: int
+	lock: Lock
+	'''Serializes the service process's writes to the ring'''
+	on_time_taken_ms: Dict[str, float]
+	'''Running on-time totals as of the last take_motion_on_time_ms'''
+	pulse_train_command: int
+	pwm_engine_failures_seen: int
+	'''The motion core reports its own in the snapshot; see fail_pwm_channel'''
+
+def start_motion_core(state: GlobalState):
+	'''Forks, so it has to run before any other thread starts'''
+	nonpersistent = state['nonpersistent']
+	context = multiprocessing.get_context('fork')
+	core: MotionCore = {
+		'process': None,
+		'ring': RawArray(MotionCommand, MOTION_RING_LENGTH),
+		'snapshot': RawValue(MotionSnapshot),
+		'processing_enabled': RawValue(c_bool, nonpersistent['processing_enabled']),
+		'wakeup': context.Semaphore(0),
+		'commands_written': 0,
+		'lock': Lock(),
+		'on_time_taken_ms': dict.fromkeys(PIN_NAMES, 0.0),
+		'pulse_train_command': -1,
+		'pwm_engine_failures_seen': 0,
+	}
+	core['snapshot'].pulse_train_command = -1
+	nonpersistent['motion_core'] = core
+
+	cpus = os.sched_getaffinity(0)
+	if nonpersistent['motion_core_cpu'] == None:
+		# The highest numbered CPU is the one that isolcpus= usually isolates
+		nonpersistent['motion_core_cpu'] = max(cpus)
+	core['process'] = context.Process(
+		target = run_motion_core,
+		args = [state, os.getpid()],
+		name = 'Bioprintly motion core',
+		daemon = True,
+	)
+	core['process'].start()
+	if len(cpus) > 1:
+		# Threads started from here on inherit this
+		os.sched_setaffinity(0, cpus - { nonpersistent['motion_core_cpu'] })
+
+def stop_motion_core(state: GlobalState):
+	core = state['nonpersistent']['motion_core']
+	if core == None or not core['process'].is_alive():
+		return
+	push_motion_command(state, 'Shut down')
+	core['process'].join(MOTION_CORE_TIMEOUT_MS / 1e3)
+
+def push_motion_command(
+	state: GlobalState,
+	op: MotionOp,
+	pin_name: str | None = None,
+	duty_cycle: float = 0.0,
+	step_count: int = 0,
+) -> int:
+	'''Returns the command's ring index, e.g. for wait_for_motion_core'''
+	nonpersistent = state['nonpersistent']
+	core = cast(MotionCore, nonpersistent['motion_core'])
+	with core['lock']:
+		index = core['commands_written']
+		deadline = monotonic_ms() + MOTION_CORE_TIMEOUT_MS
+		while index - read_motion_snapshot(core).commands_done >= MOTION_RING_LENGTH:
+			check_motion_core_is_responding(core, deadline)
+			sleep(1e-4)
+		command = core['ring'][index % MOTION_RING_LENGTH]
+		command.op = MOTION_OPS.index(op)
+		command.pin = PIN_NAMES.index(pin_name) if pin_name != None else -1
+		command.duty_cycle = duty_cycle
+		command.step_count = step_count
+		command.max_steps_per_s = nonpersistent['rotator_max_steps_per_s']
+		command.acceleration_steps_per_s2 = (
+			nonpersistent['rotator_acceleration_steps_per_s2']
+		)
+		core['commands_written'] = index + 1
+		# Posting a semaphore is a memory barrier, so the command is all there
+		# by the time the motion core reads it
+		core['wakeup'].release()
+	return index
+
+def check_motion_core_is_responding(core: MotionCore, deadline: float):
+	'''For loops waiting on the motion core, which may have died mid-write'''
+	if monotonic_ms() > deadline or not core['process'].is_alive():
+		raise Exception('Motion core stopped responding')
+
+def read_motion_snapshot(core: MotionCore) -> MotionSnapshot:
+	snapshot = core['snapshot']
+	deadline = monotonic_ms() + MOTION_CORE_TIMEOUT_MS
+	while True:
+		sequence = snapshot.sequence
+		if sequence % 2 == 0:
+			snapshot_copy = MotionSnapshot.from_buffer_copy(snapshot)
+			if snapshot.sequence == sequence:
+				return snapshot_copy
+		check_motion_core_is_responding(core, deadline)
+		sleep(0)
+
+def wait_for_motion_core(state: GlobalState, index: int):
+	'''Until the motion core has carried out the command at ring index `index`'''
+	core = cast(MotionCore, state['nonpersistent']['motion_core'])
+	deadline = monotonic_ms() + MOTION_CORE_TIMEOUT_MS
+	while read_motion_snapshot(core).commands_done <= index:
+		check_motion_core_is_responding(core, deadline)
+		sleep(1e-4)
+
+def sync_motion_core_control(state: GlobalState):
+	'''Also where the service hears of the motion core failing to drive a pin'''
+	nonpersistent = state['nonpersistent']
+	core = nonpersistent['motion_core']
+	if core == None:
+		return
+	pwm_engine_failures = read_motion_snapshot(core).pwm_engine_failures
+	if pwm_engine_failures > core['pwm_engine_failures_seen']:
+		core['pwm_engine_failures_seen'] = pwm_engine_failures
+		nonpersistent['processing_enabled'] = False
+		notify_operator(
+			state,
+			'Error',
+			'The motion core failed to drive a pin (see the log for which one)',
+			'Processing has been paused. Please check the pin mappings in the calibration window.',
+		)
+	core['processing_enabled'].value = nonpersistent['processing_enabled']
+
+def set_motion_duty_cycle(state: GlobalState, pin_name: str, duty_cycle: float):
+	core = state['nonpersistent']['motion_core']
+	if core == None:
+		set_pwm_duty_cycle(state, pin_name, duty_cycle)
+		return
+	# Unchanged duty cycles are resent rather than remembered here, since the
+	# motion core stops every channel by itself when processing is paused
+	push_motion_command(state, 'Set duty cycle', pin_name, duty_cycle = duty_cycle)
+	state['pins'][pin_name]['value'] = 1 if duty_cycle > 0 else 0
+
+def stop_motion_pwm(state: GlobalState, pin_name: str):
+	'''Returns once the pin is low, so that on-time taken afterwards is final'''
+	core = state['nonpersistent']['motion_core']
+	if core == None:
+		stop_pwm(state, pin_name)
+		return
+	wait_for_motion_core(state, push_motion_command(state, 'Stop PWM', pin_name))
+	state['pins'][pin_name]['value'] = 0
+
+def take_motion_on_time_ms(state: GlobalState, pin_name: str) -> float:
+	core = state['nonpersistent']['motion_core']
+	if core == None:
+		return take_pwm_on_time_ms(state, pin_name)
+	on_time_ms = read_motion_snapshot(core).on_time_ms[PIN_NAMES.index(pin_name)]
+	taken_ms = on_time_ms - core['on_time_taken_ms'][pin_name]
+	core['on_time_taken_ms'][pin_name] = on_time_ms
+	return taken_ms
+
+def start_pulse_train(state: GlobalState, pulse_train: PulseTrain):
+	core = state['nonpersistent']['motion_core']
+	if core == None:
+		Timer(0, run_step_pulse_generator, [state, pulse_train]).start()
+		return
+	# The motion core plans the same step times from the same parameters
+	core['pulse_train_command'] = push_motion_command(
+		state,
+		'Start pulse train',
+		'rotator_step',
+		step_count = len(pulse_train['step_times_s']),
+	)
+
+def sync_pulse_train(state: GlobalState, pulse_train: PulseTrain):
+	'''Catches pulse_train up with the motion core, if there is one'''
+	core = state['nonpersistent']['motion_core']
+	if core == None:
+		return
+	snapshot = read_motion_snapshot(core)
+	if snapshot.pulse_train_command != core['pulse_train_command']:
+		# Not started yet
+		return
+	pulse_train['steps_emitted'] = snapshot.pulse_train_steps_emitted
+	pulse_train['finished'] = snapshot.pulse_train_finished
+
+def zero_out_motion_pins(state: GlobalState):
+	core = state['nonpersistent']['motion_core']
+	if core != None:
+		wait_for_motion_core(state, push_motion_command(state, 'Zero out pins'))
+	zero_out_pins(state)
+
+def prepare_for_real_time(nonpersistent: NonPersistentState):
+	'''Best effort, since each step needs privileges that may be missing'''
+	try:
+		os.sched_setaffinity(0, { nonpersistent['motion_core_cpu'] })
+	except OSError as error:
+		print(f'Motion core not pinned to CPU {nonpersistent["motion_core_cpu"]}: {error}')
+	try:
+		os.sched_setscheduler(
+			0,
+			os.SCHED_FIFO,
+			os.sched_param(nonpersistent['motion_core_fifo_priority']),
+		)
+	except OSError as error:
+		print(f'Motion core not scheduled SCHED_FIFO: {error}')
+	# Page faults would stall a tick, so fault everything in now and for good
+	if CDLL(None, use_errno = True).mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+		print(f'Motion core memory not locked: {os.strerror(get_errno())}')
+
+def run_motion_core(state: GlobalState, parent_pid: int):
+	'''
+	Runs in the forked motion core process, on its own copy of the state.
+	Carries out ring commands as they come, and republishes the snapshot every
+	PWM engine interval while anything is moving.
+	'''
+	nonpersistent = state['nonpersistent']
+	core = cast(MotionCore, nonpersistent['motion_core'])
+	# Only the forking thread survives a fork, so these are as good as new, but
+	# they're replaced anyway in case another thread held one at the time
+	nonpersistent['pwm_lock'] = Lock()
+	nonpersistent['pwm_wakeup_event'] = Event()
+	nonpersistent['pwm_channels'] = {}
+	# The service process tells the operator, once it sees the snapshot
+	nonpersistent['notification_sinks'] = [log_notification]
+	prepare_for_real_time(nonpersistent)
+	# Started after prepare_for_real_time, so that it inherits all of it
+	Timer(0, run_pwm_engine, [state]).start()
+
+	snapshot = core['snapshot']
+	pulse_train: PulseTrain | None = None
+	commands_done = 0
+	while nonpersistent['shutting_down'] == False:
+		nonpersistent['processing_enabled'] = core['processing_enabled'].value
+		moving = (
+			(pulse_train != None and pulse_train['finished'] == False)
+			or any(
+				channel['duty_cycle'] > 0
+				for channel in nonpersistent['pwm_channels'].values()
+			)
+		)
+		if core['wakeup'].acquire(timeout = (
+			nonpersistent['pwm_engine_interval_ms'] / 1e3 if moving else 1.0
+		)):
+			command = core['ring'][commands_done % MOTION_RING_LENGTH]
+			op = MOTION_OPS[command.op]
+			pin_name = PIN_NAMES[command.pin] if command.pin >= 0 else ''
+			if op == 'Set duty cycle':
+				set_pwm_duty_cycle(state, pin_name, command.duty_cycle)
+			elif op == 'Stop PWM':
+				stop_pwm(state, pin_name)
+			elif op == 'Start pulse train':
+				pulse_train = {
+					'ordinal': commands_done,
+					'step_times_s': plan_trapezoidal_step_times(
+						command.step_count,
+						command.max_steps_per_s,
+						command.acceleration_steps_per_s2,
+					),
+					'steps_emitted': 0,
+					'steps_accounted_for': 0,
+					'finished': False,
+				}
+				Timer(0, run_step_pulse_generator, [state, pulse_train]).start()
+			elif op == 'Zero out pins':
+				zero_out_pins(state)
+			elif op == 'Shut down':
+				nonpersistent['shutting_down'] = True
+			commands_done += 1
+		elif os.getppid() != parent_pid:
+			# The service process died without shutting the motion core down
+			nonpersistent['shutting_down'] = True
+
+		snapshot.sequence += 1
+		snapshot.commands_done = commands_done
+		for pin_name in list(nonpersistent['pwm_channels'].keys()):
+			snapshot.on_time_ms[PIN_NAMES.index(pin_name)] += (
+				take_pwm_on_time_ms(state, pin_name)
+			)
+		if pulse_train != None:
+			snapshot.pulse_train_command = pulse_train['ordinal']
+			snapshot.pulse_train_steps_emitted = pulse_train['steps_emitted']
+			snapshot.pulse_train_finished = pulse_train['finished']
+		snapshot.pwm_engine_failures = nonpersistent['pwm_engine_failures']
+		snapshot.sequence += 1
+
+	nonpersistent['pwm_wakeup_event'].set()
+	zero_out_pins(state)
@@ -0,0 +1,68 @@
+'''
+Alerts for the operator, e.g. when the service pauses processing. Each goes
+to every notification sink: the log, plus the GUI or GUI processes when one
+is attached. Kept free of Tk imports, so the service can run headless.
+'''
+from __future__ import annotations
+import sys
+from typing import Callable, List, Literal, TypedDict, TYPE_CHECKING
+from util import friendly_timestamp, unix_time_ms
+
+if TYPE_CHECKING:
+	from state import GlobalState
+
+RECENT_NOTIFICATIONS_LENGTH = 10
+
+Severity = Literal['Warning', 'Error']
+
+class Notification(TypedDict):
+	ordinal: int
+	'''Counts up from 1 within one run of the service'''
+	severity: Severity
+	message: str
+	detail: str
+	notified_at: int
+	'''Unix epoch milliseconds'''
+
+NotificationSink = Callable[['GlobalState', Notification], None]
+
+def notify_operator(
+	state: GlobalState,
+	severity: Severity,
+	message: str,
+	detail: str,
+):
+	'''Safe to call from any thread'''
+	nonpersistent = state['nonpersistent']
+	with nonpersistent['notification_lock']:
+		nonpersistent['notification_count'] += 1
+		notification: Notification = {
+			'ordinal': nonpersistent['notification_count'],
+			'severity': severity,
+			'message': message,
+			'detail': detail,
+			'notified_at': unix_time_ms(),
+		}
+	deliver_notification(state, notification)
+
+def deliver_notification(state: GlobalState, notification: Notification):
+	for sink in list(state['nonpersistent']['notification_sinks']):
+		sink(state, notification)
+
+def log_notification(state: GlobalState, notification: Notification):
+	print(
+		f"{notification['severity']} at {friendly_timestamp(notification['notified_at'])}: {notification['message']} {notification['detail']}",
+		file = sys.stderr,
+	)
+
+def remember_notification(state: GlobalState, notification: Notification):
+	'''
+	For GUI processes, which pick recent notifications up from the state
+	snapshot (see state_snapshot.py)
+	'''
+	nonpersistent = state['nonpersistent']
+	with nonpersistent['notification_lock']:
+		recent_notifications: List[Notification] = (
+			nonpersistent['recent_notifications'] + [notification]
+		)[-RECENT_NOTIFICATIONS_LENGTH:]
+		nonpersistent['recent_notifications'] = recent_notifications
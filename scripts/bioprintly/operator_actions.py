@@ -0,0 +1,324 @@
+'''
+Everything the operator can do to the service's state from the GUI. In the
+usual single process, actions are performed right away; a GUI process
+(--attach-gui) sends them to the service process over the IPC socket instead,
+since its own state is only a replica.
+'''
+from commands import ActuatorTravel, CommandSpecifics, OnOff, SyringeNumber
+import json
+from journal import append_to_journal, journal_set
+from motion_core import zero_out_motion_pins
+from peephole import forget_tail_prediction
+from pins import InputOutput, PinNumber, setup_pins, write_pin
+from rotation_planning import record_current_syringe
+import socket
+from state import GlobalState, enqueue_command, wake_service_threads
+from state_snapshot import refresh_state_replica
+from threading import Timer
+from time import monotonic_ns, sleep
+from timing import sleep_until_ns
+from typing import Any, Dict, Literal, NotRequired, TypedDict, cast, get_args
+from util import signum, this_action_would_put_it_further_away_from_target_than_it_is_now
+
+OPERATOR_ACTION_TIMEOUT_S = 5
+
+class ActionEnqueue(TypedDict):
+	verb: Literal['Enqueue']
+	specifics: CommandSpecifics
+class ActionSetProcessingEnabled(TypedDict):
+	verb: Literal['Set processing enabled']
+	processing_enabled: bool
+class ActionSetUiScale(TypedDict):
+	verb: Literal['Set UI scale']
+	ui_scale: float
+class ActionSetPin(TypedDict):
+	verb: Literal['Set pin']
+	pin_name: str
+	number: NotRequired[PinNumber]
+	io_type: NotRequired[InputOutput]
+class ActionDeleteLastEnqueuedCommand(TypedDict):
+	verb: Literal['Delete last enqueued command']
+class ActionClearCommandHistory(TypedDict):
+	verb: Literal['Clear command history']
+class ActionHomeTheActuator(TypedDict):
+	verb: Literal['Home the actuator']
+class ActionHandcrankTheActuator(TypedDict):
+	verb: Literal['Handcrank the actuator']
+	relative_mm_required: float
+class ActionRecordPlungerPosition(TypedDict):
+	'''Records the actuator tip's position as the syringe's plunger position'''
+	verb: Literal['Record plunger position']
+	syringe_number: SyringeNumber
+class ActionRecordCurrentSyringe(TypedDict):
+	verb: Literal['Record current syringe']
+	syringe_number: SyringeNumber
+class ActionShutDown(TypedDict):
+	verb: Literal['Shut down']
+
+OperatorAction = (
+	ActionEnqueue
+	| ActionSetProcessingEnabled
+	| ActionSetUiScale
+	| ActionSetPin
+	| ActionDeleteLastEnqueuedCommand
+	| ActionClearCommandHistory
+	| ActionHomeTheActuator
+	| ActionHandcrankTheActuator
+	| ActionRecordPlungerPosition
+	| ActionRecordCurrentSyringe
+	| ActionShutDown
+)
+
+class OperatorActionRequest(TypedDict):
+	'''Sent over the IPC socket by a GUI process'''
+	operator_action: OperatorAction
+class OperatorActionAcknowledgment(TypedDict):
+	performed_operator_action: str
+	'''The action's verb'''
+class OperatorActionRejection(TypedDict):
+	rejected_operator_action: OperatorAction
+	'''The action as it was sent'''
+	reason: str
+
+def submit_operator_action(state: GlobalState, action: OperatorAction):
+	'''What the GUI calls; returns once the service has performed the action'''
+	nonpersistent = state['nonpersistent']
+	if nonpersistent['attached_to_service'] == False:
+		perform_operator_action(state, action)
+		return
+
+	connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	connection.settimeout(OPERATOR_ACTION_TIMEOUT_S)
+	with connection, connection.makefile('rw') as stream:
+		connection.connect(nonpersistent['ipc_socket_path'])
+		request: OperatorActionRequest = { 'operator_action': action }
+		stream.write(json.dumps(request) + '\n')
+		stream.flush()
+		reply = stream.readline()
+		if reply == '':
+			raise Exception(f"Service didn't acknowledge {action['verb']}")
+		reply_message = json.loads(reply)
+		if 'rejected_operator_action' in reply_message:
+			rejection = cast(OperatorActionRejection, reply_message)
+			raise Exception(f"Service rejected {action['verb']}: {rejection['reason']}")
+	refresh_state_replica(state)
+
+def is_number(value: Any) -> bool:
+	return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def validate_command_specifics(specifics: Any):
+	'''Raises with the reason if an enqueued command's fields don't make sense'''
+	if not isinstance(specifics, dict):
+		raise Exception('Command is not an object')
+	specifics = cast(Dict[str, Any], specifics)
+	verb = specifics.get('verb')
+	syringes_or_current = [*get_args(SyringeNumber), 'Current one']
+	if verb == 'Rotate':
+		if not specifics.get('target_syringe') in get_args(SyringeNumber):
+			raise Exception(f"No syringe {specifics.get('target_syringe')} to rotate to")
+		if 'relative_degrees_required' in specifics and not is_number(
+			specifics['relative_degrees_required']
+		):
+			raise Exception('Rotation angle is not a number')
+	elif verb == 'Actuate':
+		relative_mm = specifics.get('relative_mm_required')
+		if not is_number(relative_mm) and not relative_mm in get_args(ActuatorTravel):
+			raise Exception(f'Unknown actuator travel {relative_mm}')
+		if not is_number(specifics.get('duration_ms_required')):
+			raise Exception('Actuation duration is not a number')
+	elif verb == 'Turn heating pad' or verb == 'Turn UV light':
+		target_key = 'target_heating_pad' if verb == 'Turn heating pad' else 'target_uv_light'
+		if not specifics.get(target_key) in syringes_or_current:
+			raise Exception(f'No syringe {specifics.get(target_key)} for {verb}')
+		if not specifics.get('on_or_off') in get_args(OnOff):
+			raise Exception(f"Can't turn it {specifics.get('on_or_off')}")
+	elif verb != 'Barrier':
+		raise Exception(f'Unknown command {verb}')
+
+def validate_operator_action(state: GlobalState, action: OperatorAction):
+	'''
+	Actions from a GUI process arrive as JSON that nothing has checked yet.
+	Raises with the reason if one doesn't make sense, before any of it is done.
+	'''
+	if not isinstance(action, dict):
+		raise Exception('Operator action is not an object')
+	fields = cast(Dict[str, Any], action)
+	verb = fields.get('verb')
+	if verb == 'Enqueue':
+		validate_command_specifics(fields.get('specifics'))
+	elif verb == 'Set processing enabled':
+		if not isinstance(fields.get('processing_enabled'), bool):
+			raise Exception('processing_enabled is not a boolean')
+	elif verb == 'Set UI scale':
+		if not is_number(fields.get('ui_scale')) or fields['ui_scale'] <= 0:
+			raise Exception(f"UI scale {fields.get('ui_scale')} is not a positive number")
+	elif verb == 'Set pin':
+		if not fields.get('pin_name') in state['pins']:
+			raise Exception(f"No pin named {fields.get('pin_name')}")
+		if 'number' in fields and not fields['number'] in get_args(PinNumber):
+			raise Exception(f"No GPIO pin number {fields['number']}")
+		if 'io_type' in fields and not fields['io_type'] in get_args(InputOutput):
+			raise Exception(f"Pins can't be set to {fields['io_type']}")
+	elif verb == 'Handcrank the actuator':
+		if not is_number(fields.get('relative_mm_required')):
+			raise Exception('Handcrank distance is not a number')
+	elif verb == 'Record plunger position' or verb == 'Record current syringe':
+		if not fields.get('syringe_number') in get_args(SyringeNumber):
+			raise Exception(f"No syringe {fields.get('syringe_number')}")
+		if verb == 'Record plunger position' and state['actuator_position_mm'] == None:
+			raise Exception('Actuator position is unknown until the actuator is homed')
+	elif not verb in [
+		'Delete last enqueued command',
+		'Clear command history',
+		'Home the actuator',
+		'Shut down',
+	]:
+		raise Exception(f'Unknown operator action {verb}')
+
+def perform_operator_action(state: GlobalState, action: OperatorAction):
+	'''
+	Runs in the process that owns the state. Actions that take a while, like
+	homing the actuator, carry on in a thread of their own.
+	'''
+	nonpersistent = state['nonpersistent']
+	validate_operator_action(state, action)
+	
+	if action['verb'] == 'Enqueue':
+		enqueue_command(state, 'Operator', action['specifics'])
+	elif action['verb'] == 'Set processing enabled':
+		nonpersistent['processing_enabled'] = action['processing_enabled']
+		wake_service_threads(state)
+		if action['processing_enabled'] == False:
+			zero_out_motion_pins(state)
+	elif action['verb'] == 'Set UI scale':
+		state['ui_scale'] = action['ui_scale']
+		journal_set(state, 'ui_scale')
+	elif action['verb'] == 'Set pin':
+		pin = state['pins'][action['pin_name']]
+		if 'number' in action:
+			pin['number'] = action['number']
+		if 'io_type' in action:
+			pin['io_type'] = action['io_type']
+		setup_pins(state)
+		journal_set(state, 'pins')
+	elif action['verb'] == 'Delete last enqueued command':
+		with nonpersistent['enqueue_lock']:
+			if len(state['command_queue']) > 0:
+				dropped_ordinal = state['command_queue'][-1]['ordinal']
+				state['command_queue'] = state['command_queue'][:-1]
+				append_to_journal(state, { 'op': 'Drop', 'ordinal': dropped_ordinal })
+	elif action['verb'] == 'Clear command history':
+		state['command_history'].clear()
+		journal_set(state, 'command_history')
+	elif action['verb'] == 'Home the actuator':
+		Timer(0, home_the_actuator, [state]).start()
+	elif action['verb'] == 'Handcrank the actuator':
+		Timer(
+			0,
+			handcrank_the_actuator,
+			[state, action['relative_mm_required']],
+		).start()
+	elif action['verb'] == 'Record plunger position':
+		state['plunger_positions_mm'][str(action['syringe_number'])] = cast(
+			float,
+			state['actuator_position_mm'],
+		)
+		journal_set(state, 'plunger_positions_mm')
+		record_current_syringe(state, action['syringe_number'])
+		forget_tail_prediction(state)
+	elif action['verb'] == 'Record current syringe':
+		record_current_syringe(state, action['syringe_number'])
+		forget_tail_prediction(state)
+	elif action['verb'] == 'Shut down':
+		nonpersistent['shutting_down'] = True
+		wake_service_threads(state)
+	else:
+		raise Exception(f"Unknown operator action {action['verb']}")
+
+def home_the_actuator(state: GlobalState):
+	'''Only for use in calibration logic; not a substitute for CommandActuate'''
+	nonpersistent = state['nonpersistent']
+	
+	if nonpersistent['actuator_has_calibration_lock'] == True:
+		return
+	nonpersistent['actuator_has_calibration_lock'] = True
+	state['actuator_position_mm'] = None
+	forget_tail_prediction(state)
+	write_pin(state, 'actuator_retract', 1)
+	sleep(
+		nonpersistent['actuator_max_possible_extension_mm']
+		/ nonpersistent['actuator_travel_mm_per_ms']
+		/ 1000
+		* (1 + nonpersistent['safety_margin'])
+	)
+	write_pin(state, 'actuator_retract', 0)
+	state['actuator_position_mm'] = 0
+	nonpersistent['actuator_travel_since_zero_mm'] = 0.0
+	journal_set(state, 'actuator_position_mm')
+	forget_tail_prediction(state)
+	nonpersistent['actuator_has_calibration_lock'] = False
+
+def handcrank_the_actuator(state: GlobalState, relative_mm_required: float):
+	'''Only for use in calibration logic; not a substitute for CommandActuate'''
+	nonpersistent = state['nonpersistent']
+	
+	if nonpersistent['actuator_has_calibration_lock'] == True:
+		return
+	nonpersistent['actuator_has_calibration_lock'] = True
+	
+	handcrank_loop_interval_ms = 8
+	handcrank_loop_last_start_ns = monotonic_ns()
+	relative_mm_traveled = 0
+	while True:
+		handcrank_loop_start_ns = monotonic_ns()
+		handcrank_loop_measured_delta = (
+			handcrank_loop_start_ns - handcrank_loop_last_start_ns
+		) / 1e6
+		handcrank_loop_last_start_ns = handcrank_loop_start_ns
+		expected_travel_mm = (
+			signum(relative_mm_required)
+			* nonpersistent['actuator_travel_mm_per_ms']
+			* handcrank_loop_measured_delta
+		)
+		
+		if cast(float, state['actuator_position_mm']) < 0:
+			state['actuator_position_mm'] = 0
+			nonpersistent['actuator_travel_since_zero_mm'] = 0.0
+		
+		if this_action_would_put_it_further_away_from_target_than_it_is_now(
+			relative_mm_traveled,
+			expected_travel_mm,
+			relative_mm_required,
+		):
+			break
+		
+		if (
+			cast(float, state['actuator_position_mm'])
+			+ expected_travel_mm
+		) > (
+			nonpersistent['actuator_max_possible_extension_mm']
+			* (1 - nonpersistent['safety_margin'])
+		):
+			break
+		
+		if relative_mm_required > 0:
+			write_pin(state, 'actuator_extend', 1)
+		else:
+			write_pin(state, 'actuator_retract', 1)
+		
+		relative_mm_traveled += expected_travel_mm
+		state['actuator_position_mm'] = (
+			cast(float, state['actuator_position_mm'])
+			+ expected_travel_mm
+		)
+		nonpersistent['actuator_travel_since_zero_mm'] += abs(expected_travel_mm)
+		
+		sleep_until_ns(
+			handcrank_loop_start_ns + round(handcrank_loop_interval_ms * 1e6)
+		)
+	
+	write_pin(state, 'actuator_extend', 0)
+	write_pin(state, 'actuator_retract', 0)
+	journal_set(state, 'actuator_position_mm')
+	forget_tail_prediction(state)
+	nonpersistent['actuator_has_calibration_lock'] = False
@@ -0,0 +1,203 @@
+'''
+Drops commands that wouldn't change anything by the time they run, e.g. the
+retract, UV off, rotate and UV on of a tool change to the syringe that's
+already current. Works off the hardware state predicted at the tail of the
+queue, which is cached so that enqueueing stays constant-time.
+'''
+from __future__ import annotations
+from commands import CommandSpecifics, SyringeNumber
+from rotation_planning import get_clearance_position_mm
+from typing import Dict, TypedDict, TYPE_CHECKING
+
+if TYPE_CHECKING:
+	from pins import Bit
+	from state import EnqueuedCommand, GlobalState
+
+class PredictedHardware(TypedDict):
+	current_syringe: SyringeNumber | None
+	actuator_position_mm: float | None
+	'''Dead reckoning drifts, but retractions stop in the same place every time'''
+	pin_values: Dict[str, Bit | None]
+	'''Heating pads and UV lights'''
+class TailPrediction(TypedDict):
+	tail_ordinal: int
+	tail_fused_through_ordinal: int | None
+	'''The tail keeps its ordinal when commands are fused into it'''
+	hardware: PredictedHardware
+
+def get_current_hardware(state: GlobalState) -> PredictedHardware:
+	return {
+		'current_syringe': state['current_syringe'],
+		'actuator_position_mm': state['actuator_position_mm'],
+		'pin_values': {
+			pin_name: pin['value']
+			for pin_name, pin in state['pins'].items()
+			if pin_name.startswith('heating_pad_') or pin_name.startswith('uv_light_')
+		},
+	}
+
+def apply_command(
+	state: GlobalState,
+	hardware: PredictedHardware,
+	specifics: CommandSpecifics,
+):
+	'''Mirrors what the service will do when it runs the command'''
+	if specifics['verb'] == 'Rotate':
+		hardware['current_syringe'] = specifics['target_syringe']
+	elif specifics['verb'] == 'Actuate':
+		relative_mm = specifics['relative_mm_required']
+		if relative_mm == 'Retract fully':
+			hardware['actuator_position_mm'] = 0.0
+		elif relative_mm == 'Retract to clearance':
+			clearance_position_mm = get_clearance_position_mm(state['nonpersistent'])
+			# Even from an unknown position, it ends up no further out than this
+			hardware['actuator_position_mm'] = (
+				clearance_position_mm if hardware['actuator_position_mm'] == None
+				else min(hardware['actuator_position_mm'], clearance_position_mm)
+			)
+		elif relative_mm == 'Go to plunger flange':
+			hardware['actuator_position_mm'] = None
+		elif hardware['actuator_position_mm'] != None:
+			hardware['actuator_position_mm'] = max(
+				0.0,
+				hardware['actuator_position_mm'] + relative_mm,
+			)
+	elif specifics['verb'] != 'Barrier':
+		pin_name = get_target_pin_name(hardware, specifics)
+		hardware['pin_values'][pin_name] = 1 if specifics['on_or_off'] == 'On' else 0
+
+def get_target_pin_name(
+	hardware: PredictedHardware,
+	specifics: CommandSpecifics,
+) -> str:
+	'''For Turn heating pad and Turn UV light; 'Current one' as of `hardware`'''
+	if specifics['verb'] == 'Turn heating pad':
+		target = specifics['target_heating_pad']
+		prefix = 'heating_pad'
+	elif specifics['verb'] == 'Turn UV light':
+		target = specifics['target_uv_light']
+		prefix = 'uv_light'
+	else:
+		raise Exception(f"{specifics['verb']} doesn't target a pin")
+	return f"{prefix}_{hardware['current_syringe'] if target == 'Current one' else target}"
+
+def get_tail_prediction(state: GlobalState) -> PredictedHardware:
+	'''
+	Predicted hardware state once everything queued has run. Rebuilt by walking
+	the queue only when it was changed other than by enqueueing, e.g. deletion,
+	or the hardware was (see forget_tail_prediction).
+	'''
+	nonpersistent = state['nonpersistent']
+	command_queue = state['command_queue']
+	if len(command_queue) == 0:
+		return get_current_hardware(state)
+
+	cached = nonpersistent['queue_tail_prediction']
+	if cached != None and prediction_matches_tail(cached, command_queue[-1]):
+		return cached['hardware']
+
+	hardware = get_current_hardware(state)
+	for command in command_queue:
+		# Already reflected in the hardware, though it hasn't left the queue
+		if 'finished_at' in command:
+			continue
+		apply_command(state, hardware, command['specifics'])
+	remember_tail_prediction(state, hardware)
+	return hardware
+
+def prediction_matches_tail(
+	prediction: TailPrediction,
+	tail: EnqueuedCommand,
+) -> bool:
+	return (
+		prediction['tail_ordinal'] == tail['ordinal']
+		and prediction['tail_fused_through_ordinal'] == tail.get('fused_through_ordinal')
+	)
+
+def remember_tail_prediction(state: GlobalState, hardware: PredictedHardware):
+	'''Call with the queue's new tail in place'''
+	command_queue = state['command_queue']
+	if len(command_queue) == 0:
+		state['nonpersistent']['queue_tail_prediction'] = None
+		return
+	state['nonpersistent']['queue_tail_prediction'] = {
+		'tail_ordinal': command_queue[-1]['ordinal'],
+		'tail_fused_through_ordinal': command_queue[-1].get('fused_through_ordinal'),
+		'hardware': hardware,
+	}
+
+def command_is_redundant(
+	state: GlobalState,
+	hardware: PredictedHardware,
+	specifics: CommandSpecifics,
+) -> bool:
+	if specifics['verb'] == 'Barrier':
+		return False
+	if specifics['verb'] == 'Rotate':
+		# A preset angle is a deliberate move (like unwinding), not a tool change
+		return (
+			not 'relative_degrees_required' in specifics
+			and specifics['target_syringe'] == hardware['current_syringe']
+		)
+	if specifics['verb'] == 'Actuate':
+		actuator_position_mm = hardware['actuator_position_mm']
+		if actuator_position_mm == None:
+			return False
+		if specifics['relative_mm_required'] == 'Retract fully':
+			return actuator_position_mm == 0.0
+		if specifics['relative_mm_required'] == 'Retract to clearance':
+			return actuator_position_mm <= get_clearance_position_mm(state['nonpersistent'])
+		return False
+	if hardware['current_syringe'] == None and (
+		specifics.get('target_heating_pad') == 'Current one'
+		or specifics.get('target_uv_light') == 'Current one'
+	):
+		return False
+	return (
+		hardware['pin_values'].get(get_target_pin_name(hardware, specifics))
+		== (1 if specifics['on_or_off'] == 'On' else 0)
+	)
+
+def supersedes_queue_tail(
+	state: GlobalState,
+	hardware: PredictedHardware,
+	specifics: CommandSpecifics,
+) -> bool:
+	'''
+	Whether the command makes the tail pointless, like rotating to syringe 1
+	right after rotating to syringe 2, or UV on right after UV off. The tail
+	can go, as long as the service hasn't started it; the command is then
+	judged against the state before the tail.
+	'''
+	if len(state['command_queue']) == 0:
+		return False
+	tail = state['command_queue'][-1]
+	tail_specifics = tail['specifics']
+	if 'started_at' in tail or tail_specifics['verb'] != specifics['verb']:
+		return False
+	if specifics['verb'] == 'Rotate':
+		return (
+			not 'relative_degrees_required' in tail_specifics
+			and not 'relative_degrees_required' in specifics
+		)
+	if specifics['verb'] == 'Actuate' or specifics['verb'] == 'Barrier':
+		return False
+	return (
+		hardware['current_syringe'] != None
+		and get_target_pin_name(hardware, tail_specifics)
+		== get_target_pin_name(hardware, specifics)
+	)
+
+def drop_queue_tail(state: GlobalState):
+	'''Only call for a tail that the command being enqueued supersedes'''
+	state['command_queue'] = state['command_queue'][:-1]
+	# Rebuilt by walking the queue, which is cheap next to the motions saved
+	forget_tail_prediction(state)
+
+def forget_tail_prediction(state: GlobalState):
+	'''
+	Call whenever the hardware changes other than by the queue running, e.g.
+	pins zeroed out on pause, or calibration. The prediction started from the
+	hardware as it was, so it's rebuilt from the hardware as it is now.
+	'''
+	state['nonpersistent']['queue_tail_prediction'] = None
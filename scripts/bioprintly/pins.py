@@ -1,7 +1,10 @@
 from __future__ import annotations
-from time import sleep
+from notifications import notify_operator
+from peephole import forget_tail_prediction
+from time import perf_counter, sleep
+from timing import record_loop_delta
 from types import SimpleNamespace
-from typing import Iterable, Literal, Tuple, TypedDict, cast, get_args, TYPE_CHECKING
+from typing import Any, Dict, Iterable, Literal, Tuple, TypedDict, cast, get_args, TYPE_CHECKING
 
 if TYPE_CHECKING:
 	from state import GlobalState
@@ -12,6 +15,7 @@ PinNumber = Literal[
 	 3,  5,  7,     11, 13, 15,     19, 21, 23,         29, 31, 33, 35, 37,
 ]
 InputOutput = Literal['Input', 'Output']
+PwmBackend = Literal['Hardware', 'Software']
 
 class Pin(TypedDict):
 	number: PinNumber | None
@@ -30,6 +34,14 @@ class PinMappings(TypedDict):
 	uv_light_2: Pin
 	uv_light_3: Pin
 	uv_light_4: Pin
+class PwmChannel(TypedDict):
+	backend: PwmBackend
+	duty_cycle: float
+	output: Bit
+	'''Last value the software PWM engine wrote to the pin'''
+	error_accumulator: float
+	on_time_ms: float
+	'''Time spent high that hasn't been collected by take_pwm_on_time_ms yet'''
 
 try:
 	GPIO = __import__('RPi', fromlist = ['GPIO']).GPIO
@@ -46,6 +58,28 @@ except:
 	})
 	GPIO = SimpleNamespace(**gpio_stub)
 
+# Board pin numbers of the Pi's hardware PWM channels, mapped to the BCM GPIO
+# numbers that pigpio expects
+HARDWARE_PWM_BCM_NUMBERS: Dict[int, int] = { 12: 18, 32: 12, 33: 13, 35: 19 }
+hardware_pwm: Any = None
+hardware_pwm_probed = False
+
+def get_hardware_pwm() -> Any:
+	'''
+	Lazily connects to the pigpio daemon, since it's optional and connecting
+	takes a moment. Returns None when it isn't available.
+	'''
+	global hardware_pwm, hardware_pwm_probed
+	if hardware_pwm_probed == False:
+		hardware_pwm_probed = True
+		try:
+			hardware_pwm = __import__('pigpio').pi()
+			if not hardware_pwm.connected:
+				hardware_pwm = None
+		except:
+			hardware_pwm = None
+	return hardware_pwm
+
 def flip_bit(value: Bit) -> Bit:
 	return cast(Bit, +(not value))
 
@@ -96,9 +130,174 @@ def write_pin(state: GlobalState, pin_name: str, value: Bit):
 	pin['value'] = value
 
 def zero_out_pins(state: GlobalState):
+	with state['nonpersistent']['pwm_lock']:
+		for pin_name, channel in state['nonpersistent']['pwm_channels'].items():
+			stop_pwm_channel(state, pin_name, channel)
+	
 	for pin_number in get_args(PinNumber):
 		GPIO.setup(pin_number, GPIO.OUT)
 		GPIO.output(pin_number, 0)
 	
 	for pin_name, pin in state['pins'].items():
 		cast(Pin, pin)['value'] = 0
+	forget_tail_prediction(state)
+
+def set_pwm_duty_cycle(state: GlobalState, pin_name: str, duty_cycle: float):
+	'''
+	Uses a hardware PWM channel when the pin has one and pigpio is available,
+	otherwise hands the pin to the software engine in run_pwm_engine.
+	'''
+	nonpersistent = state['nonpersistent']
+	pin_number = state['pins'][pin_name]['number']
+	with nonpersistent['pwm_lock']:
+		channel = nonpersistent['pwm_channels'].get(pin_name)
+		if channel == None:
+			channel = nonpersistent['pwm_channels'][pin_name] = {
+				'backend': (
+					'Hardware'
+					if (
+						pin_number in HARDWARE_PWM_BCM_NUMBERS
+						and get_hardware_pwm() != None
+					)
+					else 'Software'
+				),
+				'duty_cycle': 0.0,
+				'output': 0,
+				'error_accumulator': 0.0,
+				'on_time_ms': 0.0,
+			}
+		if channel['duty_cycle'] == duty_cycle:
+			return
+		channel['duty_cycle'] = duty_cycle
+		nonpersistent['pwm_wakeup_event'].set()
+		if channel['backend'] == 'Hardware':
+			get_hardware_pwm().hardware_PWM(
+				HARDWARE_PWM_BCM_NUMBERS[cast(int, pin_number)],
+				nonpersistent['pwm_hardware_frequency_hz'],
+				round(duty_cycle * 1e6),
+			)
+			state['pins'][pin_name]['value'] = 1 if duty_cycle > 0 else 0
+
+def stop_pwm(state: GlobalState, pin_name: str):
+	with state['nonpersistent']['pwm_lock']:
+		channel = state['nonpersistent']['pwm_channels'].get(pin_name)
+		if channel != None:
+			stop_pwm_channel(state, pin_name, channel)
+
+def stop_pwm_channel(state: GlobalState, pin_name: str, channel: PwmChannel):
+	'''Caller must hold pwm_lock'''
+	if channel['duty_cycle'] == 0 and channel['output'] == 0:
+		return
+	channel['duty_cycle'] = 0.0
+	channel['output'] = 0
+	channel['error_accumulator'] = 0.0
+	if channel['backend'] == 'Hardware':
+		pin_number = cast(int, state['pins'][pin_name]['number'])
+		get_hardware_pwm().hardware_PWM(
+			HARDWARE_PWM_BCM_NUMBERS[pin_number],
+			0,
+			0,
+		)
+		# Hardware PWM leaves the pin in its alternate function mode
+		GPIO.setup(pin_number, GPIO.OUT)
+	write_pin(state, pin_name, 0)
+
+def take_pwm_on_time_ms(state: GlobalState, pin_name: str) -> float:
+	'''Returns how long the pin has been high since the last call'''
+	with state['nonpersistent']['pwm_lock']:
+		channel = state['nonpersistent']['pwm_channels'].get(pin_name)
+		if channel == None:
+			return 0.0
+		on_time_ms = channel['on_time_ms']
+		channel['on_time_ms'] = 0.0
+		return on_time_ms
+
+def run_pwm_engine(state: GlobalState):
+	'''
+	Software PWM fallback using error accumulation (first-order sigma-delta),
+	which spreads the high ticks evenly instead of leaving them to chance. Also
+	tallies on-time for every channel so that dead reckoning can use how long
+	the pin was actually high. Waits for set_pwm_duty_cycle while no channel is
+	active, rather than ticking.
+	'''
+	nonpersistent = state['nonpersistent']
+	tick_last_start = perf_counter()
+	was_ticking = False
+	while nonpersistent['shutting_down'] == False:
+		tick_start = perf_counter()
+		tick_measured_delta_ms = (tick_start - tick_last_start) * 1e3
+		tick_last_start = tick_start
+		if was_ticking:
+			record_loop_delta(nonpersistent['pwm_tick_deltas'], tick_measured_delta_ms)
+		any_channel_active = False
+		
+		with nonpersistent['pwm_lock']:
+			# Cleared under the lock, so a duty cycle set after it wakes the wait
+			nonpersistent['pwm_wakeup_event'].clear()
+			for pin_name, channel in nonpersistent['pwm_channels'].items():
+				if channel['backend'] == 'Hardware':
+					channel['on_time_ms'] += (
+						channel['duty_cycle'] * tick_measured_delta_ms
+					)
+				elif channel['output'] == 1:
+					channel['on_time_ms'] += tick_measured_delta_ms
+				
+				try:
+					if nonpersistent['processing_enabled'] == False:
+						# PWM only drives commands, so never outlive processing
+						stop_pwm_channel(state, pin_name, channel)
+						continue
+					if channel['duty_cycle'] == 0:
+						continue
+					any_channel_active = True
+					if channel['backend'] == 'Hardware':
+						continue
+					
+					channel['error_accumulator'] += channel['duty_cycle']
+					if channel['error_accumulator'] >= 1.0:
+						channel['error_accumulator'] -= 1.0
+						output = 1
+					else:
+						output = 0
+					if output != channel['output']:
+						write_pin(state, pin_name, output)
+						channel['output'] = output
+				except Exception as error:
+					fail_pwm_channel(state, pin_name, channel, error)
+		
+		was_ticking = any_channel_active
+		if any_channel_active:
+			sleep(max(0,
+				nonpersistent['pwm_engine_interval_ms']
+				- (perf_counter() - tick_start) * 1e3
+			) / 1e3)
+		else:
+			# Times out now and then to notice shutting down, should nothing wake it
+			nonpersistent['pwm_wakeup_event'].wait(1.0)
+			# Every channel was low while waiting, so there's no on-time to tally
+			tick_last_start = perf_counter()
+
+def fail_pwm_channel(
+	state: GlobalState,
+	pin_name: str,
+	channel: PwmChannel,
+	error: Exception,
+):
+	'''
+	Caller must hold pwm_lock. Keeps the engine running for the other channels,
+	but pauses processing, since the command driving the pin would otherwise
+	stall with no visible cause (e.g. the pin was remapped to an input).
+	'''
+	nonpersistent = state['nonpersistent']
+	# Stopping the channel would write to the pin again
+	channel['duty_cycle'] = 0.0
+	channel['output'] = 0
+	channel['error_accumulator'] = 0.0
+	nonpersistent['processing_enabled'] = False
+	nonpersistent['pwm_engine_failures'] += 1
+	notify_operator(
+		state,
+		'Error',
+		f'Failed to drive pin {pin_name}: {error}',
+		'Processing has been paused. Please check the pin mappings in the calibration window.',
+	)
@@ -1,140 +1,73 @@
+'''
+Invoked by Klipper macros once per G-code line, so startup time matters. Only
+import modules that stay clear of Tk and state management (see benchmark.py).
+'''
+from commands import Rejection, Request, Response
+from g_code import build_commands_for_g_code
 import json
 import math
-from typing import List, cast, get_args
-from state import SyringeNumber, establish_savefolder_path, Request, Response, CommandSpecifics
+import os
+from request_protocol import establish_savefolder_path, get_ipc_socket_path, get_request_spool_path, get_response_spool_path, sleep_briefly, write_file_atomically
+import socket
 import sys
-from time import sleep
-from util import unix_time_ms
+from time import time_ns
+from typing import cast
 
-def build_commands_for_g_code(g_code: str) -> List[CommandSpecifics]:
-	if g_code == 'M140':
-		for i in range(2, len(sys.argv)):
-			if sys.argv[i][0] == 'S':
-				on_or_off = 'Off' if float(sys.argv[i][1:]) == 0.0 else 'On'
-				break
-		else:
-			return []
-		commands = [
-			{
-				'verb': 'Actuate',
-				'duration_ms_required': 0.0,
-				'relative_mm_required': 'Retract fully',
-			},
-			{
-				'verb': 'Turn UV light',
-				'target_uv_light': 'Current one',
-				'on_or_off': on_or_off,
-			},
-		]
-		for i in get_args(SyringeNumber):
-			commands.append({
-				'verb': 'Turn heating pad',
-				'target_heating_pad': i,
-				'on_or_off': on_or_off,
-			})
-		return commands
-	elif g_code[0] == 'T':
-		target_syringe = 1 + int(g_code[1:])
-		if not target_syringe in get_args(SyringeNumber):
-			raise Exception(f'T-code {g_code} out of range in bioprintly/request.py')
-		target_syringe = cast(SyringeNumber, target_syringe)
-		return [
-			{
-				'verb': 'Actuate',
-				'duration_ms_required': 0.0,
-				'relative_mm_required': 'Retract fully',
-			},
-			{
-				'verb': 'Turn UV light',
-				'target_uv_light': 'Current one',
-				'on_or_off': 'Off',
-			},
-			{
-				'verb': 'Rotate',
-				'target_syringe': target_syringe,
-			},
-			{
-				'verb': 'Turn UV light',
-				'target_uv_light': 'Current one',
-				'on_or_off': 'On'
-			},
-		]
-	elif g_code == 'M83':
-		return [
-			{
-				'verb': 'Actuate',
-				'duration_ms_required': 0.0,
-				'relative_mm_required': 'Go to plunger flange',
-			},
-		]
-	elif g_code == 'G1':
-		relative_mm_required = 0.0
-		x_travel_mm = 0.0
-		y_travel_mm = 0.0
-		z_travel_mm = 0.0
-		feedrate_mm_per_ms = 0.0
-		for i in range(2, len(sys.argv)):
-			if sys.argv[i][0] == 'E':
-				relative_mm_required = float(sys.argv[i][1:])
-			if sys.argv[i][0] == 'X':
-				x_travel_mm = float(sys.argv[i][1:])
-			if sys.argv[i][0] == 'Y':
-				y_travel_mm = float(sys.argv[i][1:])
-			if sys.argv[i][0] == 'Y':
-				z_travel_mm = float(sys.argv[i][1:])
-			if sys.argv[i][0] == 'F':
-				feedrate_mm_per_ms = float(sys.argv[i][1:]) / 60.0 / 1000.0
-		if relative_mm_required == 0.0 or feedrate_mm_per_ms == 0.0:
-			return []
-		diagonal_travel_mm = math.sqrt(
-			x_travel_mm ** 2
-			+ y_travel_mm ** 2
-			+ z_travel_mm ** 2
-		)
-		return [{
-			'verb': 'Actuate',
-			'relative_mm_required': relative_mm_required,
-			'duration_ms_required': diagonal_travel_mm / feedrate_mm_per_ms,
-		}]
-	else:
-		raise Exception(f'Unknown G-code {sys.argv[1]} in bioprintly/request.py')
-
-def sleep_briefly():
-	sleep(0.2)
-
-def submit_request_to_bioprintly(
-	savefolder_path: str,
-	g_code: str,
-	commands: List[CommandSpecifics],
-):
-	request_timestamp = unix_time_ms()
-	request: Request = {
-		'timestamp': request_timestamp,
-		'commands': commands,
-	}
-	json.dump(
-		request,
-		open(f'{savefolder_path}/request.json', 'w'),
-		indent = '\t',
+def submit_request_to_bioprintly(savefolder_path: str, request: Request):
+	if submit_request_over_ipc_socket(savefolder_path, request):
+		return
+	
+	# Time-based sequence numbers keep the spool in request order; the pid
+	# disambiguates requests made in the same nanosecond
+	request_id = f'{time_ns():020d}-{os.getpid()}'
+	request_spool_path = get_request_spool_path(savefolder_path)
+	response_spool_path = get_response_spool_path(savefolder_path)
+	os.makedirs(request_spool_path, exist_ok = True)
+	os.makedirs(response_spool_path, exist_ok = True)
+	write_file_atomically(
+		f'{request_spool_path}/{request_id}.json',
+		json.dumps(request),
 	)
 
-	if g_code == 'G1':
+	if request.get('awaits_completion', True) == False:
 		return
 
+	response_path = f'{response_spool_path}/{request_id}.json'
 	while True:
 		try:
-			response: Response = json.load(open(
-				f'{savefolder_path}/response.json',
-				'r',
-			))
+			response: Response = json.load(open(response_path, 'r'))
 		except:
 			sleep_briefly()
 			continue
+		os.remove(response_path)
+		break
 
-		if response['completed_request_timestamp'] >= request_timestamp:
-			break
-
-		sleep_briefly()
+def submit_request_over_ipc_socket(
+	savefolder_path: str,
+	request: Request,
+) -> bool:
+	'''
+	Blocks until Bioprintly replies. Returns False if Bioprintly isn't
+	listening, in which case the file protocol should be used instead.
+	'''
+	connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		connection.connect(get_ipc_socket_path(savefolder_path))
+	except OSError:
+		connection.close()
+		return False
+	
+	with connection, connection.makefile('rw') as stream:
+		stream.write(json.dumps(request) + '\n')
+		stream.flush()
+		reply = stream.readline()
+	if reply == '':
+		raise Exception('Bioprintly closed the IPC socket without replying')
+	reply_message = json.loads(reply)
+	if 'rejected_request_timestamp' in reply_message:
+		rejection = cast(Rejection, reply_message)
+		raise Exception(f"Bioprintly rejected the request: {rejection['reason']}")
+	return True
 
 def handle_request_from_klipper():
 	savefolder_path = establish_savefolder_path()
@@ -142,10 +75,26 @@ def handle_request_from_klipper():
 	logfile.write('Invoked with argv: ' + str(sys.argv) + '\n')
 
 	g_code = sys.argv[1]
-	commands = build_commands_for_g_code(g_code)
-	logfile.write(f'Built and submitting commands {json.dumps(commands)}')
+	request: Request = {
+		'timestamp': math.floor(time_ns() / 1e6),
+		'commands': [],
+		'awaits_completion': g_code != 'G1',
+	}
+	if g_code == 'ADVANCE':
+		# Sent in place of forwarded lines of a compiled program, e.g.
+		# ADVANCE PROGRAM=<sha256> MARKER=12 AWAIT=0
+		params = dict(param.split('=', 1) for param in sys.argv[2:])
+		request['program_advance'] = {
+			'program_sha256': params['PROGRAM'],
+			'marker': int(params['MARKER']),
+		}
+		request['awaits_completion'] = params.get('AWAIT', '1') != '0'
+	else:
+		request['commands'] = build_commands_for_g_code(g_code, sys.argv[2:])
+	logfile.write(f'Built and submitting request {json.dumps(request)}')
 	logfile.close()
-	if len(commands) > 0:
-		submit_request_to_bioprintly(savefolder_path, g_code, commands)
+	if len(request['commands']) > 0 or 'program_advance' in request:
+		submit_request_to_bioprintly(savefolder_path, request)
 
-handle_request_from_klipper()
+if __name__ == '__main__':
+	handle_request_from_klipper()
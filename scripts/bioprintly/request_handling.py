@@ -1,56 +1,176 @@
+from bisect import bisect_right
+from g_code_compiler import load_compiled_program
 import json
-from state import GlobalState, Request, Response, enqueue_command
-from time import sleep
-from util import unix_time_ms
+from journal import journal_set
+import os
+from pathlib import Path
+from request_protocol import get_request_spool_path, get_response_spool_path, sleep_briefly, write_file_atomically
+from state import CommandSpecifics, GlobalState, PendingResponse, ProgramAdvance, Request, Response, commands_up_to_ordinal_are_finished, enqueue_commands
+from typing import List
 
-def sleep_briefly():
-	sleep(0.2)
+def enqueue_request(state: GlobalState, request: Request) -> int:
+	'''Returns the caboose ordinal, as enqueue_commands does'''
+	with state['nonpersistent']['enqueue_lock']:
+		commands = request['commands']
+		if 'program_advance' in request:
+			commands = commands + take_program_commands(
+				state,
+				request['program_advance'],
+			)
+		return enqueue_commands(state, 'Klipper', commands)
 
-def handle_requests(state: GlobalState):
-	savefolder_path = state['nonpersistent']['savefolder_path']
-	if command_with_caboose_ordinal_is_complete(state):
-		response: Response = {
-			'completed_request_timestamp': state[
-				'request_handling_watermark'
-			],
-		}
-		json.dump(
-			response,
-			open(f'{savefolder_path}/response.json', 'w'),
-			indent = '\t',
+def take_program_commands(
+	state: GlobalState,
+	program_advance: ProgramAdvance,
+) -> List[CommandSpecifics]:
+	'''
+	Advances the program cursor to the end of the given sync marker. Markers
+	that Klipper skipped get caught up on. Markers the cursor has already
+	passed are ignored, since that's Klipper retrying a request, except for the
+	first marker with commands (the first one Klipper is sent, see
+	write_advancing_g_code): that (or switching programs) means a new print, so
+	the cursor restarts there.
+	'''
+	nonpersistent = state['nonpersistent']
+	program_sha256 = program_advance['program_sha256']
+	program = nonpersistent['loaded_program']
+	if program == None or program['source_sha256'] != program_sha256:
+		program = load_compiled_program(
+			nonpersistent['savefolder_path'],
+			program_sha256,
 		)
-		state['request_handling_caboose_ordinal'] = None
-	
-	try:
-		request: Request | None = json.load(open(
-			f"{savefolder_path}/request.json",
-			'r',
-		))
-	except:
-		request: Request | None = None
-	
+		if program == None:
+			raise Exception(f'No compiled program {program_sha256} (run g_code_compiler.py on the G-code file first)')
+		nonpersistent['loaded_program'] = program
+
+	sync_markers = program['sync_markers']
+	marker = program_advance['marker']
+	if not 0 <= marker < len(sync_markers):
+		raise Exception(f'Sync marker {marker} out of range for program {program_sha256}')
+	marker_start = 0 if marker == 0 else sync_markers[marker - 1]['command_count']
+	marker_end = sync_markers[marker]['command_count']
+
+	cursor = state['program_cursor']
+	first_marker_with_commands = bisect_right(
+		sync_markers,
+		0,
+		key = lambda sync_marker: sync_marker['command_count'],
+	)
 	if (
-		request != None
-		and request['timestamp'] > state['request_handling_watermark']
+		cursor == None
+		or cursor['program_sha256'] != program_sha256
+		or (
+			marker <= first_marker_with_commands
+			and cursor['next_command_index'] > marker_end
+		)
 	):
-		print(f'Received request from Klipper: {json.dumps(request)}')
+		next_command_index = marker_start
+	elif cursor['next_command_index'] >= marker_end:
+		return []
+	else:
+		next_command_index = cursor['next_command_index']
+
+	state['program_cursor'] = {
+		'program_sha256': program_sha256,
+		'next_command_index': marker_end,
+		'command_count': len(program['commands']),
+	}
+	journal_set(state, 'program_cursor')
+	return program['commands'][next_command_index:marker_end]
+
+def klipper_job_is_in_progress(state: GlobalState) -> bool:
+	'''
+	While Klipper awaits a request or is partway through a compiled program.
+	A cancelled print counts as in progress until the next one gets going.
+	'''
+	cursor = state['program_cursor']
+	return (
+		len(state['request_handling_pending_responses']) > 0
+		or (
+			cursor != None
+			and cursor['next_command_index'] < cursor['command_count']
+		)
+	)
 
-		caboose_ordinal = None
-		for command in request['commands']:
-			caboose_ordinal = enqueue_command(state, 'Klipper', command)
-		state['request_handling_caboose_ordinal'] = caboose_ordinal
-		state['request_handling_watermark'] = request['timestamp']
-	
-	state['nonpersistent']['request_handling_last_poll'] = unix_time_ms()
-
-
-def command_with_caboose_ordinal_is_complete(state) -> bool:
-	caboose_ordinal = state['request_handling_caboose_ordinal']
-	if caboose_ordinal == None:
-		return False
-	for finished_command in reversed(state['command_history']):
-		if finished_command['ordinal'] < caboose_ordinal:
-			return False
-		elif finished_command['ordinal'] == caboose_ordinal:
-			return True
-	return False
+def run_request_spool(state: GlobalState):
+	'''
+	Fallback for when request.py can't reach the IPC socket. Runs as its own
+	thread so the service loop never touches the filesystem.
+	'''
+	savefolder_path = state['nonpersistent']['savefolder_path']
+	Path(get_request_spool_path(savefolder_path)).mkdir(exist_ok = True)
+	Path(get_response_spool_path(savefolder_path)).mkdir(exist_ok = True)
+
+	while state['nonpersistent']['shutting_down'] == False:
+		handle_requests(state)
+		sleep_briefly()
+
+def handle_requests(state: GlobalState):
+	nonpersistent = state['nonpersistent']
+	savefolder_path = nonpersistent['savefolder_path']
+
+	pending_responses = state['request_handling_pending_responses']
+	still_pending: list[PendingResponse] = []
+	for pending_response in pending_responses:
+		if commands_up_to_ordinal_are_finished(
+			state,
+			pending_response['caboose_ordinal'],
+		):
+			response: Response = {
+				'completed_request_timestamp': pending_response['timestamp'],
+			}
+			write_file_atomically(
+				f"{get_response_spool_path(savefolder_path)}/{pending_response['request_id']}.json",
+				json.dumps(response),
+			)
+		else:
+			still_pending.append(pending_response)
+	if len(still_pending) != len(pending_responses):
+		state['request_handling_pending_responses'] = still_pending
+		journal_set(state, 'request_handling_pending_responses')
+
+	# Filenames start with a zero-padded sequence number, so sorting them
+	# drains the spool in the order requests were made
+	request_filenames = sorted(filter(
+		lambda filename: filename.endswith('.json') and not filename.startswith('.'),
+		os.listdir(get_request_spool_path(savefolder_path)),
+	))
+	for request_filename in request_filenames:
+		request_path = f'{get_request_spool_path(savefolder_path)}/{request_filename}'
+		request_id = request_filename.removesuffix('.json')
+		try:
+			request: Request = json.load(open(request_path, 'r'))
+		except (OSError, json.JSONDecodeError):
+			print(f'Dropping unreadable spooled request {request_filename}')
+			nonpersistent['request_spool_dropped'] += 1
+			os.replace(request_path, f'{request_path}.rejected')
+			continue
+
+		if request_id in state['request_handling_recent_request_ids']:
+			print(f'Ignoring duplicate spooled request {request_filename}')
+			nonpersistent['request_spool_duplicates'] += 1
+			os.remove(request_path)
+			continue
+
+		print(f'Received request from Klipper: {json.dumps(request)}')
+		try:
+			caboose_ordinal = enqueue_request(state, request)
+		except Exception as error:
+			print(f'Rejecting spooled request {request_filename}: {error}')
+			nonpersistent['request_spool_dropped'] += 1
+			os.replace(request_path, f'{request_path}.rejected')
+			continue
+		if request.get('awaits_completion', True) == True:
+			state['request_handling_pending_responses'].append({
+				'request_id': request_id,
+				'timestamp': request['timestamp'],
+				'caboose_ordinal': caboose_ordinal,
+			})
+			journal_set(state, 'request_handling_pending_responses')
+		state['request_handling_recent_request_ids'] = (
+			state['request_handling_recent_request_ids'] + [request_id]
+		)[-100:]
+		journal_set(state, 'request_handling_recent_request_ids')
+		nonpersistent['request_spool_received'] += 1
+		# Removing the spooled file is the acknowledgment
+		os.remove(request_path)
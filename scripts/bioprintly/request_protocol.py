@@ -0,0 +1,43 @@
+'''
+Where and how requests are exchanged with request.py. Kept free of Tk and
+state management imports so that request.py starts quickly.
+'''
+import os
+from os import environ
+from time import sleep
+
+def establish_savefolder_path() -> str:
+	if environ.get('XDG_DATA_DIR'):
+		savefolder_base = f"{environ.get('XDG_DATA_DIR')}/"
+	elif environ.get('HOME'):
+		savefolder_base = f"{environ.get('HOME')}/."
+	elif environ.get('APPDATA'):
+		savefolder_base = f"{environ.get('APPDATA')}/"
+	else:
+		raise Exception(f'User directory not found as any of these env vars: XDG_DATA_DIR, HOME, APPDATA')
+	savefolder_path = f'{savefolder_base}bioprintly'
+	os.makedirs(savefolder_path, exist_ok = True)
+	return savefolder_path
+
+def get_ipc_socket_path(savefolder_path: str) -> str:
+	return f'{savefolder_path}/bioprintly.sock'
+
+def get_request_spool_path(savefolder_path: str) -> str:
+	return f'{savefolder_path}/request_spool'
+
+def get_response_spool_path(savefolder_path: str) -> str:
+	return f'{savefolder_path}/response_spool'
+
+def write_file_atomically(path: str, content: str):
+	'''
+	Writes to a dotfile first, which spool readers skip, then renames it into
+	place so readers never see a partial file.
+	'''
+	directory, filename = os.path.split(path)
+	temporary_path = f'{directory}/.{filename}.tmp'
+	with open(temporary_path, 'w') as temporary_file:
+		temporary_file.write(content)
+	os.replace(temporary_path, path)
+
+def sleep_briefly():
+	sleep(0.2)
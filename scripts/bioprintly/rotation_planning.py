@@ -0,0 +1,86 @@
+'''
+Plans barrel rotations. Tool changes take the shorter way round, so long as
+the wiring to the barrel stays within its winding limit. Winding is tracked
+cumulatively from the steps emitted, and unwound while the queue sits idle.
+'''
+from __future__ import annotations
+from commands import SyringeNumber
+from journal import journal_set
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+	from state import GlobalState, NonPersistentState
+
+DEGREES_PER_SYRINGE = -90.0
+'''Going up one syringe number turns the barrel this way'''
+WINDING_SLACK_DEGREES = 0.5
+'''Covers the rounding of winding to whole steps'''
+
+def get_clearance_position_mm(nonpersistent: NonPersistentState) -> float:
+	'''Where Retract to clearance stops: inside the clearance by the safety margin'''
+	return (
+		nonpersistent['rotator_actuator_clearance_mm']
+		* (1 - nonpersistent['safety_margin'])
+	)
+
+def get_home_winding_degrees(syringe: SyringeNumber) -> float:
+	'''Winding at each syringe back when every rotation went the same way round'''
+	return (syringe - 1) * DEGREES_PER_SYRINGE
+
+def get_barrel_winding_degrees(state: GlobalState) -> float | None:
+	if state['barrel_winding_degrees'] != None:
+		return state['barrel_winding_degrees']
+	if state['current_syringe'] == None:
+		return None
+	return get_home_winding_degrees(state['current_syringe'])
+
+def plan_rotation_degrees(
+	current_syringe: SyringeNumber,
+	target_syringe: SyringeNumber,
+	winding_degrees: float,
+	winding_limit_degrees: float,
+) -> float:
+	'''
+	The shorter way round that keeps the winding within the limit. A half turn
+	goes whichever way unwinds. Should neither way stay within the limit, the
+	one that ends up less wound is taken.
+	'''
+	shorter_degrees = (
+		((target_syringe - current_syringe) * DEGREES_PER_SYRINGE + 180.0)
+		% 360.0
+		- 180.0
+	)
+	if shorter_degrees == 0.0:
+		return 0.0
+	candidates = [
+		shorter_degrees,
+		shorter_degrees + 360.0 if shorter_degrees < 0.0 else shorter_degrees - 360.0,
+	]
+	within_limit = [
+		degrees for degrees in candidates
+		if abs(winding_degrees + degrees) <= winding_limit_degrees + WINDING_SLACK_DEGREES
+	]
+	if len(within_limit) == 0:
+		return min(candidates, key = lambda degrees: abs(winding_degrees + degrees))
+	return min(
+		within_limit,
+		key = lambda degrees: (abs(degrees), abs(winding_degrees + degrees)),
+	)
+
+def plan_unwinding_degrees(winding_degrees: float) -> float:
+	'''A full turn back towards zero, if that leaves the barrel less wound'''
+	if abs(winding_degrees) <= 180.0 + WINDING_SLACK_DEGREES:
+		return 0.0
+	return -360.0 if winding_degrees > 0.0 else 360.0
+
+def record_current_syringe(state: GlobalState, syringe: SyringeNumber):
+	'''
+	For calibration. Winding is only kept when the syringe matches the one
+	Bioprintly believed was current; otherwise the barrel is taken to be at
+	that syringe's home winding.
+	'''
+	if syringe != state['current_syringe']:
+		state['barrel_winding_degrees'] = None
+		journal_set(state, 'barrel_winding_degrees')
+	state['current_syringe'] = syringe
+	journal_set(state, 'current_syringe')
@@ -1,54 +1,113 @@
-from tkinter import messagebox
-from typing import Any, Callable, Dict, cast
-from pins import flip_bit, read_pin, write_pin, zero_out_pins
-from request_handling import handle_requests
-import random
-from state import CommandActuate, CommandRotate, CommandSpecifics, CommandTurnHeatingPad, CommandTurnUvLight, EnqueuedCommand, FinishedCommand, GlobalState, NonPersistentState, SyringeNumber, on_off_string_to_bit, save_state_to_disk, calibration_is_complete
-from time import sleep
+from command_scheduling import find_runnable_commands
+from copy import deepcopy
+from typing import Any, Callable, Dict, Set, cast
+from journal import COMMAND_HISTORY_LENGTH, PROGRESS_KEYS, append_to_journal, bump_state_version, journal_set, stop_state_writer
+from notifications import notify_operator
+from motion_core import set_motion_duty_cycle, start_pulse_train, stop_motion_core, stop_motion_pwm, sync_motion_core_control, sync_pulse_train, take_motion_on_time_ms, zero_out_motion_pins
+from pins import write_pin
+from request_handling import klipper_job_is_in_progress
+from rotation_planning import get_barrel_winding_degrees, get_clearance_position_mm, plan_rotation_degrees, plan_unwinding_degrees
+from state import CommandActuate, CommandBarrier, CommandRotate, CommandSpecifics, CommandTurnHeatingPad, CommandTurnUvLight, EnqueuedCommand, FinishedCommand, GlobalState, NonPersistentState, SyringeNumber, on_off_string_to_bit, calibration_is_complete, enqueue_commands
+from step_pulses import plan_trapezoidal_step_times
+from time import monotonic_ns
+from timing import monotonic_ms, sleep_until_ns
 from util import signum, this_action_would_put_it_further_away_from_target_than_it_is_now, unix_time_ms
 
+POSITION_JOURNALING_INTERVAL_MS = 2000
+
 def run_service(state: GlobalState):
+	'''
+	Ticks every processing interval while there are commands to process, and
+	otherwise waits until woken by wake_service_threads or there's upkeep due
+	'''
 	nonpersistent = state['nonpersistent']
+	nonpersistent['processing_loop_last_start_ns'] = monotonic_ns()
 	while nonpersistent['shutting_down'] == False:
+		tick_start_ns = monotonic_ns()
 		nonpersistent['processing_loop_measured_delta'] = (
-			unix_time_ms() - nonpersistent['processing_loop_last_start']
-		)
-		nonpersistent['processing_loop_last_start'] = unix_time_ms()
+			tick_start_ns - nonpersistent['processing_loop_last_start_ns']
+		) / 1e6
+		nonpersistent['processing_loop_last_start_ns'] = tick_start_ns
+		# Processing gets paused from all over, so the motion core hears of it here
+		sync_motion_core_control(state)
 		
-		if unix_time_ms() >= nonpersistent['request_handling_last_poll'] + 200:
-			handle_requests(state)
-			
 		if nonpersistent['processing_enabled'] == True:
 			process_commands(state)
+		if nonpersistent['processing_enabled'] == True:
+			# Unless processing was just paused, e.g. for missing calibration
+			unwind_barrel_when_idle(state)
+		else:
+			# Time spent paused doesn't count as idle
+			nonpersistent['queue_last_busy'] = monotonic_ms()
 		
-		if unix_time_ms() >= nonpersistent['savefile_last_write'] + 2000:
-			save_state_to_disk(state)
+		if monotonic_ms() >= (
+			nonpersistent['position_last_journaled']
+			+ POSITION_JOURNALING_INTERVAL_MS
+		):
+			journal_positions(state)
 		
-		sleep(max(0,
-			nonpersistent['processing_loop_interval_ms']
-			- (unix_time_ms() - nonpersistent['processing_loop_last_start'])
-		) / 1e3)
+		# Cleared before checking for work, so a wakeup can't slip in between
+		nonpersistent['service_wakeup_event'].clear()
+		idle_wait_ms = get_idle_wait_ms(state)
+		if idle_wait_ms == None:
+			sleep_until_ns(
+				tick_start_ns
+				+ round(nonpersistent['processing_loop_interval_ms'] * 1e6)
+			)
+			continue
+		
+		was_paused = nonpersistent['processing_enabled'] == False
+		nonpersistent['service_wakeup_event'].wait(idle_wait_ms / 1e3)
+		# Time spent waiting is neither a processing interval nor idle queue time
+		nonpersistent['processing_loop_last_start_ns'] = (
+			monotonic_ns()
+			- round(nonpersistent['processing_loop_interval_ms'] * 1e6)
+		)
+		if was_paused:
+			nonpersistent['queue_last_busy'] = monotonic_ms()
 	
-	zero_out_pins(state)
-	save_state_to_disk(state)
+	zero_out_motion_pins(state)
+	stop_motion_core(state)
+	journal_positions(state)
+	stop_state_writer(state)
+
+def get_idle_wait_ms(state: GlobalState) -> float | None:
+	'''
+	None while there are commands to process, otherwise how long until the
+	positions are due to be journaled or the barrel due to be unwound
+	'''
+	nonpersistent = state['nonpersistent']
+	now = monotonic_ms()
+	wait_ms = (
+		nonpersistent['position_last_journaled']
+		+ POSITION_JOURNALING_INTERVAL_MS
+		- now
+	)
+	if nonpersistent['processing_enabled'] == True:
+		if len(state['command_queue']) > 0:
+			return None
+		unwinding_due = (
+			nonpersistent['queue_last_busy']
+			+ nonpersistent['barrel_unwinding_idle_ms']
+		)
+		if unwinding_due > now:
+			wait_ms = min(wait_ms, unwinding_due - now)
+	return max(0, wait_ms)
 
 def process_commands(state: GlobalState):
 	if not calibration_is_complete(state):
 		state['nonpersistent']['processing_enabled'] = False
-		messagebox.showwarning(
-			message = 'Calibration is missing one or more values',
-			detail = 'Please click the calibrate button at the top of the UI.',
+		notify_operator(
+			state,
+			'Warning',
+			'Calibration is missing one or more values',
+			'Please click the calibrate button at the top of the UI.',
 		)
 		return
 	
 	if len(state['command_queue']) == 0:
 		return
 	
-	active_command = state['command_queue'][0]
-	if not 'started_at' in active_command:
-		active_command['started_at'] = unix_time_ms()
-	
-	specifics = active_command['specifics']
 	processing_functions: Dict[
 		str,
 		Callable[[GlobalState, NonPersistentState, EnqueuedCommand, Any], None]
@@ -57,25 +116,123 @@ def process_commands(state: GlobalState):
 		'Actuate': actuate_one_interval,
 		'Turn heating pad': turn_heating_pad,
 		'Turn UV light': turn_uv_light,
+		'Barrier': pass_barrier,
 	}
-	if not specifics['verb'] in processing_functions:
-		raise Exception(f"Tried to process unknown command {specifics['verb']}")
+	# Commands that finish right away can unblock others, so keep going until
+	# nothing new can run; each command still gets one interval per tick
+	processed_ordinals: Set[int] = set()
+	while state['nonpersistent']['processing_enabled'] == True:
+		# Starting under the lock means enqueueing never drops or fuses into a
+		# command that has started
+		with state['nonpersistent']['enqueue_lock']:
+			active_commands = list(filter(
+				lambda command: command['ordinal'] not in processed_ordinals,
+				find_runnable_commands(state),
+			))
+			for active_command in active_commands:
+				if not 'started_at' in active_command:
+					active_command['started_at'] = unix_time_ms()
+					append_to_journal(state, {
+						'op': 'Start',
+						'ordinal': active_command['ordinal'],
+						'started_at': active_command['started_at'],
+					})
+		if len(active_commands) == 0:
+			break
+		
+		for active_command in active_commands:
+			processed_ordinals.add(active_command['ordinal'])
+			specifics = active_command['specifics']
+			if not specifics['verb'] in processing_functions:
+				raise Exception(f"Tried to process unknown command {specifics['verb']}")
+			
+			processing_functions[specifics['verb']](
+				state,
+				state['nonpersistent'],
+				active_command,
+				specifics
+			)
+			if state['nonpersistent']['processing_enabled'] == False:
+				# E.g. the actuator reached its maximum safe distance
+				break
 	
-	processing_functions[specifics['verb']](
-		state,
-		state['nonpersistent'],
-		active_command,
-		specifics
-	)
+	if len(processed_ordinals) > 0:
+		# Progress is filled in every tick but only journaled now and then, so
+		# the GUI has to hear of it some other way
+		bump_state_version(state, 'command_queue')
+	flush_finished_commands(state)
 
-def finish_active_task(state: GlobalState):
-	state['command_queue'][0]['finished_at'] = unix_time_ms()
-	state['command_history'].append(
-		cast(FinishedCommand, state['command_queue'][0])
-	)
-	state['command_history'] = state['command_history'][-50:]
-	state['command_queue'] = state['command_queue'][1:]
-	save_state_to_disk(state)
+def finish_command(state: GlobalState, command: EnqueuedCommand):
+	'''
+	Frees the command's resources right away. The queue, history and journal
+	catch up once per tick, in flush_finished_commands.
+	'''
+	finished_command = cast(FinishedCommand, command)
+	finished_command['finished_at'] = unix_time_ms()
+	state['nonpersistent']['finished_commands_pending'].append(finished_command)
+
+def flush_finished_commands(state: GlobalState):
+	nonpersistent = state['nonpersistent']
+	finished_commands = nonpersistent['finished_commands_pending']
+	if len(finished_commands) == 0:
+		return
+	nonpersistent['finished_commands_pending'] = []
+	state['command_history'] = (
+		state['command_history'] + finished_commands
+	)[-COMMAND_HISTORY_LENGTH:]
+	# Enqueueing may drop the queue's tail, so don't race it
+	with nonpersistent['enqueue_lock']:
+		state['command_queue'] = list(filter(
+			lambda queued_command: not 'finished_at' in queued_command,
+			state['command_queue'],
+		))
+	append_to_journal(state, {
+		'op': 'Finish',
+		'commands': finished_commands,
+	})
+	journal_positions(state)
+	with nonpersistent['command_finished_condition']:
+		nonpersistent['command_finished_condition'].notify_all()
+
+def journal_positions(state: GlobalState):
+	'''
+	Positions change every interval while motors run, so they're journaled when
+	commands finish and periodically rather than on every change. So is how far
+	each started command has got, which has to match the positions on replay.
+	'''
+	nonpersistent = state['nonpersistent']
+	journaled_positions = nonpersistent['journaled_positions']
+	for key in [
+		'current_syringe',
+		'actuator_position_mm',
+		'plunger_positions_mm',
+		'barrel_winding_degrees',
+	]:
+		if key in journaled_positions and journaled_positions[key] == state[key]:
+			continue
+		journal_set(state, key)
+		journaled_positions[key] = deepcopy(state[key])
+	
+	journaled_progress = nonpersistent['journaled_progress']
+	progress_by_ordinal: Dict[int, Dict[str, Any]] = {}
+	# Only commands in the scheduling window are ever started
+	for command in state['command_queue'][:nonpersistent['command_scheduling_window']]:
+		if not 'started_at' in command or 'finished_at' in command:
+			continue
+		progress = {
+			key: value
+			for key, value in command['specifics'].items()
+			if key in PROGRESS_KEYS
+		}
+		progress_by_ordinal[command['ordinal']] = progress
+		if journaled_progress.get(command['ordinal']) != progress:
+			append_to_journal(state, {
+				'op': 'Progress',
+				'ordinal': command['ordinal'],
+				'progress': progress,
+			})
+	nonpersistent['journaled_progress'] = progress_by_ordinal
+	nonpersistent['position_last_journaled'] = monotonic_ms()
 
 def rotate_one_interval(
 	state: GlobalState,
@@ -83,50 +240,135 @@ def rotate_one_interval(
 	active_command: EnqueuedCommand,
 	specifics: CommandRotate,
 ):
-	if cast(float, state['actuator_position_mm']) > 10.0:
+	if cast(float, state['actuator_position_mm']) > nonpersistent['rotator_actuator_clearance_mm']:
 		state['nonpersistent']['processing_enabled'] = False
-		messagebox.showwarning(
-			message = f'Attempted to rotate barrel but actuator is {state["actuator_position_mm"]} mm extended',
-			detail = 'Processing has been paused. Please retract the actuator before attempting rotation.',
+		notify_operator(
+			state,
+			'Warning',
+			f'Attempted to rotate barrel but actuator is {state["actuator_position_mm"]} mm extended',
+			'Processing has been paused. Please retract the actuator before attempting rotation.',
 		)
 		return
 		
 	if not 'relative_degrees_required' in specifics:
-		specifics['relative_degrees_required'] = (
-			specifics['target_syringe']
-			- cast(SyringeNumber, state['current_syringe'])
-		) * -90.0
+		specifics['relative_degrees_required'] = plan_rotation_degrees(
+			cast(SyringeNumber, state['current_syringe']),
+			specifics['target_syringe'],
+			cast(float, get_barrel_winding_degrees(state)),
+			nonpersistent['barrel_winding_limit_degrees'],
+		)
 	if not 'relative_degrees_traveled' in specifics:
 		specifics['relative_degrees_traveled'] = 0.0
-	if specifics['relative_degrees_required'] == 0.0:
-		finish_active_task(state)
-		return
 	
-	expected_travel_degrees = (
-		signum(specifics['relative_degrees_required'])
-		# Stepper motor steps only count the rising edge
-		* 0.5 * nonpersistent['rotator_degrees_per_step']
-	)
+	direction = signum(specifics['relative_degrees_required'])
+	pulse_train = nonpersistent['rotator_pulse_train']
+	if pulse_train != None and pulse_train['ordinal'] != active_command['ordinal']:
+		# Left over from a command that was deleted while paused
+		pulse_train = nonpersistent['rotator_pulse_train'] = None
+	if pulse_train != None:
+		sync_pulse_train(state, pulse_train)
+		steps_emitted = pulse_train['steps_emitted']
+		traveled_degrees = (
+			direction
+			* (steps_emitted - pulse_train['steps_accounted_for'])
+			* nonpersistent['rotator_degrees_per_step']
+		)
+		specifics['relative_degrees_traveled'] += traveled_degrees
+		state['barrel_winding_degrees'] = (
+			cast(float, get_barrel_winding_degrees(state)) + traveled_degrees
+		)
+		pulse_train['steps_accounted_for'] = steps_emitted
+		if pulse_train['finished'] == False:
+			return
+		nonpersistent['rotator_pulse_train'] = None
 	
-	if this_action_would_put_it_further_away_from_target_than_it_is_now(
-		specifics['relative_degrees_traveled'],
-		expected_travel_degrees,
-		specifics['relative_degrees_required'],
-	):
+	steps_remaining = round(abs(
+		specifics['relative_degrees_required']
+		- specifics['relative_degrees_traveled']
+	) / nonpersistent['rotator_degrees_per_step'])
+	if steps_remaining == 0:
 		state['current_syringe'] = specifics['target_syringe']
-		finish_active_task(state)
+		finish_command(state, active_command)
 		return
 	
-	write_pin(state, 'rotator_direction', (
-		0
-		if specifics['relative_degrees_required'] >= 0
-		else 1
-	))
-	write_pin(state, 'rotator_step', flip_bit(
-		read_pin(state, 'rotator_step')
-	))
-	
-	specifics['relative_degrees_traveled'] += expected_travel_degrees
+	write_pin(state, 'rotator_direction', 0 if direction >= 0 else 1)
+	pulse_train = nonpersistent['rotator_pulse_train'] = {
+		'ordinal': active_command['ordinal'],
+		'step_times_s': plan_trapezoidal_step_times(
+			steps_remaining,
+			nonpersistent['rotator_max_steps_per_s'],
+			nonpersistent['rotator_acceleration_steps_per_s2'],
+		),
+		'steps_emitted': 0,
+		'steps_accounted_for': 0,
+		'finished': False,
+	}
+	start_pulse_train(state, pulse_train)
+
+def unwind_barrel_when_idle(state: GlobalState):
+	'''
+	Takes a full turn out of the barrel's winding once the queue has sat empty
+	for a while, so that later tool changes are free to go the shorter way. The
+	UV light and actuator are put back as they were afterwards. Never during a
+	Klipper job, where an idle queue is just a gap in extrusion.
+	'''
+	nonpersistent = state['nonpersistent']
+	if not calibration_is_complete(state):
+		return
+	with nonpersistent['enqueue_lock']:
+		if (
+			len(state['command_queue']) > 0
+			or klipper_job_is_in_progress(state)
+		):
+			nonpersistent['queue_last_busy'] = monotonic_ms()
+			return
+		if monotonic_ms() < (
+			nonpersistent['queue_last_busy']
+			+ nonpersistent['barrel_unwinding_idle_ms']
+		):
+			return
+		winding_degrees = get_barrel_winding_degrees(state)
+		if winding_degrees == None:
+			return
+		unwinding_degrees = plan_unwinding_degrees(winding_degrees)
+		if unwinding_degrees == 0.0:
+			return
+		
+		current_syringe = cast(SyringeNumber, state['current_syringe'])
+		# Idle is a cheap time to bottom out, which re-zeroes dead reckoning
+		actuator_was_extended = cast(float, state['actuator_position_mm']) > 0
+		uv_light_was_on = state['pins'][f'uv_light_{current_syringe}']['value'] == 1
+		commands: list[CommandSpecifics] = []
+		if actuator_was_extended:
+			commands.append({
+				'verb': 'Actuate',
+				'duration_ms_required': 0.0,
+				'relative_mm_required': 'Retract fully',
+			})
+		if uv_light_was_on:
+			commands.append({
+				'verb': 'Turn UV light',
+				'target_uv_light': 'Current one',
+				'on_or_off': 'Off',
+			})
+		commands.append({
+			'verb': 'Rotate',
+			'target_syringe': current_syringe,
+			'relative_degrees_required': unwinding_degrees,
+		})
+		if actuator_was_extended:
+			commands.append({
+				'verb': 'Actuate',
+				'duration_ms_required': 0.0,
+				'relative_mm_required': 'Go to plunger flange',
+			})
+		if uv_light_was_on:
+			commands.append({
+				'verb': 'Turn UV light',
+				'target_uv_light': 'Current one',
+				'on_or_off': 'On',
+			})
+		enqueue_commands(state, 'Bioprintly', commands)
 
 def actuate_one_interval(
 	state: GlobalState,
@@ -134,12 +376,23 @@ def actuate_one_interval(
 	active_command: EnqueuedCommand,
 	specifics: CommandActuate
 ):
+	if specifics['relative_mm_required'] == 'Retract to clearance' and (
+		nonpersistent['actuator_travel_since_zero_mm']
+		>= nonpersistent['actuator_rezero_travel_mm']
+	):
+		specifics['relative_mm_required'] = 'Retract fully'
 	if specifics['relative_mm_required'] == 'Retract fully':
 		specifics['relative_mm_required'] = (
 			cast(float, state['actuator_position_mm'])
 			* (1 + nonpersistent['safety_margin'])
 			* -1
 		)
+	elif specifics['relative_mm_required'] == 'Retract to clearance':
+		specifics['relative_mm_required'] = min(
+			0.0,
+			get_clearance_position_mm(nonpersistent)
+			- cast(float, state['actuator_position_mm']),
+		)
 	elif specifics['relative_mm_required'] == 'Go to plunger flange':
 		specifics['relative_mm_required'] = (
 			state['plunger_positions_mm'][str(state['current_syringe'])]
@@ -148,7 +401,14 @@ def actuate_one_interval(
 	if not 'relative_mm_traveled' in specifics:
 		specifics['relative_mm_traveled'] = 0.0
 	if specifics['relative_mm_required'] == 0.0:
-		finish_active_task(state)
+		finish_command(state, active_command)
+		return
+	
+	tally_actuator_travel(state, specifics)
+	
+	if cast(float, state['actuator_position_mm']) < 0:
+		stop_actuator(state, specifics)
+		finish_command(state, active_command)
 		return
 	
 	duration_ms_at_full_power = (
@@ -174,12 +434,15 @@ def actuate_one_interval(
 		expected_travel_mm,
 		specifics['relative_mm_required'],
 	):
-		write_pin(state, 'actuator_retract', 0)
-		write_pin(state, 'actuator_extend', 0)
-		state['plunger_positions_mm'][str(state['current_syringe'])] = (
-			cast(float, state['actuator_position_mm'])
-		)
-		finish_active_task(state)
+		stop_actuator(state, specifics)
+		if specifics['relative_mm_required'] > 0:
+			# Retracting leaves the plunger behind; extending past it pushes it
+			plunger_key = str(state['current_syringe'])
+			state['plunger_positions_mm'][plunger_key] = max(
+				state['plunger_positions_mm'][plunger_key],
+				cast(float, state['actuator_position_mm']),
+			)
+		finish_command(state, active_command)
 		return
 	
 	if (
@@ -189,35 +452,49 @@ def actuate_one_interval(
 		nonpersistent['actuator_max_possible_extension_mm']
 		* (1 - nonpersistent['safety_margin'])
 	):
+		stop_actuator(state, specifics)
 		nonpersistent['processing_enabled'] = False
-		messagebox.showerror(
-			message = 'Actuator has reached the maximum safe distance programmed. You may have run out of material in the current syringe.',
-			detail = 'To continue, open the calibration window, home the actuator, and re-calibrate the current syringe to a position where it has more material.',
+		notify_operator(
+			state,
+			'Error',
+			'Actuator has reached the maximum safe distance programmed. You may have run out of material in the current syringe.',
+			'To continue, open the calibration window, home the actuator, and re-calibrate the current syringe to a position where it has more material.',
 		)
 		return
+	
+	set_motion_duty_cycle(
+		state,
+		(
+			'actuator_extend'
+			if signum(specifics['relative_mm_required']) == 1
+			else 'actuator_retract'
+		),
+		pwm_on_percent,
+	)
 
-	pwm_value = (
-		0 if random.uniform(0.0, 1.0) > pwm_on_percent
-		else 1
+def tally_actuator_travel(state: GlobalState, specifics: CommandActuate):
+	'''Dead-reckons travel from how long the PWM engine held each pin high'''
+	traveled_mm = state['nonpersistent']['actuator_travel_mm_per_ms'] * (
+		take_motion_on_time_ms(state, 'actuator_extend')
+		- take_motion_on_time_ms(state, 'actuator_retract')
+	)
+	specifics['relative_mm_traveled'] = (
+		cast(float, specifics['relative_mm_traveled']) + traveled_mm
 	)
-	
-	if signum(specifics['relative_mm_required']) == 1:
-		write_pin(state, 'actuator_extend', pwm_value)
-	else:
-		write_pin(state, 'actuator_retract', pwm_value)
-	
-	specifics['relative_mm_traveled'] += expected_travel_mm
 	state['actuator_position_mm'] = (
-		cast(float, state['actuator_position_mm'])
-		+ expected_travel_mm
+		cast(float, state['actuator_position_mm']) + traveled_mm
 	)
+	state['nonpersistent']['actuator_travel_since_zero_mm'] += abs(traveled_mm)
 
+def stop_actuator(state: GlobalState, specifics: CommandActuate):
+	stop_motion_pwm(state, 'actuator_extend')
+	stop_motion_pwm(state, 'actuator_retract')
+	# Count the travel since the last tally, up until the pins went low
+	tally_actuator_travel(state, specifics)
 	if cast(float, state['actuator_position_mm']) < 0:
+		# Bottomed out, so the position is exact again
 		state['actuator_position_mm'] = 0
-		write_pin(state, 'actuator_retract', 0)
-		write_pin(state, 'actuator_extend', 0)
-		finish_active_task(state)
-		return
+		state['nonpersistent']['actuator_travel_since_zero_mm'] = 0.0
 
 def turn_heating_pad(
 	state: GlobalState,
@@ -235,7 +512,16 @@ def turn_heating_pad(
 		f'heating_pad_{target_heating_pad}',
 		on_off_string_to_bit(specifics['on_or_off']),
 	)
-	finish_active_task(state)
+	finish_command(state, active_command)
+
+def pass_barrier(
+	state: GlobalState,
+	nonpersistent: NonPersistentState,
+	active_command: EnqueuedCommand,
+	specifics: CommandBarrier,
+):
+	'''Only ever runnable once everything enqueued before it has finished'''
+	finish_command(state, active_command)
 
 def turn_uv_light(
 	state: GlobalState,
@@ -253,4 +539,4 @@ def turn_uv_light(
 		f'uv_light_{target_uv_light}',
 		on_off_string_to_bit(specifics['on_or_off']),
 	)
-	finish_active_task(state)
+	finish_command(state, active_command)
@@ -1,46 +1,36 @@
-from copy import copy
-import json
-from os import environ
+from __future__ import annotations
+from commands import Acknowledgment, CommandActuate, CommandBarrier, CommandRotate, CommandSpecifics, CommandTurnHeatingPad, CommandTurnUvLight, Enqueuer, OnOff, ProgramAdvance, Rejection, Request, Response, SyringeNumber
+from g_code_compiler import CompiledProgram
+from journal import JournalEntry, append_to_journal, journal_set, read_snapshot_and_journal, start_state_journal
+from motion_core import MotionCore, sync_motion_core_control
+from notifications import Notification, NotificationSink, log_notification, notify_operator
 import os
-from pathlib import Path
+from request_protocol import establish_savefolder_path, get_ipc_socket_path
+from state_snapshot import JournalTail, StateSnapshot
 import subprocess
-from tkinter import Tk, Toplevel, messagebox
-from typing import Any, Callable, Dict, List, Literal, NotRequired, TypedDict, cast, get_args
-from util import unix_time_ms
-from pins import Bit, PinMappings
+from queue import Queue
+from threading import Condition, Event, Lock, RLock
+from time import monotonic_ns
+from timing import LoopDeltas, create_loop_deltas, monotonic_ms
+from typing import Any, Callable, Dict, List, Literal, NotRequired, Sequence, TypedDict, cast, get_args, TYPE_CHECKING
+from util import signum, unix_time_ms
+from peephole import TailPrediction, apply_command, command_is_redundant, drop_queue_tail, get_tail_prediction, remember_tail_prediction, supersedes_queue_tail
+from pins import Bit, PinMappings, PwmChannel
+from step_pulses import PulseTrain
 
-SyringeNumber = Literal[1, 2, 3, 4]
-OnOff = Literal['On', 'Off']
-Enqueuer = Literal['Klipper', 'Operator']
-
-class CommandRotate(TypedDict):
-	verb: Literal['Rotate']
-	target_syringe: SyringeNumber
-	relative_degrees_required: NotRequired[float]
-	relative_degrees_traveled: NotRequired[float]
-class CommandActuate(TypedDict):
-	verb: Literal['Actuate']
-	duration_ms_required: float
-	relative_mm_required: float | Literal['Retract fully', 'Go to plunger flange']
-	relative_mm_traveled: NotRequired[float]
-class CommandTurnHeatingPad(TypedDict):
-	verb: Literal['Turn heating pad']
-	target_heating_pad: SyringeNumber | Literal['Current one']
-	on_or_off: OnOff
-class CommandTurnUvLight(TypedDict):
-	verb: Literal['Turn UV light']
-	target_uv_light: SyringeNumber | Literal['Current one']
-	on_or_off: OnOff
-
-CommandSpecifics = (
-	CommandRotate
-	| CommandActuate
-	| CommandTurnHeatingPad
-	| CommandTurnUvLight
-)
+if TYPE_CHECKING:
+	# Tk is only imported once a GUI is requested
+	from tkinter import Tk, Toplevel
 
 class EnqueuedCommand(TypedDict):
 	ordinal: int
+	fused_through_ordinal: NotRequired[int]
+	'''Last ordinal of the commands fused into this one, if any were'''
+	fused_command_count: NotRequired[int]
+	'''
+	Including this one. Dropped commands can use up ordinals within the fused
+	range, so it isn't always the range's length.
+	'''
 	enqueued_by: Enqueuer
 	enqueued_at: int
 	'''Unix epoch milliseconds'''
@@ -49,6 +39,8 @@ class EnqueuedCommand(TypedDict):
 	specifics: CommandSpecifics
 class FinishedCommand(TypedDict):
 	ordinal: int
+	fused_through_ordinal: NotRequired[int]
+	fused_command_count: NotRequired[int]
 	enqueued_by: Enqueuer
 	enqueued_at: int
 	'''Unix epoch milliseconds'''
@@ -56,23 +48,53 @@ class FinishedCommand(TypedDict):
 	finished_at: int
 	specifics: CommandSpecifics
 
-class Request(TypedDict):
+class PendingResponse(TypedDict):
+	request_id: str
+	'''Filename the request was spooled under, minus the extension'''
 	timestamp: int
-	'''Unix epoch milliseconds'''
-	commands: List[CommandSpecifics]
-class Response(TypedDict):
-	completed_request_timestamp: int
-
+	caboose_ordinal: int
+class ProgramCursor(TypedDict):
+	program_sha256: str
+	next_command_index: int
+	'''Index of the first program command not yet enqueued'''
+	command_count: int
+	'''Of the whole program, so that it's known when the print is done'''
 # Basically useEffect
 class Redrawable(TypedDict):
 	dependencies: List[Callable[[], Any]]
-	'''List of functions whose return values will trigger a redraw if changed'''
+	'''
+	List of functions whose return values will trigger a redraw if changed.
+	They're all called and compared with != every frame, so they should return
+	something cheap and immutable; for collections, that's get_state_version.
+	'''
 	redraw: Callable[[], Any]
 
 class NonPersistentState(TypedDict):
 	savefolder_path: str
 	savefile_path: str
-	savefile_last_write: int
+	savefile_last_write: float
+	'''When the last snapshot was taken (monotonic_ms)'''
+	journal_queue: Queue[JournalEntry | None]
+	'''Entries waiting for run_state_writer; None asks it to stop'''
+	journal_generation: int
+	journal_compaction_entry_threshold: int
+	journal_compaction_interval_ms: int
+	state_writer_shadow: Dict[str, Any]
+	'''Copy of the persistent state owned by run_state_writer'''
+	state_writer_coalescing_ms: int
+	state_writer_stopped: Event
+	state_write_latency_ms: float
+	state_write_max_latency_ms: float
+	position_last_journaled: float
+	'''monotonic_ms'''
+	journaled_positions: Dict[str, Any]
+	journaled_progress: Dict[int, Dict[str, Any]]
+	'''Per started command, as last journaled by journal_positions'''
+	state_versions: Dict[str, int]
+	'''
+	Per top-level key, bumped by each journaled change, and every tick that
+	processes commands for command_queue; see bump_state_version
+	'''
 	gui_root: Tk | None
 	gui_redrawables: List[Redrawable]
 	gui_dependency_cache: Dict[str, Any]
@@ -81,12 +103,65 @@ class NonPersistentState(TypedDict):
 	modal_dependency_cache: Dict[str, Any]
 	default_font_sizes: Dict[str, int]
 	reopening_gui: bool
+	attached_to_service: bool
+	'''
+	True in a GUI process (--attach-gui), whose state is only a replica of the
+	service process's; see state_snapshot.py
+	'''
+	state_snapshot: StateSnapshot | None
+	'''Published by the service process when the GUI runs in its own process'''
+	journal_tail: JournalTail | None
+	'''Where a GUI process is up to in replaying the journal'''
+	gui_process: subprocess.Popen | None
+	'''The GUI process, in the service process that launched it'''
 	shutting_down: bool
+	notification_sinks: List[NotificationSink]
+	'''Where notify_operator sends alerts; see notifications.py'''
+	notification_lock: Lock
+	notification_count: int
+	recent_notifications: List[Notification]
+	'''Published for GUI processes'''
+	notifications_seen_through: int | None
+	'''
+	In a GUI process, ordinal of the last published notification it has taken.
+	None until it first reads the snapshot, so that it skips older ones.
+	'''
+	gui_notifications: Queue[Notification]
+	'''Waiting to be shown by the Tk thread'''
 	processing_enabled: bool
-	processing_loop_last_start: int
-	processing_loop_measured_delta: int
+	processing_loop_last_start_ns: int
+	'''monotonic_ns'''
+	processing_loop_measured_delta: float
+	'''Milliseconds; feeds straight into dead reckoning'''
 	processing_loop_interval_ms: int
-	request_handling_last_poll: int
+	service_wakeup_event: Event
+	'''Cuts run_service's idle wait short; see wake_service_threads'''
+	request_spool_received: int
+	request_spool_dropped: int
+	request_spool_duplicates: int
+	loaded_program: CompiledProgram | None
+	'''Program the cursor points into, so it's only read from disk once'''
+	enqueue_lock: RLock
+	'''Keeps the commands of one request contiguous in the queue'''
+	command_finished_condition: Condition
+	'''Notified whenever a command leaves the queue'''
+	ipc_socket_path: str
+	command_fusion_rate_tolerance: float
+	'''How far apart (relatively) two Actuates' ms per mm may be to be fused'''
+	command_fusion_max_duration_ms: float
+	'''Keeps fused commands short enough that requests awaiting them don't stall'''
+	barrel_winding_limit_degrees: float
+	'''How far either way the barrel's wiring can be wound from syringe 1'''
+	barrel_unwinding_idle_ms: int
+	'''How long the queue has to sit empty before the barrel is unwound'''
+	queue_last_busy: float
+	'''monotonic_ms of the last time the service saw a command in the queue'''
+	queue_tail_prediction: TailPrediction | None
+	'''Hardware state once the queue has run, for dropping redundant commands'''
+	command_scheduling_window: int
+	'''How far into the queue the service looks for commands it can run'''
+	finished_commands_pending: List[FinishedCommand]
+	'''Finished during the current tick, to leave the queue together at its end'''
 	safety_margin: float
 	'''
 	General-purpose safety margin for any operation that would physically crash
@@ -101,8 +176,38 @@ class NonPersistentState(TypedDict):
 	delegate control of the servo actuator to an Arduino/microcontroller set up
 	to accept commands with specific timing params.
 	'''
+	rotator_actuator_clearance_mm: float
+	'''Furthest the actuator may be extended while the barrel rotates'''
 	rotator_degrees_per_step: float
+	rotator_max_steps_per_s: float
+	rotator_acceleration_steps_per_s2: float
+	rotator_pulse_train: PulseTrain | None
+	'''Pulse train currently being emitted for the active Rotate command'''
 	actuator_travel_mm_per_ms: float
+	actuator_travel_since_zero_mm: float
+	'''Dead-reckoned both ways since the actuator last bottomed out, or infinite'''
+	actuator_rezero_travel_mm: float
+	'''
+	Dead reckoning drifts with travel, and Retract to clearance never bottoms
+	out to correct it. Past this much travel, it retracts fully instead, before
+	the drift can eat into the clearance margin.
+	'''
+	pwm_channels: Dict[str, PwmChannel]
+	pwm_lock: Lock
+	pwm_wakeup_event: Event
+	'''Cuts run_pwm_engine's wait short while no channel is active'''
+	pwm_engine_interval_ms: float
+	'''Tick interval of the software PWM engine while any channel is active'''
+	pwm_engine_failures: int
+	'''Counts channels the PWM engine gave up on; see fail_pwm_channel'''
+	pwm_tick_deltas: LoopDeltas
+	'''Shared with the motion core process, if there is one'''
+	motion_core: MotionCore | None
+	'''Process running the PWM engine and step pulses, if enabled; see motion_core.py'''
+	motion_core_cpu: int | None
+	'''CPU the motion core is pinned to; None picks the highest numbered one'''
+	motion_core_fifo_priority: int
+	pwm_hardware_frequency_hz: int
 	actuator_max_possible_extension_mm: float
 	actuator_has_calibration_lock: bool
 	'''
@@ -121,61 +226,44 @@ class GlobalState(TypedDict):
 	actuator_position_mm: float | None
 	plunger_positions_mm: Dict[str, float]
 	'''Distances from fully retracted actuator tip to each plunger's tip'''
+	barrel_winding_degrees: float | None
+	'''
+	Net rotation since syringe 1 with the wiring relaxed. None until a rotation
+	has been tracked, meaning the current syringe's home winding.
+	'''
 	command_queue: list[EnqueuedCommand]
 	command_history: list[FinishedCommand]
 	next_command_ordinal: int
-	request_handling_watermark: int
-	request_handling_caboose_ordinal: int | None
+	request_handling_pending_responses: List[PendingResponse]
+	'''Spooled requests awaiting completion before their response is written'''
+	request_handling_recent_request_ids: List[str]
+	'''For spotting requests that get spooled twice'''
+	program_cursor: ProgramCursor | None
+	'''How far into the compiled program Klipper is printing'''
 
 def on_off_string_to_bit(on_off: OnOff) -> Bit:
 	return 1 if on_off == 'On' else 0
 
-def establish_savefolder_path() -> str:
-	if environ.get('XDG_DATA_DIR'):
-		savefolder_base = f"{environ.get('XDG_DATA_DIR')}/"
-	elif environ.get('HOME'):
-		savefolder_base = f"{environ.get('HOME')}/."
-	elif environ.get('APPDATA'):
-		savefolder_base = f"{environ.get('APPDATA')}/"
-	else:
-		raise Exception(f'User directory not found as any of these env vars: XDG_DATA_DIR, HOME, APPDATA')
-	savefolder_path = f'{savefolder_base}bioprintly'
-	Path(savefolder_path).mkdir(parents = True, exist_ok = True)
-	return savefolder_path
-
-def save_state_to_disk(state: GlobalState):
-	'''
-	I believe this should only be called from the service thread to avoid race
-	conditions.
-	'''
-	savefile_path = state['nonpersistent']['savefile_path']
-	savefile = open(savefile_path, 'w')
-	persistent_state = cast(Dict, copy(state))
-	persistent_state.pop('nonpersistent')
-	json.dump(
-		persistent_state,
-		savefile,
-		indent = '\t'
-	)
-	state['nonpersistent']['savefile_last_write'] = unix_time_ms()
-
 def load_state_from_disk(state: GlobalState):
-	savefile_path = state['nonpersistent']['savefile_path']
-	try:
-		savefile = open(savefile_path, 'r')
-	except:
+	savedata = read_snapshot_and_journal(state['nonpersistent']['savefolder_path'])
+	if savedata == None:
 		return
-	savedata = json.load(savefile)
 	for key, value in savedata.items():
 		if key == 'nonpersistent':
 			continue
 		if key == 'process_info':
-			dont_run_multiple_instances_at_once(value)
+			dont_run_multiple_instances_at_once(state, value)
+			continue
+		if key == 'journal_generation':
+			state['nonpersistent']['journal_generation'] = value
 			continue
 		if key in state:
 			state[key] = value
 
-def dont_run_multiple_instances_at_once(savefile_process_info: ProcessInfo):
+def dont_run_multiple_instances_at_once(
+	state: GlobalState,
+	savefile_process_info: ProcessInfo,
+):
 	if type(savefile_process_info['pid']) is not int:
 		raise Exception(f"Non-integer value for savefile_process_info['pid'] (bad savefile)")
 	
@@ -188,19 +276,35 @@ def dont_run_multiple_instances_at_once(savefile_process_info: ProcessInfo):
 	except:
 		return
 	if ppid_for_savefile_pid == savefile_process_info['ppid']:
-		messagebox.showerror(
-			message = 'Another instance of Bioprintly appears to be running',
-			detail = 'Not starting another instance to avoid conflicts.',
+		notify_operator(
+			state,
+			'Error',
+			'Another instance of Bioprintly appears to be running',
+			'Not starting another instance to avoid conflicts.',
 		)
 		exit(1)
 
-def get_initial_global_state() -> GlobalState:
+def build_default_global_state() -> GlobalState:
+	'''Without loading or writing anything, e.g. for offline tools'''
 	savefolder_path = establish_savefolder_path()
 	state: GlobalState = {
 		'nonpersistent': {
 			'savefolder_path': savefolder_path,
 			'savefile_path': f'{savefolder_path}/state.json',
-			'savefile_last_write': 0,
+			'savefile_last_write': 0.0,
+			'journal_queue': Queue(),
+			'journal_generation': 0,
+			'journal_compaction_entry_threshold': 1000,
+			'journal_compaction_interval_ms': 60000,
+			'state_writer_shadow': {},
+			'state_writer_coalescing_ms': 100,
+			'state_writer_stopped': Event(),
+			'state_write_latency_ms': 0.0,
+			'state_write_max_latency_ms': 0.0,
+			'position_last_journaled': 0.0,
+			'journaled_positions': {},
+			'journaled_progress': {},
+			'state_versions': {},
 			'gui_root': None,
 			'gui_redrawables': [],
 			'gui_dependency_cache': {},
@@ -209,15 +313,56 @@ def get_initial_global_state() -> GlobalState:
 			'modal_dependency_cache': {},
 			'default_font_sizes': {},
 			'reopening_gui': False,
+			'attached_to_service': False,
+			'state_snapshot': None,
+			'journal_tail': None,
+			'gui_process': None,
 			'shutting_down': False,
+			'notification_sinks': [log_notification],
+			'notification_lock': Lock(),
+			'notification_count': 0,
+			'recent_notifications': [],
+			'notifications_seen_through': None,
+			'gui_notifications': Queue(),
 			'processing_enabled': False,
 			'processing_loop_interval_ms': 8,
-			'processing_loop_measured_delta': 8,
-			'processing_loop_last_start': unix_time_ms(),
-			'request_handling_last_poll': 0,
+			'service_wakeup_event': Event(),
+			'processing_loop_measured_delta': 8.0,
+			'processing_loop_last_start_ns': monotonic_ns(),
+			'request_spool_received': 0,
+			'request_spool_dropped': 0,
+			'request_spool_duplicates': 0,
+			'loaded_program': None,
+			'enqueue_lock': RLock(),
+			'command_finished_condition': Condition(),
+			'ipc_socket_path': get_ipc_socket_path(savefolder_path),
+			'command_fusion_rate_tolerance': 0.05,
+			'command_fusion_max_duration_ms': 5000.0,
+			'barrel_winding_limit_degrees': 360.0,
+			'barrel_unwinding_idle_ms': 30000,
+			'queue_last_busy': monotonic_ms(),
+			'queue_tail_prediction': None,
+			'command_scheduling_window': 32,
+			'finished_commands_pending': [],
 			'safety_margin': 0.05,
+			'rotator_actuator_clearance_mm': 10.0,
 			'rotator_degrees_per_step': 90 / 235,
+			'rotator_max_steps_per_s': 400.0,
+			'rotator_acceleration_steps_per_s2': 1600.0,
+			'rotator_pulse_train': None,
 			'actuator_travel_mm_per_ms': 8e-3,
+			'actuator_travel_since_zero_mm': float('inf'),
+			'actuator_rezero_travel_mm': 50.0,
+			'pwm_channels': {},
+			'pwm_lock': Lock(),
+			'pwm_wakeup_event': Event(),
+			'pwm_engine_interval_ms': 1.0,
+			'pwm_engine_failures': 0,
+			'pwm_tick_deltas': create_loop_deltas(),
+			'motion_core': None,
+			'motion_core_cpu': None,
+			'motion_core_fifo_priority': 50,
+			'pwm_hardware_frequency_hz': 1000,
 			'actuator_max_possible_extension_mm': 45.5,
 			'actuator_has_calibration_lock': False,
 		},
@@ -237,16 +382,25 @@ def get_initial_global_state() -> GlobalState:
 		'current_syringe': None,
 		'actuator_position_mm': None,
 		'plunger_positions_mm': {},
+		'barrel_winding_degrees': None,
 		'command_queue': [],
 		'command_history': [],
 		'next_command_ordinal': 0,
-		'request_handling_watermark': 0,
-		'request_handling_caboose_ordinal': None,
+		'request_handling_pending_responses': [],
+		'request_handling_recent_request_ids': [],
+		'program_cursor': None,
 	}
-	
+	return state
+
+def get_initial_global_state(
+	notification_sinks: Sequence[NotificationSink] = (log_notification,),
+) -> GlobalState:
+	'''Sinks are set up first, so that alerts raised while loading reach them'''
+	state = build_default_global_state()
+	state['nonpersistent']['notification_sinks'] = list(notification_sinks)
 	load_state_from_disk(state)
 	# Save process info to prevent multiple instances from running at once
-	save_state_to_disk(state)
+	start_state_journal(state)
 	
 	return state
 
@@ -267,18 +421,142 @@ def processing_is_allowed_to_be_started(state: GlobalState) -> bool:
 		and state['nonpersistent']['modal'] == None
 	)
 
+def wake_service_threads(state: GlobalState):
+	'''
+	The service and PWM engine wait rather than tick while there's nothing for
+	them to do. Call after anything that might give them something to do: new
+	commands, processing being enabled or paused, or shutting down.
+	'''
+	sync_motion_core_control(state)
+	state['nonpersistent']['service_wakeup_event'].set()
+	state['nonpersistent']['pwm_wakeup_event'].set()
+
 def enqueue_command(
 	state: GlobalState,
 	enqueuer: Enqueuer,
 	specifics: CommandSpecifics,
 ) -> int:
-	ordinal = state['next_command_ordinal']
-	state['command_queue'].append({
-		'ordinal': ordinal,
-		'enqueued_by': enqueuer,
-		'enqueued_at': unix_time_ms(),
-		'specifics': specifics,
-	})
-	state['next_command_ordinal'] += 1
+	with state['nonpersistent']['enqueue_lock']:
+		ordinal = state['next_command_ordinal']
+		hardware = get_tail_prediction(state)
+		while (
+			not command_is_redundant(state, hardware, specifics)
+			and supersedes_queue_tail(state, hardware, specifics)
+		):
+			dropped_ordinal = state['command_queue'][-1]['ordinal']
+			drop_queue_tail(state)
+			append_to_journal(state, { 'op': 'Drop', 'ordinal': dropped_ordinal })
+			hardware = get_tail_prediction(state)
+		if command_is_redundant(state, hardware, specifics):
+			state['next_command_ordinal'] += 1
+			journal_set(state, 'next_command_ordinal')
+			return ordinal
+		apply_command(state, hardware, specifics)
+
+		fusable_command = find_fusable_queue_tail(state, enqueuer, specifics)
+		if fusable_command != None:
+			fuse_into_command(fusable_command, ordinal, cast(CommandActuate, specifics))
+			state['next_command_ordinal'] += 1
+			append_to_journal(state, { 'op': 'Fuse', 'command': fusable_command })
+			remember_tail_prediction(state, hardware)
+			return ordinal
+
+		command: EnqueuedCommand = {
+			'ordinal': ordinal,
+			'enqueued_by': enqueuer,
+			'enqueued_at': unix_time_ms(),
+			'specifics': specifics,
+		}
+		state['command_queue'].append(command)
+		state['next_command_ordinal'] += 1
+		append_to_journal(state, { 'op': 'Enqueue', 'command': command })
+		remember_tail_prediction(state, hardware)
+		wake_service_threads(state)
 
 	return ordinal
+
+def find_fusable_queue_tail(
+	state: GlobalState,
+	enqueuer: Enqueuer,
+	specifics: CommandSpecifics,
+) -> EnqueuedCommand | None:
+	'''
+	Runs of short extrusions are cheaper as one Actuate: one start, one finish
+	and one history entry. Only fuses into a tail that hasn't started, moving
+	the same way at about the same rate, so timing within the run holds up.
+	'''
+	nonpersistent = state['nonpersistent']
+	if len(state['command_queue']) == 0 or specifics['verb'] != 'Actuate':
+		return None
+	tail = state['command_queue'][-1]
+	tail_specifics = tail['specifics']
+	if (
+		'started_at' in tail
+		or tail['enqueued_by'] != enqueuer
+		or tail_specifics['verb'] != 'Actuate'
+		or 'relative_mm_traveled' in tail_specifics
+	):
+		return None
+	tail_mm = tail_specifics['relative_mm_required']
+	mm = specifics['relative_mm_required']
+	if (
+		isinstance(tail_mm, str)
+		or isinstance(mm, str)
+		or signum(tail_mm) != signum(mm)
+		or mm == 0.0
+		or (
+			tail_specifics['duration_ms_required'] + specifics['duration_ms_required']
+			> nonpersistent['command_fusion_max_duration_ms']
+		)
+	):
+		return None
+	tail_ms_per_mm = tail_specifics['duration_ms_required'] / abs(tail_mm)
+	ms_per_mm = specifics['duration_ms_required'] / abs(mm)
+	if abs(tail_ms_per_mm - ms_per_mm) > (
+		nonpersistent['command_fusion_rate_tolerance']
+		* max(tail_ms_per_mm, ms_per_mm)
+	):
+		return None
+	return tail
+
+def fuse_into_command(
+	command: EnqueuedCommand,
+	ordinal: int,
+	specifics: CommandActuate,
+):
+	'''
+	The fused command keeps its first ordinal, so it stays in ordinal order and
+	requests waiting on any of the fused ordinals complete once it finishes
+	'''
+	fused_specifics = cast(CommandActuate, dict(command['specifics']))
+	fused_specifics['relative_mm_required'] = (
+		cast(float, fused_specifics['relative_mm_required'])
+		+ cast(float, specifics['relative_mm_required'])
+	)
+	fused_specifics['duration_ms_required'] += specifics['duration_ms_required']
+	# Swapped in whole, since the service reads specifics without the lock
+	command['specifics'] = fused_specifics
+	command['fused_through_ordinal'] = ordinal
+	command['fused_command_count'] = command.get('fused_command_count', 1) + 1
+
+def enqueue_commands(
+	state: GlobalState,
+	enqueuer: Enqueuer,
+	commands: List[CommandSpecifics],
+) -> int:
+	'''
+	Returns the caboose ordinal: once every command up to and including it has
+	finished, so have all of these commands (and everything enqueued before).
+	'''
+	with state['nonpersistent']['enqueue_lock']:
+		for specifics in commands:
+			enqueue_command(state, enqueuer, specifics)
+		return state['next_command_ordinal'] - 1
+
+def commands_up_to_ordinal_are_finished(
+	state: GlobalState,
+	ordinal: int,
+) -> bool:
+	'''The queue stays sorted by ordinal, so only its head matters'''
+	command_queue = state['command_queue']
+	return len(command_queue) == 0 or command_queue[0]['ordinal'] > ordinal
@@ -0,0 +1,297 @@
+'''
+Lets a GUI process (--attach-gui) follow the service process's state without
+sharing its GIL. The service publishes a compact snapshot of what the GUI
+shows to a file that both processes map into memory. It's guarded by a
+sequence lock, so that a reader can never make the service wait.
+
+The queue and history can be far too long to publish every tick, so they're
+left out of the snapshot. The GUI process replays the journal for those
+instead, the same way they're loaded at startup.
+'''
+from __future__ import annotations
+from bisect import bisect_left
+from copy import copy
+from ctypes import Structure, c_uint32, c_uint64, sizeof
+import json
+from journal import JOURNALED_KEYS_BY_OP, apply_journal_entry, bump_state_version, get_journal_path
+import mmap
+from notifications import deliver_notification
+import os
+from threading import Lock
+from time import sleep
+from timing import monotonic_ms
+from typing import Any, BinaryIO, Dict, List, TypedDict, cast, TYPE_CHECKING
+
+if TYPE_CHECKING:
+	from state import EnqueuedCommand, GlobalState
+
+STATE_SNAPSHOT_CAPACITY = 1 << 18
+'''Bytes of JSON; the snapshot leaves out anything that grows with the queue'''
+STATE_SNAPSHOT_INTERVAL_MS = 100
+STATE_SNAPSHOT_TIMEOUT_MS = 1000
+'''Publishing takes microseconds, so one left unfinished this long never will be'''
+PUBLISHED_KEYS = [
+	'ui_scale',
+	'pins',
+	'current_syringe',
+	'actuator_position_mm',
+	'plunger_positions_mm',
+	'barrel_winding_degrees',
+]
+PUBLISHED_NONPERSISTENT_KEYS = [
+	'shutting_down',
+	'processing_enabled',
+	'processing_loop_interval_ms',
+	'processing_loop_measured_delta',
+	'state_write_latency_ms',
+	'state_write_max_latency_ms',
+	'request_spool_received',
+	'request_spool_dropped',
+	'request_spool_duplicates',
+	'actuator_has_calibration_lock',
+	'journal_generation',
+	'recent_notifications',
+]
+REPLAYED_KEYS = ['command_queue', 'command_history', 'next_command_ordinal']
+'''Kept up to date in a GUI process by replaying the journal'''
+
+class StateSnapshotHeader(Structure):
+	_fields_ = [
+		# Odd while the service is writing
+		('sequence', c_uint64),
+		# Of the JSON that follows the header
+		('length', c_uint32),
+	]
+
+class StateSnapshot(TypedDict):
+	memory: mmap.mmap
+	header: StateSnapshotHeader
+	lock: Lock
+	'''Serializes the service's writes'''
+class JournalTail(TypedDict):
+	generation: int
+	file: BinaryIO | None
+	'''None until the generation's journal has been written to'''
+
+def get_state_snapshot_path(savefolder_path: str) -> str:
+	return f'{savefolder_path}/state_snapshot'
+
+def open_state_snapshot(savefolder_path: str, publishing: bool) -> StateSnapshot:
+	'''The service opens it for publishing, before a GUI process opens it'''
+	path = get_state_snapshot_path(savefolder_path)
+	if not publishing and not os.path.exists(path):
+		raise Exception(f'No state snapshot at {path} (start Bioprintly with --headless or --gui-process first)')
+	file_descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+	try:
+		if publishing:
+			os.ftruncate(
+				file_descriptor,
+				sizeof(StateSnapshotHeader) + STATE_SNAPSHOT_CAPACITY,
+			)
+		memory = mmap.mmap(file_descriptor, 0)
+	finally:
+		os.close(file_descriptor)
+	snapshot: StateSnapshot = {
+		'memory': memory,
+		'header': StateSnapshotHeader.from_buffer(memory),
+		'lock': Lock(),
+	}
+	if publishing:
+		# A previous run may have died mid-write
+		snapshot['header'].sequence += snapshot['header'].sequence % 2
+	return snapshot
+
+def publish_state_snapshot(state: GlobalState):
+	'''Safe to call from any thread of the service process'''
+	nonpersistent = state['nonpersistent']
+	snapshot = cast(StateSnapshot, nonpersistent['state_snapshot'])
+	published: Dict[str, Any] = {
+		# Shallow copies, since other threads may add keys while this serializes
+		key: copy(state[key])
+		for key in PUBLISHED_KEYS
+	}
+	for key in PUBLISHED_NONPERSISTENT_KEYS:
+		published[key] = nonpersistent[key]
+	published['service_pid'] = os.getpid()
+	# Only started commands change while queued, as processing fills them in
+	published['started_commands'] = [
+		{ **command, 'specifics': dict(command['specifics']) }
+		for command in state['command_queue'][
+			:nonpersistent['command_scheduling_window']
+		]
+		if 'started_at' in command
+	]
+	encoded = json.dumps(published, separators = (',', ':')).encode()
+	if len(encoded) > STATE_SNAPSHOT_CAPACITY:
+		raise Exception(f'State snapshot of {len(encoded)} bytes is over capacity')
+
+	header_size = sizeof(StateSnapshotHeader)
+	with snapshot['lock']:
+		header = snapshot['header']
+		header.sequence += 1
+		snapshot['memory'][header_size:header_size + len(encoded)] = encoded
+		header.length = len(encoded)
+		header.sequence += 1
+
+def run_state_snapshot_publisher(state: GlobalState):
+	'''Publishes one last time once shutting down, so GUI processes close too'''
+	nonpersistent = state['nonpersistent']
+	while nonpersistent['shutting_down'] == False:
+		publish_state_snapshot(state)
+		sleep(STATE_SNAPSHOT_INTERVAL_MS / 1e3)
+	publish_state_snapshot(state)
+
+def read_state_snapshot(snapshot: StateSnapshot) -> Dict[str, Any] | None:
+	'''
+	None if nothing has been published yet. Raises if the service seems to
+	have died mid-publish, leaving the sequence odd for good.
+	'''
+	header = snapshot['header']
+	header_size = sizeof(StateSnapshotHeader)
+	deadline = monotonic_ms() + STATE_SNAPSHOT_TIMEOUT_MS
+	while True:
+		sequence = header.sequence
+		if sequence % 2 == 0:
+			length = min(header.length, STATE_SNAPSHOT_CAPACITY)
+			encoded = snapshot['memory'][header_size:header_size + length]
+			if header.sequence == sequence:
+				return json.loads(encoded) if length > 0 else None
+		if monotonic_ms() > deadline:
+			raise Exception('State snapshot was left half-published')
+		sleep(0)
+
+def refresh_state_replica(state: GlobalState):
+	'''
+	For GUI processes. Bumps the version of every key that changed, as the
+	service does when it journals them, so redraws work the same way.
+	'''
+	nonpersistent = state['nonpersistent']
+	try:
+		published = read_state_snapshot(
+			cast(StateSnapshot, nonpersistent['state_snapshot']),
+		)
+	except Exception as error:
+		print(f'Closing, since the service stopped publishing: {error}')
+		nonpersistent['shutting_down'] = True
+		return
+	if published == None:
+		return
+	for key in PUBLISHED_KEYS:
+		if state[key] != published[key]:
+			state[key] = published[key]
+			bump_state_version(state, key)
+	for key in PUBLISHED_NONPERSISTENT_KEYS:
+		nonpersistent[key] = published[key]
+	if not service_is_running(published['service_pid']):
+		nonpersistent['shutting_down'] = True
+
+	follow_journal(state)
+	overlay_started_commands(state, published['started_commands'])
+
+	seen_through = nonpersistent['notifications_seen_through']
+	for notification in nonpersistent['recent_notifications']:
+		if seen_through != None and notification['ordinal'] > seen_through:
+			deliver_notification(state, notification)
+	nonpersistent['notifications_seen_through'] = max(
+		[seen_through or 0] + [
+			notification['ordinal']
+			for notification in nonpersistent['recent_notifications']
+		],
+	)
+
+def service_is_running(service_pid: int) -> bool:
+	try:
+		os.kill(service_pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+def follow_journal(state: GlobalState):
+	'''
+	Replays whatever the service has appended to the journal since the last
+	call. Once the service compacts it, starts over from the new snapshot.
+	'''
+	nonpersistent = state['nonpersistent']
+	journal_tail = nonpersistent['journal_tail']
+	if (
+		journal_tail == None
+		or nonpersistent['journal_generation'] > journal_tail['generation']
+	):
+		journal_tail = reload_replayed_keys(state)
+
+	if journal_tail['file'] == None:
+		try:
+			journal_tail['file'] = open(get_journal_path(
+				nonpersistent['savefolder_path'],
+				journal_tail['generation'],
+			), 'rb')
+		except FileNotFoundError:
+			return
+	journal_file = journal_tail['file']
+
+	while True:
+		position = journal_file.tell()
+		line = journal_file.readline()
+		if not line.endswith(b'\n'):
+			# Caught up, or the service is mid-append
+			journal_file.seek(position)
+			break
+		entry = json.loads(line)
+		if entry['op'] == 'Set' and entry['key'] not in REPLAYED_KEYS:
+			# The snapshot has fresher values for everything else
+			continue
+		apply_journal_entry(cast(Dict[str, Any], state), entry)
+		for key in (
+			[entry['key']]
+			if entry['op'] == 'Set'
+			else JOURNALED_KEYS_BY_OP[entry['op']]
+		):
+			bump_state_version(state, key)
+
+def reload_replayed_keys(state: GlobalState) -> JournalTail:
+	nonpersistent = state['nonpersistent']
+	journal_tail = nonpersistent['journal_tail']
+	if journal_tail != None and journal_tail['file'] != None:
+		journal_tail['file'].close()
+
+	try:
+		with open(nonpersistent['savefile_path'], 'r') as savefile:
+			savedata = json.load(savefile)
+	except (FileNotFoundError, json.JSONDecodeError):
+		savedata = {}
+	state['command_queue'] = savedata.get('command_queue', [])
+	state['command_history'] = savedata.get('command_history', [])
+	state['next_command_ordinal'] = savedata.get('next_command_ordinal', 0)
+	for key in REPLAYED_KEYS:
+		bump_state_version(state, key)
+
+	journal_tail = nonpersistent['journal_tail'] = {
+		'generation': savedata.get('journal_generation', 0),
+		'file': None,
+	}
+	return journal_tail
+
+def overlay_started_commands(
+	state: GlobalState,
+	started_commands: List[EnqueuedCommand],
+):
+	'''The journal only has their progress once they finish'''
+	command_queue = state['command_queue']
+	changed = False
+	for command in started_commands:
+		index = bisect_left(
+			command_queue,
+			command['ordinal'],
+			key = lambda queued_command: queued_command['ordinal'],
+		)
+		if (
+			index < len(command_queue)
+			and command_queue[index]['ordinal'] == command['ordinal']
+			and command_queue[index] != command
+		):
+			command_queue[index] = command
+			changed = True
+	if changed:
+		bump_state_version(state, 'command_queue')
@@ -0,0 +1,84 @@
+from __future__ import annotations
+from math import sqrt
+from pins import write_pin
+from time import monotonic_ns
+from timing import sleep_until_ns
+from typing import List, TypedDict, TYPE_CHECKING
+
+if TYPE_CHECKING:
+	from state import GlobalState
+
+class PulseTrain(TypedDict):
+	ordinal: int
+	'''Ordinal of the command this pulse train was planned for'''
+	step_times_s: List[float]
+	'''Rising edge time of each step, as seconds from the start of the train'''
+	steps_emitted: int
+	steps_accounted_for: int
+	'''How many of the emitted steps processing has already tallied up'''
+	finished: bool
+
+def plan_trapezoidal_step_times(
+	step_count: int,
+	max_steps_per_s: float,
+	acceleration_steps_per_s2: float,
+) -> List[float]:
+	'''
+	Accelerates at a constant rate up to the max step rate, cruises, then
+	decelerates symmetrically. If there aren't enough steps to reach the max
+	step rate, the profile becomes triangular and peaks halfway through.
+	'''
+	if step_count <= 0:
+		return []
+
+	ramp_steps = min(
+		max_steps_per_s ** 2 / (2 * acceleration_steps_per_s2),
+		step_count / 2,
+	)
+	ramp_duration_s = sqrt(2 * ramp_steps / acceleration_steps_per_s2)
+	peak_steps_per_s = acceleration_steps_per_s2 * ramp_duration_s
+	cruise_duration_s = (step_count - 2 * ramp_steps) / peak_steps_per_s
+	total_duration_s = 2 * ramp_duration_s + cruise_duration_s
+
+	step_times_s = []
+	for step in range(1, step_count + 1):
+		if step <= ramp_steps:
+			step_time_s = sqrt(2 * step / acceleration_steps_per_s2)
+		elif step <= step_count - ramp_steps:
+			step_time_s = (
+				ramp_duration_s
+				+ (step - ramp_steps) / peak_steps_per_s
+			)
+		else:
+			step_time_s = total_duration_s - sqrt(
+				2 * (step_count - step) / acceleration_steps_per_s2
+			)
+		step_times_s.append(step_time_s)
+
+	return step_times_s
+
+def run_step_pulse_generator(state: GlobalState, pulse_train: PulseTrain):
+	'''
+	Emits one rising edge on the rotator step pin per planned step time. Runs as
+	its own thread so that step timing isn't tied to the processing interval.
+	Stops early if processing is paused or the app is shutting down.
+	'''
+	nonpersistent = state['nonpersistent']
+	train_start_ns = monotonic_ns()
+
+	for step_time_s in pulse_train['step_times_s']:
+		if (
+			nonpersistent['shutting_down'] == True
+			or nonpersistent['processing_enabled'] == False
+		):
+			break
+
+		sleep_until_ns(train_start_ns + round(step_time_s * 1e9))
+
+		# Python call overhead alone exceeds the minimum pulse width of common
+		# stepper drivers, so the pin can go straight back down
+		write_pin(state, 'rotator_step', 1)
+		write_pin(state, 'rotator_step', 0)
+		pulse_train['steps_emitted'] += 1
+
+	pulse_train['finished'] = True
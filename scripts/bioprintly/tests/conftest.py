@@ -0,0 +1,16 @@
+'''
+Run with `python3 -m pytest` from scripts/bioprintly. Each test gets its own
+save folder, and pins go to the stub that pins.py falls back on off the Pi.
+'''
+from pathlib import Path
+import pytest
+import sys
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from state import GlobalState, build_default_global_state
+
+@pytest.fixture
+def state(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> GlobalState:
+	monkeypatch.setenv('XDG_DATA_DIR', str(tmp_path))
+	return build_default_global_state()
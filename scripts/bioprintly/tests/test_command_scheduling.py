@@ -0,0 +1,80 @@
+from command_scheduling import find_runnable_commands
+from commands import CommandSpecifics
+from state import EnqueuedCommand, GlobalState
+from typing import List, cast
+
+ACTUATE: CommandSpecifics = {
+	'verb': 'Actuate',
+	'duration_ms_required': 1000.0,
+	'relative_mm_required': 1.0,
+}
+
+def queue_commands(state: GlobalState, commands: List[CommandSpecifics]):
+	state['current_syringe'] = 1
+	state['command_queue'] = [
+		cast(EnqueuedCommand, {
+			'ordinal': ordinal,
+			'enqueued_by': 'Operator',
+			'enqueued_at': 0,
+			'specifics': specifics,
+		})
+		for ordinal, specifics in enumerate(commands)
+	]
+
+def runnable_ordinals(state: GlobalState) -> List[int]:
+	return [command['ordinal'] for command in find_runnable_commands(state)]
+
+def test_commands_on_separate_hardware_run_together(state: GlobalState):
+	queue_commands(state, [
+		ACTUATE,
+		{ 'verb': 'Turn heating pad', 'target_heating_pad': 2, 'on_or_off': 'On' },
+		{ 'verb': 'Turn UV light', 'target_uv_light': 'Current one', 'on_or_off': 'On' },
+	])
+	assert runnable_ordinals(state) == [0, 1, 2]
+
+def test_rotate_waits_for_the_actuator(state: GlobalState):
+	queue_commands(state, [
+		ACTUATE,
+		{ 'verb': 'Rotate', 'target_syringe': 2 },
+	])
+	assert runnable_ordinals(state) == [0]
+
+def test_current_one_waits_for_rotation(state: GlobalState):
+	queue_commands(state, [
+		{ 'verb': 'Rotate', 'target_syringe': 2 },
+		{ 'verb': 'Turn UV light', 'target_uv_light': 'Current one', 'on_or_off': 'On' },
+		{ 'verb': 'Turn heating pad', 'target_heating_pad': 3, 'on_or_off': 'On' },
+	])
+	assert runnable_ordinals(state) == [0, 2]
+
+def test_commands_never_overtake_a_conflicting_earlier_one(state: GlobalState):
+	queue_commands(state, [
+		ACTUATE,
+		{ 'verb': 'Rotate', 'target_syringe': 2 },
+		ACTUATE,
+	])
+	assert runnable_ordinals(state) == [0]
+
+def test_barrier_waits_for_and_holds_back_everything(state: GlobalState):
+	heating_pad_on: CommandSpecifics = {
+		'verb': 'Turn heating pad',
+		'target_heating_pad': 1,
+		'on_or_off': 'On',
+	}
+	queue_commands(state, [ACTUATE, { 'verb': 'Barrier' }, heating_pad_on])
+	assert runnable_ordinals(state) == [0]
+	queue_commands(state, [{ 'verb': 'Barrier' }, heating_pad_on])
+	assert runnable_ordinals(state) == [0]
+
+def test_finished_commands_are_skipped(state: GlobalState):
+	queue_commands(state, [ACTUATE, { 'verb': 'Rotate', 'target_syringe': 2 }])
+	state['command_queue'][0]['finished_at'] = 0
+	assert runnable_ordinals(state) == [1]
+
+def test_only_the_scheduling_window_is_walked(state: GlobalState):
+	state['nonpersistent']['command_scheduling_window'] = 2
+	queue_commands(state, [
+		{ 'verb': 'Turn heating pad', 'target_heating_pad': heating_pad, 'on_or_off': 'On' }
+		for heating_pad in [1, 2, 3]
+	])
+	assert runnable_ordinals(state) == [0, 1]
@@ -0,0 +1,44 @@
+from commands import CommandSpecifics
+from g_code_compiler import CompiledProgram
+from job_estimation import estimate_job
+from state import GlobalState
+from typing import List, cast
+
+def tool_change(target_syringe) -> List[CommandSpecifics]:
+	return [
+		{
+			'verb': 'Actuate',
+			'duration_ms_required': 0.0,
+			'relative_mm_required': 'Retract to clearance',
+		},
+		{ 'verb': 'Rotate', 'target_syringe': target_syringe },
+		{
+			'verb': 'Actuate',
+			'duration_ms_required': 0.0,
+			'relative_mm_required': 'Go to plunger flange',
+		},
+	]
+
+def extended_state(state: GlobalState, travel_since_zero_mm: float) -> GlobalState:
+	state['current_syringe'] = 1
+	state['actuator_position_mm'] = 20.0
+	state['plunger_positions_mm'] = { '1': 20.0, '2': 20.0, '3': 20.0, '4': 20.0 }
+	state['nonpersistent']['actuator_travel_since_zero_mm'] = travel_since_zero_mm
+	return state
+
+def retraction_mm(state: GlobalState, commands: List[CommandSpecifics]) -> float:
+	program = cast(CompiledProgram, { 'commands': commands, 'sync_markers': [] })
+	return (
+		estimate_job(state, program)['retraction_s']
+		* 1e3 * state['nonpersistent']['actuator_travel_mm_per_ms']
+	)
+
+def test_clearance_retracts_stop_short_of_zero(state: GlobalState):
+	extended_state(state, 0.0)
+	# 10.5 mm down to 9.5 mm clearance and back, twice
+	assert abs(retraction_mm(state, tool_change(2) + tool_change(3)) - 42.0) < 1e-6
+
+def test_clearance_retracts_bottom_out_once_drift_builds_up(state: GlobalState):
+	extended_state(state, state['nonpersistent']['actuator_rezero_travel_mm'])
+	# The first tool change retracts fully to re-zero, the second doesn't
+	assert abs(retraction_mm(state, tool_change(2) + tool_change(3)) - 61.0) < 1e-6
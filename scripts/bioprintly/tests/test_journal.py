@@ -0,0 +1,144 @@
+from copy import deepcopy
+from journal import JournalEntry, apply_journal_entry, coalesce_journal_entries, get_journal_path, read_snapshot_and_journal, run_state_writer, start_state_journal, stop_state_writer
+import json
+from operator_actions import perform_operator_action
+from pathlib import Path
+import pytest
+from state import EnqueuedCommand, FinishedCommand, GlobalState, enqueue_command
+from threading import Timer
+from typing import Any, Dict, List, cast
+
+def empty_savedata() -> Dict[str, Any]:
+	return { 'command_queue': [], 'command_history': [], 'next_command_ordinal': 0 }
+
+def queued(ordinal: int, mm: float = 1.0) -> EnqueuedCommand:
+	return {
+		'ordinal': ordinal,
+		'enqueued_by': 'Klipper',
+		'enqueued_at': 0,
+		'specifics': {
+			'verb': 'Actuate',
+			'duration_ms_required': 1000.0,
+			'relative_mm_required': mm,
+		},
+	}
+
+def finished(ordinal: int) -> FinishedCommand:
+	return cast(FinishedCommand, { **queued(ordinal), 'started_at': 1, 'finished_at': 2 })
+
+def replay(savedata: Dict[str, Any], entries: List[JournalEntry]) -> Dict[str, Any]:
+	savedata = deepcopy(savedata)
+	for entry in deepcopy(entries):
+		apply_journal_entry(savedata, entry)
+	return savedata
+
+ENTRIES: List[JournalEntry] = [
+	{ 'op': 'Enqueue', 'command': queued(0) },
+	{ 'op': 'Enqueue', 'command': queued(1) },
+	{ 'op': 'Fuse', 'command': { **queued(1, 2.0), 'fused_through_ordinal': 2 } },
+	{ 'op': 'Fuse', 'command': { **queued(1, 3.0), 'fused_through_ordinal': 3 } },
+	{ 'op': 'Enqueue', 'command': queued(4) },
+	{ 'op': 'Drop', 'ordinal': 4 },
+	{ 'op': 'Start', 'ordinal': 0, 'started_at': 1 },
+	{ 'op': 'Progress', 'ordinal': 0, 'progress': { 'relative_mm_traveled': 0.25 } },
+	{ 'op': 'Set', 'key': 'actuator_position_mm', 'value': 0.25 },
+	{ 'op': 'Progress', 'ordinal': 0, 'progress': { 'relative_mm_traveled': 0.5 } },
+	{ 'op': 'Set', 'key': 'actuator_position_mm', 'value': 0.5 },
+	{ 'op': 'Start', 'ordinal': 1, 'started_at': 1 },
+	{ 'op': 'Progress', 'ordinal': 1, 'progress': { 'relative_mm_traveled': 0.1 } },
+	{ 'op': 'Finish', 'commands': [finished(0)] },
+	{ 'op': 'Set', 'key': 'ui_scale', 'value': 1.0 },
+]
+
+def test_replay_applies_every_op():
+	savedata = replay(empty_savedata(), ENTRIES)
+	assert [command['ordinal'] for command in savedata['command_queue']] == [1]
+	assert savedata['command_queue'][0]['specifics']['relative_mm_required'] == 3.0
+	assert savedata['command_queue'][0]['specifics']['relative_mm_traveled'] == 0.1
+	assert savedata['command_queue'][0]['started_at'] == 1
+	assert [command['ordinal'] for command in savedata['command_history']] == [0]
+	assert savedata['next_command_ordinal'] == 5
+	assert savedata['actuator_position_mm'] == 0.5
+
+def test_coalescing_replays_the_same():
+	shadow = { **empty_savedata(), 'ui_scale': 1.0 }
+	coalesced = coalesce_journal_entries(shadow, deepcopy(ENTRIES))
+	assert replay(shadow, coalesced) == replay(shadow, ENTRIES)
+	ops = [entry['op'] for entry in coalesced]
+	# Overwritten and unchanged Sets, the finished command's Start and
+	# Progress, and the first of the two Fuses all go
+	assert ops.count('Set') == 1
+	assert ops.count('Fuse') == 1
+	assert ops.count('Start') == 1
+	assert ops.count('Progress') == 1
+
+def test_runs_of_finishes_are_merged():
+	coalesced = coalesce_journal_entries(empty_savedata(), [
+		{ 'op': 'Finish', 'commands': [finished(0)] },
+		{ 'op': 'Finish', 'commands': [finished(1)] },
+	])
+	assert len(coalesced) == 1
+	assert [command['ordinal'] for command in coalesced[0]['commands']] == [0, 1]
+
+def run_journal(state: GlobalState, work):
+	start_state_journal(state)
+	Timer(0, run_state_writer, [state]).start()
+	work()
+	stop_state_writer(state)
+
+def test_state_round_trips_through_the_journal(state: GlobalState):
+	state['current_syringe'] = 1
+	state['actuator_position_mm'] = 0.0
+	for pin in state['pins'].values():
+		pin['value'] = 0
+	def work():
+		for _ in range(3):
+			enqueue_command(state, 'Klipper', {
+				'verb': 'Actuate',
+				'duration_ms_required': 100.0,
+				'relative_mm_required': 0.1,
+			})
+		enqueue_command(state, 'Operator', { 'verb': 'Rotate', 'target_syringe': 2 })
+		enqueue_command(state, 'Operator', { 'verb': 'Rotate', 'target_syringe': 3 })
+		perform_operator_action(state, { 'verb': 'Delete last enqueued command' })
+		perform_operator_action(state, { 'verb': 'Set UI scale', 'ui_scale': 1.5 })
+	run_journal(state, work)
+	
+	savedata = read_snapshot_and_journal(state['nonpersistent']['savefolder_path'])
+	assert savedata != None
+	assert savedata['command_queue'] == state['command_queue']
+	assert savedata['next_command_ordinal'] == state['next_command_ordinal']
+	assert savedata['ui_scale'] == 1.5
+
+def test_torn_final_line_is_ignored(state: GlobalState):
+	run_journal(state, lambda: None)
+	savefolder_path = state['nonpersistent']['savefolder_path']
+	journal_path = Path(get_journal_path(
+		savefolder_path,
+		state['nonpersistent']['journal_generation'],
+	))
+	journal_path.write_text(
+		json.dumps({ 'op': 'Enqueue', 'command': queued(0) }) + '\n'
+		+ json.dumps({ 'op': 'Enqueue', 'command': queued(1) })[:20]
+	)
+	savedata = read_snapshot_and_journal(savefolder_path)
+	assert savedata != None
+	assert [command['ordinal'] for command in savedata['command_queue']] == [0]
+
+# The writer re-raises, so that the traceback is logged
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_failed_writer_still_lets_shutdown_finish(state: GlobalState):
+	notifications = []
+	state['nonpersistent']['notification_sinks'] = [
+		lambda state, notification: notifications.append(notification),
+	]
+	start_state_journal(state)
+	writer = Timer(0, run_state_writer, [state])
+	writer.start()
+	# Can't be serialized
+	state['nonpersistent']['journal_queue'].put(
+		{ 'op': 'Set', 'key': 'ui_scale', 'value': { 1.5 } },
+	)
+	stop_state_writer(state)
+	writer.join()
+	assert [notification['severity'] for notification in notifications] == ['Error']
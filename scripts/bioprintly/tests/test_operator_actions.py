@@ -0,0 +1,35 @@
+from operator_actions import OperatorAction, perform_operator_action
+import pytest
+from state import GlobalState
+from typing import cast
+
+def test_unknown_pin_is_rejected_before_anything_changes(state: GlobalState):
+	pins_before = dict(state['pins'])
+	with pytest.raises(Exception, match = 'No pin named uv_light_9'):
+		perform_operator_action(state, cast(OperatorAction, {
+			'verb': 'Set pin',
+			'pin_name': 'uv_light_9',
+			'number': 8,
+		}))
+	assert state['pins'] == pins_before
+
+def test_malformed_fields_are_rejected(state: GlobalState):
+	for action, reason in [
+		({ 'verb': 'Set pin', 'pin_name': 'uv_light_1', 'number': 9 }, 'No GPIO pin number 9'),
+		({ 'verb': 'Record current syringe', 'syringe_number': 5 }, 'No syringe 5'),
+		({ 'verb': 'Set UI scale', 'ui_scale': 'big' }, 'not a positive number'),
+		({ 'verb': 'Handcrank the actuator', 'relative_mm_required': None }, 'not a number'),
+		({ 'verb': 'Enqueue', 'specifics': { 'verb': 'Rotate', 'target_syringe': 0 } }, 'No syringe 0'),
+		({ 'verb': 'Enqueue', 'specifics': { 'verb': 'Actuate', 'duration_ms_required': 0.0, 'relative_mm_required': 'Retract a bit' } }, 'Unknown actuator travel'),
+		({ 'verb': 'Enqueue', 'specifics': { 'verb': 'Explode' } }, 'Unknown command Explode'),
+		({ 'verb': 'Reboot' }, 'Unknown operator action Reboot'),
+	]:
+		with pytest.raises(Exception, match = reason):
+			perform_operator_action(state, cast(OperatorAction, action))
+	assert len(state['command_queue']) == 0
+
+def test_valid_actions_are_performed(state: GlobalState):
+	perform_operator_action(state, { 'verb': 'Set UI scale', 'ui_scale': 1.5 })
+	perform_operator_action(state, { 'verb': 'Record current syringe', 'syringe_number': 2 })
+	assert state['ui_scale'] == 1.5
+	assert state['current_syringe'] == 2
@@ -0,0 +1,110 @@
+from commands import CommandSpecifics
+from journal import JournalEntry
+from pins import zero_out_pins
+from queue import Empty
+from state import GlobalState, enqueue_command, enqueue_commands
+from typing import List
+
+def calibrate(state: GlobalState):
+	state['current_syringe'] = 1
+	state['actuator_position_mm'] = 0.0
+	for pin in state['pins'].values():
+		pin['value'] = 0
+
+def take_journal(state: GlobalState) -> List[JournalEntry]:
+	entries = []
+	while True:
+		try:
+			entries.append(state['nonpersistent']['journal_queue'].get_nowait())
+		except Empty:
+			return entries
+
+def queued_verbs(state: GlobalState) -> List[str]:
+	return [command['specifics']['verb'] for command in state['command_queue']]
+
+def actuate(mm: float, duration_ms: float) -> CommandSpecifics:
+	return {
+		'verb': 'Actuate',
+		'duration_ms_required': duration_ms,
+		'relative_mm_required': mm,
+	}
+
+def uv_light_1(on_or_off) -> CommandSpecifics:
+	return { 'verb': 'Turn UV light', 'target_uv_light': 1, 'on_or_off': on_or_off }
+
+def test_compatible_actuates_are_fused(state: GlobalState):
+	calibrate(state)
+	caboose = enqueue_commands(state, 'Klipper', [actuate(0.1, 100.0)] * 3)
+	assert len(state['command_queue']) == 1
+	fused = state['command_queue'][0]
+	assert fused['specifics']['relative_mm_required'] == 0.1 * 3
+	assert fused['specifics']['duration_ms_required'] == 300.0
+	assert fused['fused_through_ordinal'] == caboose
+	assert fused['fused_command_count'] == 3
+
+def test_actuates_at_different_rates_or_from_others_are_not_fused(state: GlobalState):
+	calibrate(state)
+	enqueue_command(state, 'Klipper', actuate(0.1, 100.0))
+	enqueue_command(state, 'Klipper', actuate(0.1, 500.0))
+	enqueue_command(state, 'Operator', actuate(0.1, 500.0))
+	assert len(state['command_queue']) == 3
+
+def test_started_tail_is_not_fused_into(state: GlobalState):
+	calibrate(state)
+	enqueue_command(state, 'Klipper', actuate(0.1, 100.0))
+	state['command_queue'][0]['started_at'] = 0
+	enqueue_command(state, 'Klipper', actuate(0.1, 100.0))
+	assert len(state['command_queue']) == 2
+
+def test_fused_count_leaves_out_dropped_commands(state: GlobalState):
+	calibrate(state)
+	enqueue_command(state, 'Klipper', actuate(0.1, 100.0))
+	# Already off, so dropped, though it uses up an ordinal
+	enqueue_command(state, 'Klipper', uv_light_1('Off'))
+	enqueue_command(state, 'Klipper', actuate(0.1, 100.0))
+	fused = state['command_queue'][0]
+	assert fused['fused_through_ordinal'] == 2
+	assert fused['fused_command_count'] == 2
+
+def test_redundant_tool_change_is_dropped(state: GlobalState):
+	calibrate(state)
+	enqueue_commands(state, 'Klipper', [
+		{ 'verb': 'Actuate', 'duration_ms_required': 0.0, 'relative_mm_required': 'Retract to clearance' },
+		uv_light_1('Off'),
+		{ 'verb': 'Rotate', 'target_syringe': 1 },
+	])
+	assert state['command_queue'] == []
+	assert state['next_command_ordinal'] == 3
+
+def test_superseded_tail_is_dropped_and_journaled_as_drop(state: GlobalState):
+	calibrate(state)
+	enqueue_command(state, 'Operator', actuate(1.0, 1000.0))
+	enqueue_command(state, 'Operator', { 'verb': 'Rotate', 'target_syringe': 2 })
+	take_journal(state)
+	enqueue_command(state, 'Operator', { 'verb': 'Rotate', 'target_syringe': 3 })
+	assert queued_verbs(state) == ['Actuate', 'Rotate']
+	assert state['command_queue'][-1]['specifics'] == { 'verb': 'Rotate', 'target_syringe': 3 }
+	assert [entry['op'] for entry in take_journal(state)] == ['Drop', 'Enqueue']
+
+def test_tail_back_to_current_state_leaves_nothing(state: GlobalState):
+	calibrate(state)
+	enqueue_command(state, 'Operator', actuate(1.0, 1000.0))
+	enqueue_command(state, 'Operator', uv_light_1('On'))
+	enqueue_command(state, 'Operator', uv_light_1('Off'))
+	assert queued_verbs(state) == ['Actuate']
+
+def test_started_tail_is_never_dropped(state: GlobalState):
+	calibrate(state)
+	enqueue_command(state, 'Operator', uv_light_1('On'))
+	state['command_queue'][0]['started_at'] = 0
+	enqueue_command(state, 'Operator', uv_light_1('Off'))
+	assert queued_verbs(state) == ['Turn UV light', 'Turn UV light']
+
+def test_prediction_follows_hardware_changed_outside_the_queue(state: GlobalState):
+	calibrate(state)
+	state['pins']['uv_light_1']['value'] = 1
+	enqueue_command(state, 'Operator', actuate(1.0, 1000.0))
+	# E.g. processing paused
+	zero_out_pins(state)
+	enqueue_command(state, 'Operator', uv_light_1('On'))
+	assert queued_verbs(state) == ['Actuate', 'Turn UV light']
@@ -0,0 +1,64 @@
+from g_code_compiler import compile_g_code_file, write_advancing_g_code
+from pathlib import Path
+from request_handling import take_program_commands
+from state import GlobalState
+from typing import List
+
+# The first forwarded line is a travel move, which compiles to no commands
+G_CODE = '''G90
+G1 X0 Y0 F6000
+G91
+G1 X1.5 Y-0.75 E0.04 F1200
+T1
+G1 X1.5 Y-0.75 E0.04 F1200
+'''
+
+def compile_advances(state: GlobalState, tmp_path: Path) -> List[int]:
+	'''Markers of the BIOPRINTLY_ADVANCE lines Klipper would be sent'''
+	source_path = tmp_path / 'print.gcode'
+	advancing_path = tmp_path / 'print.bioprintly.gcode'
+	source_path.write_text(G_CODE)
+	program = compile_g_code_file(
+		state['nonpersistent']['savefolder_path'],
+		str(source_path),
+	)
+	write_advancing_g_code(str(source_path), str(advancing_path), program)
+	state['nonpersistent']['loaded_program'] = program
+	return [
+		int(line.split('MARKER=')[1].split()[0])
+		for line in advancing_path.read_text().splitlines()
+		if line.startswith('BIOPRINTLY_ADVANCE')
+	]
+
+def advance(state: GlobalState, marker: int) -> int:
+	loaded_program = state['nonpersistent']['loaded_program']
+	assert loaded_program != None
+	return len(take_program_commands(state, {
+		'program_sha256': loaded_program['source_sha256'],
+		'marker': marker,
+	}))
+
+def test_print_enqueues_every_command_once(state: GlobalState, tmp_path: Path):
+	markers = compile_advances(state, tmp_path)
+	assert markers[0] != 0
+	program_commands = len(state['nonpersistent']['loaded_program']['commands'])
+	assert sum(advance(state, marker) for marker in markers) == program_commands
+
+def test_retried_advance_is_ignored(state: GlobalState, tmp_path: Path):
+	markers = compile_advances(state, tmp_path)
+	for marker in markers:
+		assert advance(state, marker) > 0
+		assert advance(state, marker) == 0
+	assert advance(state, markers[0]) > 0
+
+def test_reprint_starts_over(state: GlobalState, tmp_path: Path):
+	markers = compile_advances(state, tmp_path)
+	first_print = [advance(state, marker) for marker in markers]
+	second_print = [advance(state, marker) for marker in markers]
+	assert second_print == first_print
+
+def test_skipped_markers_are_caught_up_on(state: GlobalState, tmp_path: Path):
+	markers = compile_advances(state, tmp_path)
+	program_commands = len(state['nonpersistent']['loaded_program']['commands'])
+	first_marker_commands = advance(state, markers[0])
+	assert advance(state, markers[-1]) == program_commands - first_marker_commands
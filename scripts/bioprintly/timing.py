@@ -0,0 +1,53 @@
+'''
+Timing for the loops that dead-reckon motion. unix_time_ms is for timestamps
+that people read only: wall-clock time can jump (the Pi has no real-time
+clock, so it does when NTP syncs), and flooring it to whole milliseconds is a
+12% error at an 8 ms processing interval. Waits sleep through most of the
+time, then spin on the clock for the rest, since sleeps can overshoot.
+'''
+from ctypes import Structure, c_double, c_uint64
+from multiprocessing.sharedctypes import RawValue
+from time import monotonic_ns, sleep
+from typing import List
+
+SPIN_NS = 200_000
+'''Tail end of each wait that's spun rather than slept; covers sleep overshoot'''
+LOOP_DELTA_SAMPLES = 4096
+
+class LoopDeltas(Structure):
+	'''
+	Ring of a loop's latest tick-to-tick times. Lives in shared memory, so that
+	it reads the same from outside the motion core process; see motion_core.py.
+	'''
+	_fields_ = [
+		('count', c_uint64),
+		('deltas_ms', c_double * LOOP_DELTA_SAMPLES),
+	]
+
+def monotonic_ms() -> float:
+	return monotonic_ns() / 1e6
+
+def sleep_until_ns(deadline_ns: int):
+	'''`deadline_ns` is in monotonic_ns time'''
+	remaining_ns = deadline_ns - monotonic_ns()
+	if remaining_ns > SPIN_NS:
+		sleep((remaining_ns - SPIN_NS) / 1e9)
+	while monotonic_ns() < deadline_ns:
+		# Lets other threads have the GIL while spinning
+		sleep(0)
+
+def create_loop_deltas() -> LoopDeltas:
+	return RawValue(LoopDeltas)
+
+def record_loop_delta(loop_deltas: LoopDeltas, delta_ms: float):
+	loop_deltas.deltas_ms[loop_deltas.count % LOOP_DELTA_SAMPLES] = delta_ms
+	loop_deltas.count += 1
+
+def get_loop_deltas_ms(loop_deltas: LoopDeltas) -> List[float]:
+	'''Oldest first, once the ring has wrapped around'''
+	count = loop_deltas.count
+	deltas_ms = list(loop_deltas.deltas_ms)
+	if count <= LOOP_DELTA_SAMPLES:
+		return deltas_ms[:count]
+	start = count % LOOP_DELTA_SAMPLES
+	return deltas_ms[start:] + deltas_ms[:start]
@@ -1,10 +1,7 @@
 from colorsys import hsv_to_rgb
 from datetime import datetime
-import json
 from math import floor
-from threading import Timer
 from time import time_ns
-from tkinter import Tk, Toplevel
 from typing import Any, List, Literal, cast
 
 def unix_time_ms() -> int:
@@ -44,9 +41,6 @@ def throw(exception: Exception):
 	'''Allows raising exceptions inside lambdas'''
 	raise exception
 
-def deep_equals(a: Any, b: Any):
-	return json.dumps(a, sort_keys = True) == json.dumps(b, sort_keys = True)
-
 def flatten(two_level_list: List[List[Any]]) -> List[Any]:
 	result = []
 	for inner_list in two_level_list:
@@ -54,15 +48,6 @@ def flatten(two_level_list: List[List[Any]]) -> List[Any]:
 			result.append(value)
 	return result
 
-def maximize_tk_window(root: Tk | Toplevel):
-	try:
-		root.state('zoomed')
-		# Workaround for zoom not working after re-opening the root window
-		if root.state() != 'zoomed':
-			Timer(0, lambda: root.state('zoomed')).start()
-	except:
-		pass
-
 def stringify_primitive(value: Any) -> str:
 	if type(value) is float:
 		# 2 digits after the dot